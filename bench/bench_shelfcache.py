@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of `ShelfCache` over its storage backends.
+
+Measures the throughput and the p50/p99 latency of get, set, delete and prune
+operations for every combination of:
+
+- backend: the `LockedShelf` implementations (`MutexShelf`, `RWShelf`,
+  `RWLockShelf`, `SqliteShelf` and `LogShelf`), the dbm based ones once per
+  available dbm module (`dbm.gnu`, `dbm.ndbm` and `dbm.dumb`)
+- value size and number of keys
+- read ratio: the fraction of gets in the mixed get/set workload (1 for gets
+  only, 0 for sets only)
+- number of threads and of processes running the workload at once
+
+In the mixed workload, the throughput of gets and of sets are both counted
+over the whole run.
+
+Delete and prune are measured once per backend, value size and number of keys
+(from a single thread): for prune, half of the keys have expired, the count
+is the number of items deleted and the latency is that of the whole call.
+
+The results are written as JSON (to stdout, or to the `--output` file), one
+record per configuration and operation, so that runs can be compared (run
+from the root of the repository, or with shelfcache installed)::
+
+    $ PYTHONPATH=. python bench/bench_shelfcache.py --quick -o before.json
+    $ PYTHONPATH=. python bench/bench_shelfcache.py --quick -o after.json \\
+          --compare before.json
+
+With `--compare`, the change in throughput of every operation is printed (to
+stderr), and the exit status is 1 if any is slower than the baseline by more
+than `--threshold`.
+
+Every configuration uses a fresh database in a temporary directory (see
+`--dir`, to benchmark the disk the cache will live on). Worker processes are
+spawned, not forked, so that they don't share the state of the backends.
+"""
+from shelfcache import ShelfCache
+from shelfcache.locked_shelf import MutexShelf, RWShelf, RWLockShelf
+from shelfcache.sqlite_shelf import SqliteShelf
+from shelfcache.log_shelf import LogShelf
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional
+import argparse
+import dbm
+import functools
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+
+DBM_BACKENDS = ('MutexShelf', 'RWShelf', 'RWLockShelf')
+"""The backends which store the shelf in a dbm database."""
+
+BACKENDS = DBM_BACKENDS + ('SqliteShelf', 'LogShelf')
+
+DBM_MODULES = ('dbm.gnu', 'dbm.ndbm', 'dbm.dumb')
+
+KEY_FIELDS = ('backend', 'dbm', 'value_size', 'keys', 'read_ratio',
+              'threads', 'processes', 'op')
+"""The fields identifying a result (when comparing runs)."""
+
+FULL = dict(value_sizes=[100, 4096, 65536], keys=[100, 1000],
+            read_ratios=[1.0, 0.9, 0.5, 0.0], threads=[1, 4],
+            processes=[1, 4], ops=500)
+
+QUICK = dict(value_sizes=[100, 4096], keys=[100], read_ratios=[0.9],
+             threads=[1, 4], processes=[1, 2], ops=200)
+
+
+def available_dbms() -> List[str]:
+    found = []
+    for name in DBM_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            continue
+        found.append(name)
+    return found
+
+
+def use_dbm(name: Optional[str]) -> None:
+    """
+    Create new dbm databases with the module `name` (`shelve` has no option
+    for it; existing databases are opened with the module which created them
+    whatever this setting).
+    """
+    if name is not None:
+        module = importlib.import_module(name)
+        # (dbm.open only fills its table of modules if it picks the default)
+        dbm._modules[name] = module
+        dbm._defaultmod = module
+
+
+def shelf_type(backend: str, processes: int, lock=None) -> Callable:
+    """
+    The `shelf_t` of a backend, synchronizing `processes` processes.
+
+    :param lock: The lock of `MutexShelf` (a `multiprocessing.Lock` when
+        there are several processes)
+    """
+    if backend == 'MutexShelf':
+        return functools.partial(MutexShelf, lock=lock or threading.Lock())
+    if backend == 'RWLockShelf':
+        # Its RWLock only synchronizes the threads of a process
+        return functools.partial(RWLockShelf, use_flock=processes > 1)
+    return {'RWShelf': RWShelf, 'SqliteShelf': SqliteShelf,
+            'LogShelf': LogShelf}[backend]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    The `q`-quantile of the sorted `values` (0 if there are none).
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(config: Dict[str, Any], op: str, latencies: List[float],
+              seconds: float, count: Optional[int]=None) -> Dict[str, Any]:
+    """
+    Build the result record of an operation from its latencies (seconds) and
+    the wall-clock time they were recorded in.
+    """
+    latencies = sorted(latencies)
+    if count is None:
+        count = len(latencies)
+    result = dict(config, op=op, count=count, seconds=seconds)
+    result.update(
+        ops_per_sec=count / seconds if seconds > 0 else 0.0,
+        mean=sum(latencies) / len(latencies) if latencies else 0.0,
+        p50=percentile(latencies, 0.5),
+        p99=percentile(latencies, 0.99))
+    return result
+
+
+def make_keys(count: int) -> List[str]:
+    return ['key{}'.format(i) for i in range(count)]
+
+
+def populate(cache: ShelfCache, config: Dict[str, Any],
+             expired: float=0.0) -> List[str]:
+    """
+    Write `config['keys']` items of `config['value_size']` bytes, the first
+    `expired` fraction of them already expired.
+    """
+    keys = make_keys(config['keys'])
+    value = os.urandom(config['value_size'])
+    stale = int(len(keys) * expired)
+    if stale:
+        cache.set_many([(key, value) for key in keys[:stale]],
+                       expire_dt=datetime.utcnow() - timedelta(days=1))
+    cache.set_many([(key, value) for key in keys[stale:]])
+    return keys
+
+
+def _mixed_thread(cache: ShelfCache, keys: List[str], value: bytes,
+                  read_ratio: float, ops: int, seed: int,
+                  results: List) -> None:
+    rng = random.Random(seed)
+    clock = time.perf_counter
+    gets = []  # type: List[float]
+    sets = []  # type: List[float]
+    for _ in range(ops):
+        key = keys[rng.randrange(len(keys))]
+        if rng.random() < read_ratio:
+            start = clock()
+            cache.get(key)
+            gets.append(clock() - start)
+        else:
+            start = clock()
+            cache.create_or_update(key, value)
+            sets.append(clock() - start)
+    results.append((gets, sets))
+
+
+def _mixed_process(config: Dict[str, Any], db_path: str, lock, barrier,
+                   ops: int, seed: int, results_queue) -> None:
+    """
+    Run the mixed workload on `config['threads']` threads, and put the get
+    and set latencies and the start and end times on `results_queue`.
+    """
+    cache = ShelfCache(db_path, shelf_t=shelf_type(
+        config['backend'], config['processes'], lock))
+    keys = make_keys(config['keys'])
+    value = os.urandom(config['value_size'])
+    results = []  # type: List
+    threads = [threading.Thread(target=_mixed_thread,
+                                args=(cache, keys, value,
+                                      config['read_ratio'], ops,
+                                      seed * 1000 + i, results))
+               for i in range(config['threads'])]
+    if barrier is not None:
+        barrier.wait()
+    begin = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    end = time.time()
+    cache.close()
+    gets = [latency for thread_gets, _ in results for latency in thread_gets]
+    sets = [latency for _, thread_sets in results for latency in thread_sets]
+    results_queue.put((gets, sets, begin, end))
+
+
+def bench_mixed(config: Dict[str, Any], db_path: str,
+                ops: int) -> List[Dict[str, Any]]:
+    """
+    Run the mixed get/set workload, `ops` operations per thread.
+    """
+    cache = ShelfCache(db_path, shelf_t=shelf_type(config['backend'], 1))
+    populate(cache, config)
+    cache.close()
+
+    processes = config['processes']
+    if processes == 1:
+        results_queue = queue.Queue()  # type: Any
+        _mixed_process(config, db_path, None, None, ops, 0, results_queue)
+        outcomes = [results_queue.get()]
+    else:
+        context = multiprocessing.get_context('spawn')
+        lock = context.Lock()
+        barrier = context.Barrier(processes)
+        results_queue = context.Queue()
+        workers = [context.Process(target=_mixed_process,
+                                   args=(config, db_path, lock, barrier, ops,
+                                         seed, results_queue))
+                   for seed in range(processes)]
+        for worker in workers:
+            worker.start()
+        # (drained before joining, or the workers could block on it)
+        outcomes = [results_queue.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+
+    seconds = (max(outcome[3] for outcome in outcomes) -
+               min(outcome[2] for outcome in outcomes))
+    results = []
+    for op, index in (('get', 0), ('set', 1)):
+        latencies = [latency for outcome in outcomes
+                     for latency in outcome[index]]
+        if latencies:
+            results.append(summarize(config, op, latencies, seconds))
+    return results
+
+
+def bench_delete(config: Dict[str, Any], db_path: str) -> Dict[str, Any]:
+    cache = ShelfCache(db_path, shelf_t=shelf_type(config['backend'], 1))
+    keys = populate(cache, config)
+    clock = time.perf_counter
+    latencies = []
+    begin = clock()
+    for key in keys:
+        start = clock()
+        cache.delete(key)
+        latencies.append(clock() - start)
+    seconds = clock() - begin
+    cache.close()
+    return summarize(config, 'delete', latencies, seconds)
+
+
+def bench_prune(config: Dict[str, Any], db_path: str) -> Dict[str, Any]:
+    cache = ShelfCache(db_path, shelf_t=shelf_type(config['backend'], 1))
+    populate(cache, config, expired=0.5)
+    start = time.perf_counter()
+    count = cache.prune_expired()
+    seconds = time.perf_counter() - start
+    cache.close()
+    return summarize(config, 'prune', [seconds], seconds, count)
+
+
+def backends(names: List[str],
+             dbms: List[str]) -> Iterator[Dict[str, Any]]:
+    """
+    The (backend, dbm) pairs to benchmark.
+    """
+    for name in names:
+        if name in DBM_BACKENDS:
+            for module in dbms:
+                yield {'backend': name, 'dbm': module}
+        else:
+            yield {'backend': name, 'dbm': None}
+
+
+def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []  # type: List[Dict[str, Any]]
+
+    def bench(config: Dict[str, Any], fn: Callable, *fn_args) -> None:
+        use_dbm(config['dbm'])
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+            db_path = os.path.join(tmpdir, 'bench.db')
+            try:
+                outcome = fn(config, db_path, *fn_args)
+            except Exception as e:
+                print("{}: failed: {!r}".format(config, e), file=sys.stderr)
+                return
+        outcome = outcome if isinstance(outcome, list) else [outcome]
+        for result in outcome:
+            print("{backend} {dbm} size={value_size} keys={keys} "
+                  "reads={read_ratio} threads={threads} "
+                  "processes={processes} {op}: {ops_per_sec:.0f} ops/s, "
+                  "p50 {p50:.6f}s, p99 {p99:.6f}s".format(**result),
+                  file=sys.stderr)
+        results.extend(outcome)
+
+    for backend in backends(args.backends, args.dbms):
+        for size, keys in itertools.product(args.value_sizes, args.keys):
+            base = dict(backend, value_size=size, keys=keys)
+            single = dict(base, read_ratio=None, threads=1, processes=1)
+            bench(single, bench_delete)
+            bench(single, bench_prune)
+            for ratio, threads, processes in itertools.product(
+                    args.read_ratios, args.threads, args.processes):
+                config = dict(base, read_ratio=ratio, threads=threads,
+                              processes=processes)
+                bench(config, bench_mixed, args.ops)
+    return results
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any],
+            threshold: float) -> int:
+    """
+    Print the change in throughput of each result found in the `baseline`
+    run, and return the number which are slower by more than `threshold`.
+    """
+    def key(result: Dict[str, Any]) -> tuple:
+        return tuple(result.get(field) for field in KEY_FIELDS)
+
+    before = {key(result): result for result in baseline['results']}
+    regressions = 0
+    for result in results:
+        old = before.get(key(result))
+        if old is None or not old['ops_per_sec']:
+            continue
+        change = result['ops_per_sec'] / old['ops_per_sec'] - 1
+        regressed = change < -threshold
+        regressions += regressed
+        fields = ' '.join(str(field) for field in key(result))
+        print("{}{:+.1%} {}".format('REGRESSION ' if regressed else '',
+                                    change, fields), file=sys.stderr)
+    return regressions
+
+
+def int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(',')]
+
+
+def float_list(value: str) -> List[float]:
+    return [float(item) for item in value.split(',')]
+
+
+def str_list(value: str) -> List[str]:
+    return value.split(',')
+
+
+def parse_args(argv: Optional[List[str]]=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark ShelfCache over its storage backends.")
+    parser.add_argument('--quick', action='store_true',
+                        help="run a small set of configurations")
+    parser.add_argument('--backends', type=str_list, default=list(BACKENDS),
+                        help="comma-separated backends (default: all)")
+    parser.add_argument('--dbms', type=str_list, default=available_dbms(),
+                        help="comma-separated dbm modules for the dbm based "
+                             "backends (default: all available)")
+    parser.add_argument('--value-sizes', type=int_list)
+    parser.add_argument('--keys', type=int_list)
+    parser.add_argument('--read-ratios', type=float_list)
+    parser.add_argument('--threads', type=int_list)
+    parser.add_argument('--processes', type=int_list)
+    parser.add_argument('--ops', type=int,
+                        help="operations per thread in the mixed workload")
+    parser.add_argument('--dir', help="where to create the databases")
+    parser.add_argument('-o', '--output', help="write the results there "
+                                               "instead of to stdout")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="compare with the results of an earlier run")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="the slowdown reported as a regression "
+                             "(default: 0.1)")
+    args = parser.parse_args(argv)
+    for name, default in (QUICK if args.quick else FULL).items():
+        if getattr(args, name) is None:
+            setattr(args, name, default)
+    unknown = set(args.backends) - set(BACKENDS)
+    if unknown:
+        parser.error("unknown backends: {}".format(', '.join(sorted(unknown))))
+    return args
+
+
+def main(argv: Optional[List[str]]=None) -> int:
+    args = parse_args(argv)
+    results = run(args)
+    report = {
+        'meta': {
+            'time': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': {name: value for name, value in vars(args).items()
+                     if name not in ('output', 'compare')},
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
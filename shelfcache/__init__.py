@@ -1,2 +1,7 @@
-from .cache_get import cache_get
+from .cache_get import cache_get, cache_get_many
 from .shelfcache import ShelfCache
+from .sharded import ShardedShelfCache
+from .async_cache import AsyncShelfCache, async_cache_get
+from .response import CachedResponse
+from .session import CachedSession
+from .stats import CacheStats
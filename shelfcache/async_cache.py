@@ -0,0 +1,218 @@
+"""
+asyncio front-ends to `ShelfCache` and `cache_get`.
+
+Every `ShelfCache` operation may block on a file lock and on disk I/O, which
+would stall an event loop. `AsyncShelfCache` runs them in a dedicated, bounded
+pool of threads and exposes them as coroutines:
+
+    >>> cache = AsyncShelfCache('path/to/cache.db', exp_seconds=1200)
+    >>> await cache.create_or_update('key', data)
+    >>> result = await cache.get('key')
+
+`async_cache_get` is the coroutine version of `cache_get`. Its `get_meth` is
+an async callable (eg. a small wrapper around an aiohttp session) which
+returns a `requests.Response`-like object (it needs `status_code`, `headers`
+and `raise_for_status()`, and must be picklable to be cached), so thousands of
+fetches can be in flight in one process while only the cache operations use
+the thread pool:
+
+    >>> response = await async_cache_get(cache, url, get_meth=fetch)
+
+Without a `get_meth`, `requests.get` is run in the event loop's default
+executor.
+"""
+from .shelfcache import ShelfCache, CacheResult, Item
+from .cache_get import (_conditional_headers, _revalidated, _exp_seconds,
+                        _expiry)
+from .record import ItemMeta
+from .response import CachedResponse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from typing import (Any, Awaitable, Callable, Dict, Iterable, Mapping,
+                    Optional, Tuple, Union)
+import asyncio
+import requests
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncShelfCache:
+    """
+    Runs the operations of a `ShelfCache` (or of any object with the same
+    API, like a `ShardedShelfCache`) in a bounded thread pool so that they
+    can be awaited without blocking the event loop.
+
+    :ivar cache: The wrapped (synchronous) cache
+    """
+
+    def __init__(self, db_path='shelfcache.db', exp_seconds=-1,
+                 max_workers: int=4, cache: Optional[ShelfCache]=None,
+                 **kwargs) -> None:
+        """
+        :param db_path: Path to database (ignored if `cache` is given)
+        :param exp_seconds: The default expiry time to use for a cached item
+            (ignored if `cache` is given)
+        :param max_workers: The maximum number of cache operations run at once
+            (the size of the thread pool)
+        :param cache: An existing cache to wrap
+        :param kwargs: Passed to `ShelfCache` (if `cache` is not given)
+        """
+        if cache is None:
+            cache = ShelfCache(db_path, exp_seconds, **kwargs)
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix='shelfcache')
+
+    @property
+    def exp_seconds(self) -> int:
+        return self.cache.exp_seconds
+
+    async def _run(self, fn: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          partial(fn, *args, **kwargs))
+
+    async def close(self) -> None:
+        """
+        Close the cache and shut the thread pool down.
+        """
+        await self._run(self.cache.close)
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self) -> 'AsyncShelfCache':
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.close()
+
+    async def get(self, key) -> Optional[CacheResult]:
+        return await self._run(self.cache.get, key)
+
+    async def get_many(self, keys: Iterable) -> Dict[Any, CacheResult]:
+        return await self._run(self.cache.get_many, list(keys))
+
+    async def get_item(self, key) -> Optional[Item]:
+        return await self._run(self.cache.get_item, key)
+
+    async def meta(self, key) -> Optional[ItemMeta]:
+        return await self._run(self.cache.meta, key)
+
+    async def ttl(self, key) -> Optional[timedelta]:
+        return await self._run(self.cache.ttl, key)
+
+    async def is_fresh(self, key) -> bool:
+        return await self._run(self.cache.is_fresh, key)
+
+    async def create_or_update(self, key, data=None,
+                               expire_dt: Optional[datetime]=None,
+                               exp_seconds: Optional[int]=None) -> None:
+        await self._run(self.cache.create_or_update, key, data=data,
+                        expire_dt=expire_dt, exp_seconds=exp_seconds)
+
+    async def set_many(self, items: Union[Mapping, Iterable[Tuple[Any, Any]]],
+                       expire_dt: Optional[datetime]=None,
+                       exp_seconds: Optional[int]=None) -> None:
+        if not isinstance(items, Mapping):
+            items = list(items)
+        await self._run(self.cache.set_many, items, expire_dt, exp_seconds)
+
+    async def update(self, key, fn: Callable[[Any], Any], default: Any=None,
+                     expire_dt: Optional[datetime]=None,
+                     exp_seconds: Optional[int]=None) -> Any:
+        return await self._run(self.cache.update, key, fn, default,
+                               expire_dt, exp_seconds)
+
+    async def incr(self, key, n: int=1, initial: int=0) -> int:
+        return await self._run(self.cache.incr, key, n, initial)
+
+    async def compare_and_set(self, key, expected_version: int, data=None,
+                              expire_dt: Optional[datetime]=None,
+                              exp_seconds: Optional[int]=None) -> bool:
+        return await self._run(self.cache.compare_and_set, key,
+                               expected_version, data, expire_dt, exp_seconds)
+
+    async def update_expires(self, key,
+                             expire_dt: Optional[datetime]=None) -> None:
+        await self._run(self.cache.update_expires, key, expire_dt)
+
+    async def replace_data(self, key, data: Optional[object]=None) -> None:
+        await self._run(self.cache.replace_data, key, data)
+
+    async def delete(self, key: str) -> None:
+        await self._run(self.cache.delete, key)
+
+    async def delete_many(self, keys: Iterable) -> int:
+        return await self._run(self.cache.delete_many, list(keys))
+
+    async def prune_expired(self, older_than: Optional[datetime]=None) -> int:
+        return await self._run(self.cache.prune_expired, older_than)
+
+    async def prune_old(self, older_than: Optional[datetime]=None) -> int:
+        return await self._run(self.cache.prune_old, older_than)
+
+    async def clear(self) -> None:
+        await self._run(self.cache.clear)
+
+    async def stats(self) -> Dict[str, Any]:
+        return await self._run(self.cache.stats)
+
+
+async def _requests_get(url: str, **kwargs) -> requests.Response:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(requests.get, url,
+                                                    **kwargs))
+
+
+async def async_cache_get(cache: AsyncShelfCache, url: str, headers=None,
+                          get_meth: Callable[..., Awaitable]=_requests_get,
+                          compact: bool=False,
+                          **kwargs) -> requests.Response:
+    """
+    Like `cache_get`, but awaits the cache operations and the HTTP request
+    instead of blocking.
+
+    :param cache: The AsyncShelfCache to handle the cache
+    :param url: the url of the resource to fetch
+    :param get_meth: The coroutine function called (with the url, `headers`
+        and `kwargs`) to issue the HTTP get request. It must return a
+        `requests.Response`-like object. By default, `requests.get` is run in
+        the default executor of the event loop.
+    :param compact: Cache `CachedResponse` objects instead of responses (see
+        `cache_get`)
+    :param **kwargs: All keyword args are passed to `get_meth`
+
+    Returns:
+        The requested resource.
+    """
+    cached = None
+    if headers is None:
+        headers = {}
+
+    logger.info("Fetching item for url: {}".format(url))
+    item = await cache.get(url)
+    if item:
+        cached, expired = item.data, item.expired
+        if not expired:
+            logger.info("Returning fresh item found in cache: {}"
+                        .format(url))
+            return cached
+        logger.info("Stale item found in cache: {}".format(url))
+        _conditional_headers(cached, headers)
+    else:
+        logger.info("No item in cache for url: {}".format(url))
+
+    logger.info("Fetching from remote {}".format(url))
+    fetched = await get_meth(url, headers=headers, **kwargs)
+    fetched = _revalidated(url, fetched, cached)
+
+    min_age = _exp_seconds(cache, fetched)
+    if min_age is None:
+        logger.info("Not caching resource (no-store): {}".format(url))
+        return fetched
+    logger.info("Saving resource for {} with exp_seconds: {}"
+                .format(url, min_age))
+    data = CachedResponse.from_response(fetched) if compact else fetched
+    await cache.create_or_update(url, data=data, **_expiry(min_age))
+    return fetched
@@ -0,0 +1,354 @@
+"""
+Content-addressed storage for the large binary values inside cached items.
+
+When `ShelfCache` is given a `blob_threshold`, every `bytes`, `bytearray` or
+`memoryview` object of at least that many bytes found while pickling an item
+(eg. the body of a cached `requests.Response`) is written to its own file in
+the `<db_path>.blobs` directory, named after the SHA-256 of its contents, and
+only a reference to it is pickled (see :func:`dumps`). Identical values are
+stored once, however many items (or urls) they belong to, and rewriting an
+item's metadata never rewrites its blobs.
+
+Blobs are read with `mmap`: `bytes` and `bytearray` objects are copied
+straight from the mapping, and `memoryview` objects are read back as views of
+the mapping itself.
+
+Large bodies can also be written to the store a chunk at a time (see
+:meth:`BlobStore.writer`), and cached as a `BlobRef`: pickling a `BlobRef`
+only stores its digest (whatever `blob_threshold` is, as long as it is set),
+and unpickling it gives a `BlobRef` which reads the blob a chunk at a time
+(see :meth:`BlobRef.chunks`).
+
+The payload of an item with blobs starts with the list of their digests, so
+that :meth:`ShelfCache.collect_blobs` (which runs every few prunes) can find
+the unreferenced blobs without unpickling anything.
+"""
+from typing import Any, Iterator, List, Optional, Set, Tuple
+import hashlib
+import io
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SIZE = 32
+
+CHUNK_SIZE = 65536
+
+_COUNT = struct.Struct('<I')
+_TYPES = {bytes: 'b', bytearray: 'a', memoryview: 'm'}
+
+
+class BlobStore:
+    """
+    A directory of immutable files named after the SHA-256 of their contents
+    (in subdirectories named after the first two hex digits).
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: The directory (created when the first blob is written)
+        """
+        self.path = path
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def exists(self) -> bool:
+        return os.path.isdir(self.path)
+
+    def put(self, data) -> str:
+        """
+        Store `data` (a bytes-like object) unless an identical blob exists,
+        and return its (hex) digest.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        try:
+            # Tell collect() it's still in use
+            os.utime(path)
+            return digest
+        except FileNotFoundError:
+            pass
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        logger.debug("Stored blob {}".format(digest))
+        return digest
+
+    def get(self, digest: str) -> memoryview:
+        """
+        Return a read-only view of the mapped blob (raises FileNotFoundError
+        if there is no such blob).
+        """
+        with open(self._path(digest), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b'')
+            return memoryview(mmap.mmap(f.fileno(), 0,
+                                        access=mmap.ACCESS_READ))
+
+    def chunks(self, digest: str,
+               chunk_size: int=CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        Read a blob `chunk_size` bytes at a time.
+        """
+        with open(self._path(digest), 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def writer(self) -> 'BlobWriter':
+        """
+        Return a `BlobWriter` to store a blob a chunk at a time.
+        """
+        return BlobWriter(self)
+
+    def __contains__(self, digest: str) -> bool:
+        return os.path.exists(self._path(digest))
+
+    def digests(self) -> Iterator[str]:
+        if not self.exists():
+            return
+        for prefix in os.listdir(self.path):
+            directory = os.path.join(self.path, prefix)
+            if len(prefix) != 2 or not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if not name.startswith('.'):
+                    yield prefix + name
+
+    def collect(self, referenced: Set[str],
+                grace: float=60) -> Tuple[int, int]:
+        """
+        Delete the blobs which are not in `referenced`, except those written
+        (or re-used) less than `grace` seconds ago, which may belong to items
+        being written.
+
+        Returns:
+            The number of blobs deleted and their total size
+        """
+        count = nbytes = 0
+        cutoff = time.time() - grace
+        if self.exists():
+            # Left behind by writers which crashed
+            for name in os.listdir(self.path):
+                path = os.path.join(self.path, name)
+                try:
+                    if (name.startswith('.tmp') and
+                            os.stat(path).st_mtime <= cutoff):
+                        os.unlink(path)
+                except FileNotFoundError:
+                    pass
+        for digest in list(self.digests()):
+            if digest in referenced:
+                continue
+            path = self._path(digest)
+            try:
+                st = os.stat(path)
+                if st.st_mtime > cutoff:
+                    continue
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            count += 1
+            nbytes += st.st_size
+        if count:
+            logger.info("Deleted {} unreferenced blobs ({} bytes)"
+                        .format(count, nbytes))
+        return count, nbytes
+
+
+class BlobRef:
+    """
+    A reference to a blob (which is pickled as such by the blob pickler, see
+    :func:`dumps`).
+
+    :ivar digest: The blob's (hex) digest
+    :ivar size: The blob's size in bytes
+    :ivar store: The `BlobStore` holding it (None once pickled by anything but
+        the blob pickler)
+    """
+    __slots__ = ('digest', 'size', 'store')
+
+    def __init__(self, digest: str, size: int,
+                 store: Optional[BlobStore]=None) -> None:
+        self.digest = digest
+        self.size = size
+        self.store = store
+
+    def chunks(self, chunk_size: int=CHUNK_SIZE) -> Iterator[bytes]:
+        if self.store is None:
+            raise ValueError("BlobRef {} has no store".format(self.digest))
+        return self.store.chunks(self.digest, chunk_size)
+
+    def read(self) -> bytes:
+        """
+        Read the whole blob.
+        """
+        return b''.join(self.chunks())
+
+    def __reduce__(self) -> tuple:
+        return BlobRef, (self.digest, self.size)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, BlobRef) and other.digest == self.digest
+
+    def __hash__(self) -> int:
+        return hash(self.digest)
+
+    def __repr__(self) -> str:
+        return '<BlobRef {} ({} bytes)>'.format(self.digest, self.size)
+
+
+class BlobWriter:
+    """
+    Writes a blob a chunk at a time (to a temporary file, which is renamed
+    after its digest by :meth:`commit`).
+
+        >>> writer = store.writer()
+        >>> for chunk in chunks:
+        >>>     writer.write(chunk)
+        >>> ref = writer.commit()
+    """
+
+    def __init__(self, store: BlobStore) -> None:
+        self.store = store
+        self.size = 0
+        os.makedirs(store.path, exist_ok=True)
+        fd, self._tmp = tempfile.mkstemp(dir=store.path, prefix='.tmp')
+        self._file = os.fdopen(fd, 'wb')
+        self._hash = hashlib.sha256()
+
+    def write(self, data) -> None:
+        self._file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def commit(self) -> BlobRef:
+        """
+        Store the blob (unless an identical one exists) and return a
+        reference to it.
+        """
+        self._file.close()
+        digest = self._hash.hexdigest()
+        path = self.store._path(digest)
+        if os.path.exists(path):
+            os.unlink(self._tmp)
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self._tmp, path)
+        logger.debug("Stored blob {} ({} bytes)".format(digest, self.size))
+        return BlobRef(digest, self.size, self.store)
+
+    def abort(self) -> None:
+        """
+        Discard what was written.
+        """
+        self._file.close()
+        try:
+            os.unlink(self._tmp)
+        except FileNotFoundError:
+            pass
+
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, file, protocol, store: BlobStore,
+                 threshold: int) -> None:
+        super().__init__(file, protocol)
+        self.store = store
+        self.threshold = threshold
+        self.digests = []  # type: List[str]
+
+    def persistent_id(self, obj) -> Any:
+        if type(obj) is BlobRef:
+            self.digests.append(obj.digest)
+            return 'r', obj.digest, obj.size
+        tag = _TYPES.get(type(obj))
+        if tag is None:
+            return None
+        size = obj.nbytes if tag == 'm' else len(obj)
+        if size < self.threshold:
+            return None
+        digest = self.store.put(obj)
+        self.digests.append(digest)
+        return tag, digest
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, store: BlobStore) -> None:
+        super().__init__(file)
+        self.store = store
+
+    def persistent_load(self, pid) -> Any:
+        if pid[0] == 'r':
+            return BlobRef(pid[1], pid[2], self.store)
+        tag, digest = pid
+        view = self.store.get(digest)
+        if tag == 'm':
+            return view
+        mapping = view.obj
+        data = bytes(view) if tag == 'b' else bytearray(view)
+        view.release()
+        if isinstance(mapping, mmap.mmap):
+            mapping.close()
+        return data
+
+
+def dumps(obj, store: BlobStore, threshold: int,
+          protocol=None) -> Tuple[bool, bytes]:
+    """
+    Pickle `obj`, storing its large binary values in `store`.
+
+    Returns:
+        Whether any value was stored in `store`, and the payload: a plain
+        pickle if not, and otherwise the digests of the blobs followed by the
+        pickle.
+    """
+    f = io.BytesIO()
+    pickler = _Pickler(f, protocol, store, threshold)
+    pickler.dump(obj)
+    if not pickler.digests:
+        return False, f.getvalue()
+    digests = [bytes.fromhex(digest) for digest in pickler.digests]
+    return True, b''.join([_COUNT.pack(len(digests))] + digests +
+                          [f.getbuffer()])
+
+
+def _split(payload) -> Tuple[List[str], memoryview]:
+    payload = memoryview(payload)
+    count = _COUNT.unpack_from(payload)[0]
+    end = _COUNT.size + count * DIGEST_SIZE
+    digests = [payload[start:start + DIGEST_SIZE].hex()
+               for start in range(_COUNT.size, end, DIGEST_SIZE)]
+    return digests, payload[end:]
+
+
+def references(payload) -> List[str]:
+    """
+    Return the digests of the blobs referenced by a payload written by
+    :func:`dumps` (with blobs).
+    """
+    return _split(payload)[0]
+
+
+def loads(payload, store: BlobStore) -> Any:
+    """
+    Unpickle a payload written by :func:`dumps` (with blobs).
+    """
+    data = _split(payload)[1]
+    return _Unpickler(io.BytesIO(data), store).load()
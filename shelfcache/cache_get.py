@@ -11,6 +11,13 @@ Resources (even when stale) are never deleted from the cache. Pruning must be
 done separately, if needed (see the :meth:`prune_expired`, :meth:`prune_old`,
 and :meth:`clear` methods of `shelfcache`)
 
+Large response bodies can be kept out of the database (and stored once each,
+however many urls return them) by giving the cache a `blob_threshold`. Such a
+cache can also be used to stream responses (passing `stream=True`, like with
+`requests.get()`): their bodies are then written to the cache as they are
+read, and read back from it a chunk at a time (see `StreamingResponse`), so
+they never have to fit in memory.
+
 Usage is as simple as first initializing a ShelfCache object with a path where
 the database file should be created and a default expiration time for cached
 resources (seconds), and then calling the `cache_get` function with the URL to
@@ -30,18 +37,389 @@ http://docs.python-requests.org/en/master/user/quickstart/#response-content
 .. _requests package: http://docs.python-requests.org/en/master/r
 """
 import requests
+import copy
 import re
+import threading
 import logging
 from .shelfcache import ShelfCache
-from typing import Callable
+from .sharded import ShardedShelfCache
+from .flight import flight_for, LEAD, TIMEOUT
+from .response import CachedResponse
+from .freshness import Freshness
+from . import freshness
+from .blobs import CHUNK_SIZE
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
+from datetime import datetime
+from requests.utils import stream_decode_response_unicode
+from typing import (Any, Callable, Deque, Dict, Iterable, Iterator, List,
+                    Optional, Tuple, Union)
+from urllib.parse import urlsplit
 
 NOT_MODIFIED = 304
 
+REFRESH_WORKERS = 4
+"""The number of threads refreshing stale items in the background (see the
+`stale_while_revalidate` parameter of `cache_get`)."""
+
 logger = logging.getLogger(__name__)
 
+_refresh_pool = None  # type: Optional[ThreadPoolExecutor]
+_refreshing = {}  # type: Dict[Tuple[str, str], Future]
+_refresh_lock = threading.Lock()
+
+
+class StreamingResponse:
+    """
+    The response returned by `cache_get` when a streamed response
+    (`stream=True`) is fetched. Reading its body with :meth:`iter_content`
+    also writes it to the cache's blob store, and the response is cached (as
+    a `CachedResponse`) once it has been read entirely. Anything else is
+    delegated to the `requests.Response`.
+
+    Note that the body can only be read once (the `text` and `json()` of the
+    `requests.Response` can't be used).
+
+    :ivar on_close: Called once the body has been cached, or given up on
+        (used to hold the single-flight slot of the url until then)
+    """
+
+    def __init__(self, response: requests.Response, cache: ShelfCache,
+                 url: str, exp_seconds: int) -> None:
+        self.response = response
+        self.cache = cache
+        self.url = url
+        self.exp_seconds = exp_seconds
+        self._consumed = False
+        self._content = None  # type: Optional[bytes]
+        self.on_close = None  # type: Optional[Callable[[], None]]
+
+    def _closed(self) -> None:
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close()
+
+    def _tee(self, chunk_size: int) -> Iterator[bytes]:
+        try:
+            writer = _shard(self.cache, self.url).blob_store.writer()
+            try:
+                for chunk in self.response.iter_content(chunk_size):
+                    writer.write(chunk)
+                    yield chunk
+            except BaseException:
+                # Including the caller giving up on the rest of the body
+                writer.abort()
+                raise
+            ref = writer.commit()
+            logger.info("Saving streamed resource for {} ({} bytes) with "
+                        "exp_seconds: {}".format(self.url, ref.size,
+                                                 self.exp_seconds))
+            data = CachedResponse.from_response(self.response, content=ref)
+            self.cache.create_or_update(self.url, data=data,
+                                        **_expiry(self.exp_seconds))
+        finally:
+            self._closed()
+
+    def iter_content(self, chunk_size: int=CHUNK_SIZE,
+                     decode_unicode: bool=False) -> Iterator:
+        if self._consumed:
+            raise requests.exceptions.StreamConsumedError()
+        self._consumed = True
+        chunks = self._tee(chunk_size or CHUNK_SIZE)
+        if decode_unicode:
+            return stream_decode_response_unicode(chunks, self.response)
+        return chunks
+
+    @property
+    def content(self) -> bytes:
+        """
+        The whole body (read, and cached, on first access).
+        """
+        if self._content is None:
+            self._content = b''.join(self.iter_content())
+        return self._content
+
+    def close(self) -> None:
+        """
+        Close the response (a body which hasn't been read entirely is not
+        cached).
+        """
+        try:
+            self.response.close()
+        finally:
+            self._closed()
+
+    def __getattr__(self, name: str):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.response, name)
+
+
+def _conditional_headers(cached: requests.Response, headers: dict) -> None:
+    """
+    Add the if-none-match and/or if-modified-since headers for revalidating
+    the `cached` response (if it has an etag and/or last-modified header).
+    """
+    etag = cached.headers.get('etag')
+    etag = etag.lstrip('W/') if etag else None  # strip weak etag
+
+    # Ignore -gzip suffix added by Apache mod_deflate
+    # https://bz.apache.org/bugzilla/show_bug.cgi?id=45023
+    etag = re.sub('-gzip"$', '"', etag) if etag else None
+    lastmod = cached.headers.get('last-modified')
+
+    if etag:
+        headers['If-None-Match'] = etag
+    if lastmod:
+        headers['If-Modified-Since'] = lastmod
+
+
+def _revalidated(url: str, fetched: requests.Response,
+                 cached: Optional[requests.Response]) -> requests.Response:
+    """
+    Return the response to cache and return after fetching `url`: a copy of
+    the `cached` one (with the new headers) if the server says it was not
+    modified, and `fetched` otherwise. Raises on HTTP errors.
+    """
+    fetched.raise_for_status()
+    logger.info("Got resource from remote for  {}".format(url))
+    logger.debug("Resource: {}".format(fetched))
+
+    if fetched.status_code == NOT_MODIFIED and cached is not None:
+        # Source says resource is still fresh
+        logger.info("Server says resource is still fresh: {}".format(url))
+        # A copy: the cached response may be shared (eg. by the memory tier,
+        # or with the caller of a stale-while-revalidate cache_get)
+        revalidated = copy.copy(cached)
+        revalidated.headers = fetched.headers
+        return revalidated
+    return fetched
+
+
+def _get(cache, url: str, cached: Optional[requests.Response],
+         headers: dict, get_meth: Callable,
+         **kwargs) -> Tuple[requests.Response, bool]:
+    """
+    Fetch `url` and return the response to cache (see `_revalidated`) and
+    whether it is the `cached` one revalidated, recording the fetch in the
+    cache's `metrics` (if any).
+    """
+    metrics = getattr(cache, 'metrics', None)
+    if metrics is None:
+        fetched = get_meth(url, headers=headers, **kwargs)
+    else:
+        with metrics.timer('fetch'):
+            fetched = get_meth(url, headers=headers, **kwargs)
+    revalidated = cached is not None and fetched.status_code == NOT_MODIFIED
+    fetched = _revalidated(url, fetched, cached)
+    if metrics is not None and cached is not None:
+        metrics.incr('revalidations' if revalidated else 'refetches')
+    return fetched, revalidated
+
+
+def _exp_seconds(cache, response: requests.Response) -> Optional[int]:
+    """
+    The number of seconds to cache `response` for: the time it stays fresh
+    for (see the `freshness` module) or `cache.exp_seconds`, whichever is
+    less (`cache.exp_seconds` if the response has no freshness information).
+    Unlike for `ShelfCache`, 0 means that it is stale right away, and -1 that
+    it never expires (see `_expiry`). Returns None if the response must not
+    be stored.
+    """
+    fresh = Freshness.from_headers(response.headers)
+    if not fresh.storable:
+        return None
+    # An exp_seconds of 0 means no expiry to ShelfCache
+    limit = cache.exp_seconds if cache.exp_seconds > 0 else -1
+    ttl = fresh.ttl
+    if ttl is None:
+        return limit
+    ttl = max(0, int(ttl))
+    if limit < 0:
+        return ttl
+    return min(ttl, limit)
+
+
+def _expiry(exp_seconds: int) -> Dict[str, Any]:
+    """
+    The keyword args to store a response for `exp_seconds` (as returned by
+    `_exp_seconds`) with: a lifetime of 0 is stored as an expiry datetime
+    which has already passed.
+    """
+    if exp_seconds == 0:
+        return {'expire_dt': datetime.utcnow()}
+    return {'exp_seconds': exp_seconds}
+
+
+def _directives(response) -> freshness.Directives:
+    return freshness.parse_cache_control(response.headers.get('cache-control'))
+
+
+def _request_directives(headers: dict) -> freshness.Directives:
+    for name, value in headers.items():
+        if name.lower() == 'cache-control':
+            return freshness.parse_cache_control(value)
+    return {}
+
+
+def _usable(cache: ShelfCache, url: str, item,
+            request: freshness.Directives) -> bool:
+    """
+    Whether the cached `item` can be returned without contacting the origin
+    (see :func:`freshness.acceptable`).
+    """
+    if not request:
+        return not item.expired
+    meta = cache.meta(url)
+    if meta is None:
+        return False
+    now = datetime.utcnow()
+    ttl = None
+    if meta.expire_dt is not None:
+        ttl = (meta.expire_dt - now).total_seconds()
+    age = (now - meta.updated_dt).total_seconds()
+    revalidate = freshness.must_revalidate(_directives(item.data))
+    return freshness.acceptable(ttl, age, request, revalidate)
+
+
+def _serve_stale(cache: ShelfCache, url: str, cached: requests.Response,
+                 always: bool) -> bool:
+    """
+    Whether the stale `cached` response may be returned while it is refreshed
+    in the background: always if `always` and otherwise only within the
+    stale-while-revalidate window it was served with (but never if it must
+    be revalidated).
+    """
+    directives = _directives(cached)
+    if freshness.must_revalidate(directives):
+        return False
+    if always:
+        return True
+    window = freshness.seconds(directives, 'stale-while-revalidate')
+    if window is None:
+        return False
+    ttl = cache.ttl(url)
+    return ttl is not None and -ttl.total_seconds() <= window
+
+
+def _drain(response) -> None:
+    """
+    Read the body of a streamed response nobody will read, to cache it.
+    """
+    if isinstance(response, StreamingResponse):
+        for _ in response.iter_content():
+            pass
+
+
+def _refresh(cache: ShelfCache, url: str, item, headers: dict,
+             get_meth: Callable, single_flight: bool, compact: bool,
+             **kwargs) -> None:
+    try:
+        if not single_flight:
+            _drain(_fetch(cache, url, item, headers, get_meth, compact,
+                          **kwargs))
+            return
+        # Don't wait for other processes: they are refreshing it already
+        with flight_for(cache.db_path).flight(url, 0) as status:
+            if status == LEAD:
+                _drain(_fetch(cache, url, item, headers, get_meth, compact,
+                              **kwargs))
+    except Exception:
+        logger.exception("Background refresh failed: {}".format(url))
+    finally:
+        with _refresh_lock:
+            _refreshing.pop((cache.db_path, url), None)
+
+
+def _shard(cache, key) -> ShelfCache:
+    """
+    Return the `ShelfCache` which stores `key` (with a `ShardedShelfCache`,
+    its shard: the blobs of an item must be in the store of the shard which
+    refers to them, or collecting it would delete them).
+    """
+    if isinstance(cache, ShardedShelfCache):
+        return cache.shard(key)
+    return cache
+
+
+def _schedule_refresh(cache: ShelfCache, url: str, item, headers: dict,
+                      get_meth: Callable, single_flight: bool, compact: bool,
+                      **kwargs) -> Future:
+    """
+    Refresh `url` on the background thread pool, unless it is being refreshed
+    already.
+    """
+    global _refresh_pool
+    key = (cache.db_path, url)
+    with _refresh_lock:
+        future = _refreshing.get(key)
+        if future is not None:
+            return future
+        if _refresh_pool is None:
+            _refresh_pool = ThreadPoolExecutor(
+                REFRESH_WORKERS, thread_name_prefix='shelfcache-refresh')
+        logger.info("Refreshing in the background: {}".format(url))
+        # (_refresh can't forget the future before it is added: it needs the
+        # lock held here)
+        future = _refreshing[key] = _refresh_pool.submit(
+            _refresh, cache, url, item, headers, get_meth, single_flight,
+            compact, **kwargs)
+        return future
+
+
+def wait_for_refreshes(timeout: Optional[float]=None) -> None:
+    """
+    Wait for the background refreshes scheduled by `cache_get` to finish.
+    """
+    with _refresh_lock:
+        futures = list(_refreshing.values())
+    wait(futures, timeout)
+
+
+def _fetch(cache: ShelfCache, url: str, item, headers: dict,
+           get_meth: Callable, compact: bool=False,
+           **kwargs) -> requests.Response:
+    """
+    Fetch `url` from the remote server (revalidating the cached `item`, if
+    any) and store the response in the cache (as a `CachedResponse` if
+    `compact`).
+    """
+    cached = None
+    if item:
+        logger.info("Stale item found in cache: {}".format(url))
+        cached = item.data
+        # Give origin etag and/or last-modified headers (if available) so we
+        # only fetch and parse it if it is new/updated.
+        _conditional_headers(cached, headers)
+    else:
+        logger.info("No item in cache for url: {}".format(url))
+
+    logger.info("Fetching from remote {}".format(url))
+    fetched, revalidated = _get(cache, url, cached, headers, get_meth,
+                                **kwargs)
+
+    # Add to/update cache with new expire_dt
+    # Using max-age parsed from cache-control header, if it exists
+    min_age = _exp_seconds(cache, fetched)
+    if min_age is None:
+        logger.info("Not caching resource (no-store): {}".format(url))
+        return fetched
+    if kwargs.get('stream') and not revalidated:
+        # Cached as the caller reads it
+        return StreamingResponse(fetched, cache, url, min_age)
+    logger.info("Saving resource for {} with exp_seconds: {}"
+                .format(url, min_age))
+    data = CachedResponse.from_response(fetched) if compact else fetched
+    cache.create_or_update(url, data=data, **_expiry(min_age))
+    return fetched
+
 
 def cache_get(cache: ShelfCache, url: str, headers=None,
-              get_meth: Callable=requests.get, **kwargs) -> requests.Response:
+              get_meth: Callable=requests.get, single_flight: bool=False,
+              flight_timeout: float=10.0, stale_while_revalidate: bool=False,
+              compact: bool=False, **kwargs) -> requests.Response:
     """
     A wrapper around `requests.get()` which uses an on-disk cache.
 
@@ -49,9 +427,17 @@ def cache_get(cache: ShelfCache, url: str, headers=None,
     `params` parameter like with `requests.get()`
 
     If the url is in the cache and it is still fresh then it is returned
-    directly. Items are valid for `cache.exp_seconds` or for the max-age
-    specified in the cache-control header returned by the server, whichever
-    is less.
+    directly. Items are valid for `cache.exp_seconds` or for the freshness
+    lifetime of the response returned by the server (from its cache-control
+    max-age, Expires or Last-Modified headers, see the `freshness` module),
+    whichever is less. Responses with a ``no-store`` cache-control directive
+    are not cached, and ``no-cache`` ones are revalidated every time.
+
+    The cache-control directives of the request `headers` are honored too:
+    eg. with ``{'Cache-Control': 'max-stale=3600'}`` an item which expired
+    less than an hour ago is returned without contacting the server (unless
+    the response said ``must-revalidate``), and with ``'min-fresh=60'`` an
+    item which expires within a minute is revalidated.
 
     If the item in the cache has expired, it is re-fetched from the remote
     server (using etag and/or last-modified headers if available so that the
@@ -60,78 +446,249 @@ def cache_get(cache: ShelfCache, url: str, headers=None,
     When the response is received from the server, then the item is updated
     in the on-disk cache.
 
+    With `single_flight`, only one of the callers (threads or processes using
+    the same cache database) which find a url stale or missing at the same
+    time fetches it: the others wait for it to finish (up to
+    `flight_timeout` seconds) and then return what it stored. If the wait
+    times out, they return the stale item (or fetch the url themselves if
+    there is none). See the `flight` module.
+
+    With `stale_while_revalidate`, a stale item is returned at once and
+    refreshed on a pool of `REFRESH_WORKERS` background threads (at most once
+    at a time per url). Responses served with a ``stale-while-revalidate``
+    cache-control directive (RFC 5861) are treated the same way within the
+    window it allows, even without this option. Errors while refreshing are
+    logged, and the stale item is kept.
+
+    With `compact`, responses are cached as `CachedResponse` objects (which
+    only keep the status, url, encoding, body and the main headers) instead
+    of pickling the whole `requests.Response`. The responses returned from the
+    cache are then `CachedResponse` objects too.
+
+    With `stream=True` (which is passed on to `get_meth`), the `cache` must
+    have a `blob_threshold`: a response fetched from the server is returned
+    as a `StreamingResponse`, whose body is written to the cache's blob store
+    as it is read with `iter_content()`, and cached once it has been read
+    entirely. The cached `CachedResponse` then reads it back a chunk at a
+    time. With `single_flight` too, the url's slot is held until the body
+    has been cached (or the response closed), so that the callers waiting
+    for it read it from the cache: read it, or close the response, promptly.
+
     :param cache: The ShelfCache to handle the cache
     :param url: the url of the resource to fetch
     :param get_meth: The method which is called to issue the HTTP get request.
         By default this is requests.get but is injectable mostly for testing
         purposes.
+    :param single_flight: Coalesce concurrent fetches of the same url
+    :param flight_timeout: Seconds to wait for another caller fetching the
+        same url (with `single_flight`). With 0, the stale item is returned
+        at once if somebody else is already fetching it.
+    :param stale_while_revalidate: Return stale items without waiting for
+        them to be refreshed
+    :param compact: Cache `CachedResponse` objects instead of responses
     :pram **kwargs: All keyword args are passed to `requests.get()`
 
     Returns:
         The requested resource. The requests package will raise exceptions
         on network errors.
     """
-    etag = None
-    lastmod = None
     if headers is None: headers = {}
+    if kwargs.get('stream') and not getattr(cache, 'blob_threshold', 0):
+        raise ValueError("stream=True needs a cache with a blob_threshold")
 
     logger.info("Fetching item for url: {}".format(url))
+    request = _request_directives(headers)
     item = cache.get(url)
     if item:
         logger.info("Got resource from cache for url: {}".format(url))
-        cached, expired = item.data, item.expired
-        if not expired:
+        if _usable(cache, url, item, request):
             # If cache is fresh, use it without further ado
             logger.info("Returning fresh item found in cache: {}"
                         .format(url))
-            return cached
+            return item.data
+        if _serve_stale(cache, url, item.data, stale_while_revalidate):
+            logger.info("Returning stale item found in cache: {}".format(url))
+            # (a copy: the refresh adds its conditional headers to it)
+            _schedule_refresh(cache, url, item, dict(headers), get_meth,
+                              single_flight, compact, **kwargs)
+            return item.data
 
-        logger.info("Stale item found in cache: {}".format(url))
-        etag = cached.headers.get('etag')
-        etag = etag.lstrip('W/') if etag else None  # strip weak etag
+    if not single_flight:
+        return _fetch(cache, url, item, headers, get_meth, compact,
+                      **kwargs)
 
-        # Ignore -gzip suffix added by Apache mod_deflate
-        # https://bz.apache.org/bugzilla/show_bug.cgi?id=45023
-        etag = re.sub('-gzip"$', '"', etag) if etag else None
-        lastmod = cached.headers.get('last-modified')
-    else:
-        logger.info("No item in cache for url: {}".format(url))
+    with ExitStack() as stack:
+        status = stack.enter_context(
+            flight_for(cache.db_path).flight(url, flight_timeout))
+        # Somebody else may have fetched it, while we waited or (even if we
+        # lead) just before we got the slot: use what they stored
+        item = cache.get(url) or item
+        if item and (_usable(cache, url, item, request) or
+                     (status == TIMEOUT and not freshness.must_revalidate(
+                         _directives(item.data)))):
+            logger.info("Returning item fetched concurrently ({}): {}"
+                        .format(status, url))
+            return item.data
+        response = _fetch(cache, url, item, headers, get_meth, compact,
+                          **kwargs)
+        if isinstance(response, StreamingResponse):
+            # Only cached once read: hold the slot until then
+            response.on_close = stack.pop_all().close
+        return response
+
+
+def _fetch_one(cache, url: str, item, headers: dict, get_meth: Callable,
+               compact: bool, **kwargs) -> Tuple[Any, Any, Optional[int]]:
+    """
+    Fetch `url` (revalidating the cached `item`, if any) without storing it.
 
-    # Cache wasn't fresh in db, so we'll request it, but give origin etag
-    # and/or last-modified headers (if available) so we only fetch and
-    # parse it if it is new/updated.
+    Returns:
+        The response to return, the data to cache and its exp_seconds (None
+        if it must not be stored)
+    """
+    cached = None
+    if item:
+        cached = item.data
+        _conditional_headers(cached, headers)
     logger.info("Fetching from remote {}".format(url))
+    fetched, _ = _get(cache, url, cached, headers, get_meth, **kwargs)
+    data = CachedResponse.from_response(fetched) if compact else fetched
+    return fetched, data, _exp_seconds(cache, fetched)
 
-    # Add if-none-match and/or if-modified-since headers
-    if etag:
-        headers['If-None-Match'] = etag
-    if lastmod:
-        headers['If-Modified-Since'] = lastmod
 
-    fetched = get_meth(url, headers=headers, **kwargs)
-    fetched.raise_for_status()
-    logger.info("Got resource from remote for  {}".format(url))
-    logger.debug("Resource: {}".format(fetched))
+def _store_batch(cache, batch: Dict[int, List[Tuple[str, Any]]]) -> None:
+    """
+    Write the fetched responses in `batch` (grouped by exp_seconds) to the
+    cache, with one `set_many` per group.
+    """
+    for exp_seconds, items in batch.items():
+        logger.info("Saving {} resources with exp_seconds: {}"
+                    .format(len(items), exp_seconds))
+        cache.set_many(items, **_expiry(exp_seconds))
+    batch.clear()
 
-    if fetched.status_code == NOT_MODIFIED:
-        # Source says resource is still fresh
-        logger.info("Server says resource is still fresh: {}".format(url))
-        new_headers = fetched.headers
-        fetched = cached
-        fetched.headers = new_headers
 
-    # Add to/update cache with new expire_dt
-    # Using max-age parsed from cache-control header, if it exists
-    cc_header = fetched.headers.get('cache-control') or ''
-    ma_match = re.search('max-age=(\d+)', cc_header)
-    if ma_match:
-        if cache.exp_seconds < 0:
-            min_age = int(ma_match.group(1))
+def cache_get_many(cache: ShelfCache, urls: Iterable[str], headers=None,
+                   get_meth: Callable=requests.get, max_workers: int=8,
+                   per_host_limit: Optional[int]=2, batch_size: int=100,
+                   flush_interval: float=1.0, compact: bool=False,
+                   **kwargs) -> Iterator[Tuple[str, Union[requests.Response,
+                                                          Exception]]]:
+    """
+    Like `cache_get` for many urls at once, yielding a (url, response) pair
+    for each of them as soon as it is available:
+
+        >>> for url, response in cache_get_many(cache, urls):
+        >>>     if isinstance(response, Exception):
+        >>>         ...
+
+    The cached items of all the `urls` are read with one `get_many`, and the
+    fresh ones are yielded first. The others are fetched (and revalidated)
+    on a pool of `max_workers` threads, with at most `per_host_limit` requests
+    to the same host at a time (None for no limit), taking turns between the
+    hosts. They are yielded in the order they complete, and written to the
+    cache in batches: after `batch_size` responses, when none completes for
+    `flush_interval` seconds, and once the generator is exhausted or closed.
+
+    An exception raised while fetching a url (eg. by `raise_for_status()`) is
+    yielded in place of its response, so that one failing url does not stop
+    the others.
+
+    Urls are yielded once, even if they are given several times. Neither
+    `stream=True` nor the `single_flight` and `stale_while_revalidate`
+    options of `cache_get` are supported.
+
+    :param cache: The ShelfCache (or ShardedShelfCache) to use
+    :param urls: The urls of the resources to fetch
+    :param headers: The headers sent with every request
+    :param get_meth: The method which issues the HTTP get requests (it is
+        called from several threads at once, eg. `CachedSession.session.get`)
+    :param max_workers: The maximum number of requests in flight
+    :param per_host_limit: The maximum number of requests in flight to a host
+    :param batch_size: The number of responses written to the cache at once
+    :param flush_interval: The number of seconds fetched responses may wait
+        for the rest of their batch
+    :param compact: Cache `CachedResponse` objects instead of responses
+    :param **kwargs: All keyword args are passed to `get_meth`
+    """
+    if headers is None: headers = {}
+    if kwargs.get('stream'):
+        raise ValueError("cache_get_many does not support stream=True")
+    urls = list(dict.fromkeys(urls))
+    request = _request_directives(headers)
+    items = cache.get_many(urls)
+
+    # Hosts with urls to fetch and room for another request, in turn
+    queues = {}  # type: Dict[str, Deque[str]]
+    for url in urls:
+        item = items.get(url)
+        if item and _usable(cache, url, item, request):
+            logger.info("Returning fresh item found in cache: {}"
+                        .format(url))
+            yield url, item.data
         else:
-            min_age = min(int(ma_match.group(1)), cache.exp_seconds)
-    else:
-        min_age = cache.exp_seconds
-    logger.info("Saving resource for {} with exp_seconds: {}"
-                .format(url, min_age))
-    cache.create_or_update(url, data=fetched, exp_seconds=min_age)
-    return fetched
+            queues.setdefault(urlsplit(url).netloc, deque()).append(url)
+    if not queues:
+        return
+    ready = deque(queues)  # type: Deque[str]
+    in_flight = dict.fromkeys(queues, 0)  # type: Dict[str, int]
+    limit = per_host_limit or len(urls)
+
+    executor = ThreadPoolExecutor(max_workers,
+                                  thread_name_prefix='shelfcache-fetch')
+    futures = {}  # type: Dict[Future, Tuple[str, str]]
+    batch = {}  # type: Dict[int, List[Tuple[str, Any]]]
+    pending = 0
+
+    def submit() -> None:
+        while ready and len(futures) < max_workers:
+            host = ready.popleft()
+            url = queues[host].popleft()
+            futures[executor.submit(_fetch_one, cache, url, items.get(url),
+                                    dict(headers), get_meth, compact,
+                                    **kwargs)] = (host, url)
+            in_flight[host] += 1
+            if queues[host] and in_flight[host] < limit:
+                ready.append(host)
+
+    try:
+        submit()
+        while futures:
+            done = wait(futures, flush_interval,
+                        return_when=FIRST_COMPLETED)[0]
+            if not done:
+                _store_batch(cache, batch)
+                pending = 0
+                continue
+            completed = []
+            for future in done:
+                host, url = futures.pop(future)
+                # The host had no turn if it was at its limit
+                if queues[host] and in_flight[host] == limit:
+                    ready.append(host)
+                in_flight[host] -= 1
+                completed.append((url, future))
+            # Keep the pool busy while the caller handles these
+            submit()
+            for url, future in completed:
+                try:
+                    response, data, exp_seconds = future.result()
+                except Exception as e:
+                    logger.warning("Fetching {} failed: {}".format(url, e))
+                    yield url, e
+                    continue
+                if exp_seconds is None:
+                    logger.info("Not caching resource (no-store): {}"
+                                .format(url))
+                else:
+                    batch.setdefault(exp_seconds, []).append((url, data))
+                    pending += 1
+                yield url, response
+            if pending >= batch_size:
+                _store_batch(cache, batch)
+                pending = 0
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        _store_batch(cache, batch)
@@ -0,0 +1,158 @@
+"""
+Per-key "single-flight" coordination, so that when a popular cached resource
+expires only one caller (across all the threads and processes using the same
+cache database) fetches it again while the others wait for its result.
+
+Keys are hashed to one of a fixed number of slots. Each slot is guarded by a
+`threading.Lock` within the process and by a POSIX record lock
+(`fcntl.lockf`) on one byte of `<db_path>.flight` across processes. (Record
+locks are owned by the process, which is why the threads of a process
+coordinate among themselves first.) Since record locks can't be waited for
+with a timeout, a process waiting for another one polls.
+
+    >>> with flight_for(cache.db_path).flight(key, timeout=10) as status:
+    >>>     if status == WAITED:
+    >>>         ...  # somebody else probably did the work: check again
+    >>>     elif status == TIMEOUT:
+    >>>         ...  # gave up waiting (the slot is not held)
+    >>>     else:
+    >>>         ...  # LEAD: do the work
+
+The locks of a process are released if it dies, so a crashed leader never
+blocks the others for longer than it lived.
+"""
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+import threading
+import fcntl
+import time
+import zlib
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+LEAD = 'lead'
+"""The slot was free: the caller leads."""
+
+WAITED = 'waited'
+"""The slot was acquired after waiting for another leader to finish."""
+
+TIMEOUT = 'timeout'
+"""The slot could not be acquired in time (and is not held)."""
+
+_POLL_MIN = 0.005
+_POLL_MAX = 0.1
+
+
+class SingleFlight:
+    """
+    The single-flight slots of one cache database.
+    """
+
+    def __init__(self, db_path: str, slots: int=4096) -> None:
+        """
+        :param db_path: Path to the cache database (the lock file is kept
+            next to it)
+        :param slots: The number of slots keys are hashed to
+        """
+        self.path = db_path + '.flight'
+        self.slots = slots
+        self._fd = None  # type: Optional[int]
+        self._pid = os.getpid()
+        self._mutex = threading.Lock()
+        self._locks = {}  # type: Dict[int, threading.Lock]
+
+    def _slot(self, key: str) -> int:
+        return zlib.crc32(key.encode('utf-8')) % self.slots
+
+    def _thread_lock(self, slot: int) -> threading.Lock:
+        with self._mutex:
+            if self._pid != os.getpid():
+                # Forked: the locks (and the fd's record locks) belong to
+                # the parent
+                self._pid = os.getpid()
+                self._locks = {}
+                self._fd = None
+            lock = self._locks.get(slot)
+            if lock is None:
+                lock = self._locks[slot] = threading.Lock()
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            return lock
+
+    def _try_lockf(self, slot: int) -> bool:
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+            return True
+        except (BlockingIOError, PermissionError):
+            return False
+
+    def acquire(self, key: str, timeout: float) -> str:
+        """
+        Acquire the slot of `key`, waiting up to `timeout` seconds for
+        other threads and processes to release it.
+
+        Returns:
+            LEAD, WAITED or TIMEOUT (in which case the slot must not be
+            released)
+        """
+        slot = self._slot(key)
+        lock = self._thread_lock(slot)
+        deadline = time.monotonic() + timeout
+        status = LEAD
+        if not lock.acquire(blocking=False):
+            status = WAITED
+            if timeout <= 0 or not lock.acquire(timeout=timeout):
+                return TIMEOUT
+        delay = _POLL_MIN
+        while not self._try_lockf(slot):
+            status = WAITED
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                lock.release()
+                return TIMEOUT
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, _POLL_MAX)
+        logger.debug("Acquired flight for {} ({})".format(key, status))
+        return status
+
+    def release(self, key: str) -> None:
+        slot = self._slot(key)
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, slot)
+        self._locks[slot].release()
+
+    @contextmanager
+    def flight(self, key: str, timeout: float) -> Iterator[str]:
+        """
+        Hold the slot of `key` (if it could be acquired) for the duration of
+        a `with` block, yielding the status returned by :meth:`acquire`.
+        """
+        status = self.acquire(key, timeout)
+        try:
+            yield status
+        finally:
+            if status != TIMEOUT:
+                self.release(key)
+
+    def close(self) -> None:
+        with self._mutex:
+            if self._fd is not None and self._pid == os.getpid():
+                os.close(self._fd)
+            self._fd = None
+
+
+_flights = {}  # type: Dict[str, SingleFlight]
+_flights_mutex = threading.Lock()
+
+
+def flight_for(db_path: str) -> SingleFlight:
+    """
+    Return the `SingleFlight` of this process for the database `db_path`.
+    """
+    path = os.path.abspath(db_path)
+    with _flights_mutex:
+        flight = _flights.get(path)
+        if flight is None:
+            flight = _flights[path] = SingleFlight(path)
+        return flight
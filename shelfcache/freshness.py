@@ -0,0 +1,211 @@
+"""
+HTTP freshness calculations (RFC 7234, section 4.2) used by `cache_get`.
+
+The freshness lifetime of a response is given by (in order of precedence) its
+``s-maxage`` (for shared caches only) or ``max-age`` cache-control directives,
+or its ``Expires`` header (relative to its ``Date``). Failing those, a
+heuristic lifetime of a fraction (`HEURISTIC_FRACTION`) of the time since its
+``Last-Modified`` date is used, up to `MAX_HEURISTIC` seconds. The time it
+stays fresh in the cache is its lifetime minus its current age (from its
+``Age`` and ``Date`` headers):
+
+    >>> Freshness.from_headers(response.headers).ttl
+    3540.0
+
+``no-cache`` responses are stale as soon as they are stored, ``no-store``
+responses are not stored, and neither they nor ``must-revalidate`` responses
+are ever served stale.
+
+The request side directives ``max-age``, ``min-fresh``, ``max-stale`` and
+``no-cache`` (see :func:`acceptable`) let callers ask for fresher responses,
+or accept staler ones.
+"""
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Mapping, Optional
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+HEURISTIC_FRACTION = 0.1
+"""The fraction of the time since a response was last modified it is assumed
+to stay fresh for, if it has no explicit lifetime."""
+
+MAX_HEURISTIC = 24 * 3600
+"""The maximum heuristic freshness lifetime (seconds)."""
+
+Directives = Dict[str, Optional[str]]
+
+_DIRECTIVE = re.compile(r'([^\s,=]+)(?:\s*=\s*("[^"]*"|[^\s,]*))?')
+
+
+def parse_cache_control(value: Optional[str]) -> Directives:
+    """
+    Parse a cache-control header into a dict of its (lower-cased) directives
+    and their values (None for the directives without a value).
+    """
+    directives = {}  # type: Directives
+    for match in _DIRECTIVE.finditer(value or ''):
+        arg = match.group(2)
+        if arg is not None:
+            arg = arg.strip('"')
+        directives[match.group(1).lower()] = arg
+    return directives
+
+
+def seconds(directives: Directives, name: str) -> Optional[int]:
+    """
+    The value of a delta-seconds directive (None if it is missing or
+    invalid).
+    """
+    try:
+        return max(0, int(directives[name]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime]:
+    """
+    Parse an HTTP date into a naive UTC datetime (None if it is invalid).
+    """
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if dt is None:
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+class Freshness:
+    """
+    The freshness information of a response.
+
+    :ivar lifetime: The freshness lifetime in seconds (None if the response
+        gives no information)
+    :ivar age: The current age of the response in seconds
+    :ivar heuristic: Whether `lifetime` is heuristic
+    :ivar directives: The response's cache-control directives
+    """
+
+    def __init__(self, lifetime: Optional[float], age: float,
+                 directives: Directives, heuristic: bool=False) -> None:
+        self.lifetime = lifetime
+        self.age = age
+        self.directives = directives
+        self.heuristic = heuristic
+
+    @classmethod
+    def from_headers(cls, headers: Mapping, now: Optional[datetime]=None,
+                     shared: bool=False) -> 'Freshness':
+        """
+        :param headers: The response's headers (a case-insensitive mapping)
+        :param now: When the response was received (defaults to now)
+        :param shared: Whether the cache is shared (so that ``s-maxage`` and
+            ``proxy-revalidate`` apply)
+        """
+        if now is None:
+            now = datetime.utcnow()
+        date = parse_date(headers.get('date'))
+        age = 0.0
+        if date is not None:
+            age = max(0.0, (now - date).total_seconds())
+        try:
+            age = max(age, float(headers.get('age')))
+        except (TypeError, ValueError):
+            pass
+        expires = headers.get('expires')
+        last_modified = parse_date(headers.get('last-modified'))
+        directives = parse_cache_control(headers.get('cache-control'))
+
+        if shared and 'proxy-revalidate' in directives:
+            directives.setdefault('must-revalidate', None)
+        if 'no-cache' in directives:
+            return cls(0, age, directives)
+        lifetime = seconds(directives, 's-maxage') if shared else None
+        if lifetime is None:
+            lifetime = seconds(directives, 'max-age')
+        if lifetime is None and expires is not None:
+            expires_dt = parse_date(expires)
+            # An invalid date (eg. "0") means already expired
+            lifetime = 0
+            if expires_dt is not None:
+                lifetime = max(0, ((expires_dt - (date or now))
+                                   .total_seconds()))
+        if lifetime is not None:
+            return cls(lifetime, age, directives)
+        if last_modified is not None:
+            since = ((date or now) - last_modified).total_seconds()
+            if since > 0:
+                lifetime = min(since * HEURISTIC_FRACTION, MAX_HEURISTIC)
+                return cls(lifetime, age, directives, heuristic=True)
+        return cls(None, age, directives)
+
+    @property
+    def ttl(self) -> Optional[float]:
+        """
+        The number of seconds the response stays fresh for (negative if it is
+        already stale, None if unknown).
+        """
+        if self.lifetime is None:
+            return None
+        return self.lifetime - self.age
+
+    @property
+    def storable(self) -> bool:
+        return 'no-store' not in self.directives
+
+    @property
+    def must_revalidate(self) -> bool:
+        """
+        Whether the response may never be used once stale.
+        """
+        return must_revalidate(self.directives)
+
+
+def must_revalidate(directives: Directives) -> bool:
+    """
+    Whether a response with these cache-control `directives` may never be
+    used without revalidation once stale.
+    """
+    return ('must-revalidate' in directives or 'no-cache' in directives or
+            'no-store' in directives)
+
+
+def acceptable(ttl: Optional[float], age: float, request: Directives,
+               revalidate: bool=False) -> bool:
+    """
+    Whether a cached response can be used without contacting the origin,
+    given the cache-control directives of the request.
+
+    :param ttl: The number of seconds the cached response stays fresh for
+        (negative if it is stale, None if it never expires)
+    :param age: The age of the cached response in seconds
+    :param request: The directives of the request: ``no-cache`` always
+        revalidates, ``max-age`` sets the maximum age, ``min-fresh`` how long
+        the response must still be fresh for, and ``max-stale`` how long (any
+        time if it has no value) it may have been stale for
+    :param revalidate: Whether the response forbids being used stale (see
+        :func:`must_revalidate`)
+    """
+    if 'no-cache' in request:
+        return False
+    max_age = seconds(request, 'max-age')
+    if max_age is not None and age > max_age:
+        return False
+    if ttl is None:
+        return True
+    min_fresh = seconds(request, 'min-fresh')
+    if min_fresh is not None:
+        return ttl >= min_fresh
+    if ttl >= 0:
+        return True
+    if 'max-stale' not in request or revalidate:
+        return False
+    max_stale = seconds(request, 'max-stale')
+    return max_stale is None or -ttl <= max_stale
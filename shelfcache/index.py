@@ -0,0 +1,383 @@
+"""
+A compact sidecar index (stored in `<db_path>.idx`) of the metadata of every
+item in a `ShelfCache` database: its created, updated and expiry timestamps,
+its size on disk, and when and how often it was last used (which drive the
+eviction policies of a size-bounded cache).
+
+The metadata is held in memory in parallel `array` columns, so questions like
+"which items have expired?" or "how many bytes does the cache use?" are
+answered by a single scan over a few arrays of floats instead of by iterating
+over the shelf and unpickling every cached item.
+
+On disk the index is an append-only journal of fixed-size records, written by
+the process holding the database's exclusive lock. Other processes bring
+their in-memory copy up to date (while holding the database lock) by reading
+only the records appended since they last looked (readers may also append
+access records while holding a shared lock); when the journal is
+rewritten (see :meth:`MetaIndex.compact`) its inode changes and they reload it
+from scratch.
+
+Like the `Generation` counter, the journal is only appended to if the file
+exists, so enabling the index in one process (`ShelfCache(index=True)`) is
+enough for every `ShelfCache` writing to the same database to maintain it.
+"""
+from .record import ItemMeta, to_timestamp, from_timestamp
+from array import array
+from datetime import datetime
+from itertools import compress
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+import heapq
+import math
+import os
+import struct
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+_COLUMNS = {'created_dt': 'created', 'updated_dt': 'updated',
+            'expire_dt': 'expire'}
+
+_PUT = b'P'  # an item was written (which counts as an access)
+_DELETE = b'D'
+_ACCESS = b'A'  # an item was read `hits` times (at `atime` at the latest)
+_RESTORE = b'R'  # every field of an item (written by compaction)
+_RECORD = struct.Struct('<cxxxIddddqQQ')  # op, key length, created, updated,
+#                                           expire, atime, size, version,
+#                                           hits (followed by the key)
+
+POLICIES = ('lru', 'lfu', 'ttl')
+
+
+class MetaIndex:
+    """
+    The in-memory view of the index journal for one database. All methods
+    must be called while holding the database lock (shared for the queries,
+    exclusive for the modifications). The view itself is protected by a mutex
+    so that it can be shared by threads holding a shared lock.
+    """
+
+    def __init__(self, db_path: str) -> None:
+        """
+        :param db_path: Path to the cache database (the index is kept next to
+            it)
+        """
+        self.path = db_path + '.idx'
+        self._fd = None  # type: Optional[int]
+        self._ino = None  # type: Optional[int]
+        self._offset = 0
+        self._records = 0
+        self.lock = threading.RLock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self.keys = []  # type: List[Optional[str]]
+        self.created = array('d')
+        self.updated = array('d')
+        self.expire = array('d')
+        self.size = array('q')
+        self.version = array('Q')
+        self.atime = array('d')
+        self.hits = array('Q')
+        self.nbytes = 0
+        self._rows = {}  # type: Dict[str, int]
+        self._free = []  # type: List[int]
+        self._offset = 0
+        self._records = 0
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, key) -> bool:
+        return key in self._rows
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    # Journal
+
+    @staticmethod
+    def _pack(op: bytes, key: str, created: float=math.nan,
+              updated: float=math.nan, expire: float=math.nan,
+              atime: float=math.nan, size: int=0, version: int=0,
+              hits: int=0) -> bytes:
+        bkey = key.encode('utf-8')
+        return _RECORD.pack(op, len(bkey), created, updated, expire, atime,
+                            size, version, hits) + bkey
+
+    def _append(self, record: bytes) -> None:
+        try:
+            if self._fd is None or (os.fstat(self._fd).st_ino !=
+                                    os.stat(self.path).st_ino):
+                # (re)open: the journal may have been compacted by somebody
+                self._close_fd()
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            self._close_fd()
+            return
+        os.write(self._fd, record)
+
+    def _close_fd(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def put(self, key: str, created_dt: datetime, updated_dt: datetime,
+            expire_dt: Optional[datetime], size: int, version: int=0) -> None:
+        """
+        Record the metadata of an item which was just written.
+        """
+        self._append(self._pack(_PUT, key, to_timestamp(created_dt),
+                                to_timestamp(updated_dt),
+                                to_timestamp(expire_dt), size=size,
+                                version=version))
+
+    def delete(self, key: str) -> None:
+        """
+        Record the deletion of an item.
+        """
+        self._append(self._pack(_DELETE, key))
+
+    def access(self, hits: Mapping[str, int], when: datetime) -> None:
+        """
+        Record that items were read (`hits` maps their keys to the number of
+        times they were read, the last time being `when`). May be called
+        while holding a shared lock.
+        """
+        ts = to_timestamp(when)
+        self._append(b''.join(self._pack(_ACCESS, key, atime=ts, hits=n)
+                              for key, n in hits.items()))
+
+    def _apply(self, data: bytes) -> int:
+        pos = 0
+        while pos + _RECORD.size <= len(data):
+            op, klen, created, updated, expire, atime, size, version, hits = \
+                _RECORD.unpack_from(data, pos)
+            end = pos + _RECORD.size + klen
+            if end > len(data):
+                break  # incomplete record (being written or torn)
+            key = data[pos + _RECORD.size:end].decode('utf-8')
+            if op == _PUT:
+                row = self._set(key, created, updated, expire, size, version)
+                self.atime[row] = updated
+                self.hits[row] += 1
+            elif op == _ACCESS:
+                row = self._rows.get(key)
+                if row is not None:
+                    self.atime[row] = max(self.atime[row], atime)
+                    self.hits[row] += hits
+            elif op == _RESTORE:
+                row = self._set(key, created, updated, expire, size, version)
+                self.atime[row] = atime
+                self.hits[row] = hits
+            else:
+                self._remove(key)
+            self._records += 1
+            pos = end
+        return pos
+
+    def _set(self, key: str, created: float, updated: float, expire: float,
+             size: int, version: int) -> int:
+        row = self._rows.get(key)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+                self.keys[row] = key
+            else:
+                row = len(self.keys)
+                self.keys.append(key)
+                self.created.append(0)
+                self.updated.append(0)
+                self.expire.append(0)
+                self.size.append(0)
+                self.version.append(0)
+                self.atime.append(0)
+                self.hits.append(0)
+            self._rows[key] = row
+        self.nbytes += size - self.size[row]
+        self.created[row] = created
+        self.updated[row] = updated
+        self.expire[row] = expire
+        self.size[row] = size
+        self.version[row] = version
+        return row
+
+    def _remove(self, key: str) -> None:
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        # NaN never compares smaller than anything, so free rows are
+        # skipped by the scans
+        self.keys[row] = None
+        self.nbytes -= self.size[row]
+        self.created[row] = self.updated[row] = self.expire[row] = math.nan
+        self.atime[row] = math.nan
+        self.size[row] = self.version[row] = self.hits[row] = 0
+        self._free.append(row)
+
+    def refresh(self) -> bool:
+        """
+        Bring the in-memory view up to date with the journal.
+
+        Returns:
+            False if the index does not exist.
+        """
+        with self.lock:
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                self._reset()
+                self._ino = None
+                return False
+            if st.st_ino != self._ino or st.st_size < self._offset:
+                self._reset()
+                self._ino = st.st_ino
+            if st.st_size > self._offset:
+                with open(self.path, 'rb') as f:
+                    f.seek(self._offset)
+                    data = f.read(st.st_size - self._offset)
+                self._offset += self._apply(data)
+            return True
+
+    def rebuild(self, entries: Iterable[Tuple[str, datetime, datetime,
+                                              Optional[datetime], int, int]]
+                ) -> None:
+        """
+        Replace the journal with one describing `entries` (key, created_dt,
+        updated_dt, expire_dt, size, version), creating it if it does not
+        exist.
+        """
+        self._rewrite(self._pack(_PUT, key, to_timestamp(created),
+                                 to_timestamp(updated), to_timestamp(expire),
+                                 size=size, version=version)
+                      for key, created, updated, expire, size, version
+                      in entries)
+        logger.info("Rebuilt index {}".format(self.path))
+
+    def _rewrite(self, records: Iterable[bytes]) -> None:
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            for rec in records:
+                f.write(rec)
+        os.replace(tmp, self.path)
+        self._close_fd()
+
+    def compact(self, force: bool=False) -> bool:
+        """
+        Rewrite the journal with a single record per live item if it has
+        accumulated many superseded records (or if `force` is set). Requires
+        an up to date view (see :meth:`refresh`).
+
+        Returns:
+            True if the journal was rewritten.
+        """
+        with self.lock:
+            if not force and self._records < 2 * len(self._rows) + 1024:
+                return False
+            self._rewrite(self._pack(_RESTORE, key, self.created[row],
+                                     self.updated[row], self.expire[row],
+                                     self.atime[row], self.size[row],
+                                     self.version[row], self.hits[row])
+                          for key, row in self._rows.items())
+            logger.info("Compacted index {}".format(self.path))
+            self.refresh()
+            return True
+
+    def clear(self) -> None:
+        """
+        Empty the index (if it exists).
+        """
+        if self.exists():
+            self.rebuild([])
+
+    def close(self) -> None:
+        self._close_fd()
+
+    # Queries
+
+    def entry(self, key: str) -> Optional[ItemMeta]:
+        """
+        Return the metadata recorded for `key` (or None).
+        """
+        with self.lock:
+            row = self._rows.get(key)
+            if row is None:
+                return None
+            return self._entry(row)
+
+    def _entry(self, row: int) -> ItemMeta:
+        return ItemMeta(from_timestamp(self.created[row]),
+                        from_timestamp(self.updated[row]),
+                        from_timestamp(self.expire[row]),
+                        self.size[row], self.version[row])
+
+    def entries(self) -> List[Tuple[str, datetime, datetime,
+                                    Optional[datetime], int, int]]:
+        with self.lock:
+            return [(key,) + tuple(self._entry(row))
+                    for key, row in self._rows.items()]
+
+    def before(self, field: str, dt: datetime) -> List[str]:
+        """
+        Return the keys whose `field` ('created_dt', 'updated_dt' or
+        'expire_dt') is before `dt`.
+        """
+        ts = to_timestamp(dt)
+        with self.lock:
+            column = getattr(self, _COLUMNS[field])
+            return list(compress(self.keys, map(ts.__gt__, column)))
+
+    def between(self, field: str, start: datetime, end: datetime) -> List[str]:
+        """
+        Return the keys whose `field` is in [start, end).
+        """
+        lo, hi = to_timestamp(start), to_timestamp(end)
+        with self.lock:
+            column = getattr(self, _COLUMNS[field])
+            return list(compress(self.keys,
+                                 (lo <= ts < hi for ts in column)))
+
+    def total_size(self) -> int:
+        return self.nbytes
+
+    def victims(self, policy: str, count: int=0, nbytes: int=0,
+                keep: Iterable[str]=()) -> List[str]:
+        """
+        Choose the items to evict to free at least `count` items and `nbytes`
+        bytes, in the order given by `policy`:
+
+        - 'lru': the least recently used (read or written) first
+        - 'lfu': the least frequently used first (and the least recently used
+          of those)
+        - 'ttl': the first to expire first (items which never expire last)
+
+        Items whose key is in `keep` are only chosen if there is no other
+        way to free enough space.
+        """
+        if policy not in POLICIES:
+            raise ValueError("Unknown eviction policy: {}".format(policy))
+        keep = set(keep)
+        with self.lock:
+            atime, expire = self.atime, self.expire
+            if policy == 'lru':
+                order = [(key in keep, atime[row], row)
+                         for key, row in self._rows.items()]
+            elif policy == 'lfu':
+                hits = self.hits
+                order = [(key in keep, hits[row], atime[row], row)
+                         for key, row in self._rows.items()]
+            else:
+                updated = self.updated
+                order = [(key in keep, expire[row], updated[row], row)
+                         for key, row in self._rows.items()]
+            if not nbytes:
+                return [self.keys[entry[-1]]
+                        for entry in heapq.nsmallest(count, order)]
+            heapq.heapify(order)
+            chosen = []
+            while order and (count > 0 or nbytes > 0):
+                row = heapq.heappop(order)[-1]
+                chosen.append(self.keys[row])
+                count -= 1
+                nbytes -= self.size[row]
+            return chosen
@@ -35,12 +35,17 @@ synchronize access between threads and/or processes:
 * `RWShelf`: uses the OS's `flock` mechanism to provide a shared-exclusive
     lock around shelve a shelve object (works for both threads and processes).
 
-* TODO: A more portable solution than RWShelf would be to implement a
-    reader-writer lock in Python. The Standard library does not include one, but
-    there are several implementations available on the web. (The only
-    disadvantage compared to the system-level flock is that it would only
-    synchronize the python program -- but most shelve/dbm databases don't need
-    to be read from several programs at once, anyway)
+* `ShelfHandle`: a long-lived handle which uses the same flock protocol as
+    `RWShelf`, but keeps the lock file descriptor and the shelve object open
+    across acquisitions (see :class:`ShelfHandle`).
+
+* `RWLockShelf`: a more portable alternative to RWShelf which synchronizes
+    threads with a reader-writer lock implemented in Python (`RWLock`). On its
+    own it only synchronizes the threads of one process (but most shelve/dbm
+    databases don't need to be read from several programs at once, anyway);
+    with `use_flock=True` it also takes the same flock as `RWShelf`, so that
+    processes stay synchronized while readers in the same process never wait
+    for each other.
 
 .. _shelve: https://docs.python.org/3/library/shelve.html
 
@@ -53,13 +58,131 @@ import fcntl
 from fcntl import flock
 from typing import Union
 import dbm
+import dbm.dumb
 import abc
+import os
 import os.path
+import struct
+import tempfile
+import weakref
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
 
 logger = logging.getLogger(__name__)
 lock_t = Union[threading.Lock, multiprocessing.Lock]
 
 
+def db_file(filename: str) -> str:
+    """
+    Return the path of the file actually created by dbm for `filename`.
+
+    Some implementations of dbm add the .db suffix, some don't, and dbm.dumb
+    stores its data in a .dat file. If none of them exist, the .db name is
+    returned (so that opening it raises FileNotFoundError).
+    """
+    for created_name in (filename, filename + ".db", filename + ".dat"):
+        if os.path.exists(created_name):
+            return created_name
+    return filename + ".db"
+
+
+def create_db(filename: str) -> None:
+    """
+    Create the database `filename` if it doesn't exist yet.
+
+    It can't be locked before it exists, and a dbm implementation opening a
+    file which another process is still initializing may initialize it again
+    (wiping out what was written to it meanwhile). So the database is created
+    in a temporary directory and its files are then hard-linked into place,
+    never replacing files somebody else linked first.
+    """
+    if os.path.exists(db_file(filename)):
+        return
+    directory, name = os.path.split(os.path.abspath(filename))
+    with tempfile.TemporaryDirectory(prefix='.' + name,
+                                     dir=directory) as tmpdir:
+        tmp = os.path.join(tmpdir, name)
+        with shelve.open(tmp, 'c'):
+            pass
+        created = db_file(tmp)
+        # The file found by db_file() goes last, once the others are there
+        paths = sorted((os.path.join(tmpdir, entry)
+                        for entry in os.listdir(tmpdir)),
+                       key=lambda path: path == created)
+        for path in paths:
+            try:
+                os.link(path, os.path.join(directory, os.path.basename(path)))
+            except FileExistsError:
+                pass
+
+
+class Generation:
+    """
+    A tiny on-disk counter (stored in `<filename>.gen`) which every writer
+    bumps before releasing its exclusive lock. Processes which keep state
+    derived from the database (a persistent dbm handle, an in-memory cache)
+    compare it against the value they last saw to find out whether anybody
+    else has written since.
+
+    The file is only created by processes which need it (see :meth:`create`);
+    until then :meth:`bump` is a no-op, so plain readers and writers pay no
+    more than a failed `open()`.
+    """
+    _counter = struct.Struct('<Q')
+
+    def __init__(self, filename: str) -> None:
+        """
+        :param filename: path to the shelve database file (the counter is kept
+            next to it)
+        """
+        self.path = filename + '.gen'
+        self._fd = None  # type: Optional[int]
+
+    def _open(self, create: bool=False) -> Optional[int]:
+        if self._fd is None:
+            flags = os.O_RDWR | (os.O_CREAT if create else 0)
+            try:
+                self._fd = os.open(self.path, flags, 0o644)
+            except FileNotFoundError:
+                return None
+        return self._fd
+
+    def create(self) -> None:
+        """
+        Create the counter file if it does not exist yet.
+        """
+        self._open(create=True)
+
+    def read(self) -> int:
+        """
+        Return the current value of the counter (0 if it does not exist).
+        """
+        fd = self._open()
+        if fd is None:
+            return 0
+        data = os.pread(fd, self._counter.size, 0)
+        if len(data) < self._counter.size:
+            return 0
+        return self._counter.unpack(data)[0]
+
+    def bump(self) -> int:
+        """
+        Increment the counter and return its new value. Must be called while
+        holding the exclusive lock on the database.
+        """
+        fd = self._open()
+        if fd is None:
+            return 0
+        value = self.read() + 1
+        os.pwrite(fd, self._counter.pack(value), 0)
+        return value
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
 class LockedShelf(metaclass=abc.ABCMeta):
     """
     Abstract base class for LockedShelf implementations.
@@ -108,6 +231,8 @@ class MutexShelf(LockedShelf):
         self.lock = lock
         self.lock.acquire()
         logger.debug("Acquired lock for {}".format(filename))
+        self.filename = filename
+        self.flag = flag
         self.shelf = shelve.open(filename, flag)
 
     def close(self) -> None:
@@ -115,6 +240,10 @@ class MutexShelf(LockedShelf):
         Closes shelf and releases lock.
         """
         self.shelf.close()
+        if self.flag != 'r':
+            gen = Generation(self.filename)
+            gen.bump()
+            gen.close()
         self.lock.release()
         logger.debug("Released lock for shelf")
 
@@ -166,25 +295,13 @@ class RWShelf(LockedShelf):
         else:
             ltype = fcntl.LOCK_EX
             # Create file if it doesn't exist:
-            try:
-                with shelve.open(filename, 'c'):
-                    pass
-            except dbm.error:
-                # If we got here, then more than one thread/process tried to
-                # create the file at the same time and gdbm's own locking threw
-                # an exception. It doesn't matter, the threads/procs will be
-                # synchronized by the flock below.
-                pass
-
-        # Some implementations of dbm add the .db suffix, and some don't
-        if os.path.exists(filename):
-            created_name = filename
-        else:
-            created_name = filename + ".db"
+            create_db(filename)
 
-        self.fd = open(created_name, 'r+')
+        self.fd = open(db_file(filename), 'r+')
         flock(self.fd, ltype)
         logger.debug("Acquired lock for {} ({})".format(filename, ltype))
+        self.filename = filename
+        self.flag = flag
         self.shelf = shelve.open(filename, flag)
 
     def close(self) -> None:
@@ -192,6 +309,10 @@ class RWShelf(LockedShelf):
         Closes shelf and releases lock.
         """
         self.shelf.close()
+        if self.flag != 'r':
+            gen = Generation(self.filename)
+            gen.bump()
+            gen.close()
         self.fd.close()
         logger.debug("Released lock for shelf")
 
@@ -206,3 +327,335 @@ class RWShelf(LockedShelf):
         Close when exiting from `with` context.
         """
         self.close()
+
+
+class RWLock:
+    """
+    A reader-writer lock for the threads of a process: any number of threads
+    can hold it for reading at once, or a single thread for writing. The lock
+    is not reentrant.
+
+    By default it prefers writers: once a writer is waiting, new readers wait
+    for it, so a steady stream of readers cannot starve writers.
+
+        >>> lock = RWLock()
+        >>> with lock.read():
+        >>>     ...
+        >>> with lock.write():
+        >>>     ...
+    """
+
+    def __init__(self, prefer_writers: bool=True) -> None:
+        """
+        :param prefer_writers: Make new readers wait while a writer is waiting
+            (otherwise writers wait until there are no readers at all)
+        """
+        self.prefer_writers = prefer_writers
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self) -> None:
+        with self._cond:
+            while self._writer or (self.prefer_writers and
+                                   self._waiting_writers):
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self) -> None:
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self) -> None:
+        with self._cond:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self) -> None:
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+_rwlocks = {}  # type: Dict[str, RWLock]
+_rwlocks_mutex = threading.Lock()
+
+
+def _reset_rwlocks_after_fork() -> None:
+    global _rwlocks, _rwlocks_mutex
+    # Other threads may have held them at the time of the fork
+    _rwlocks, _rwlocks_mutex = {}, threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_rwlocks_after_fork)
+
+
+def rwlock_for(filename: str) -> RWLock:
+    """
+    Return the `RWLock` shared by every `RWLockShelf` of this process which
+    opens `filename`.
+    """
+    path = os.path.abspath(filename)
+    with _rwlocks_mutex:
+        lock = _rwlocks.get(path)
+        if lock is None:
+            lock = _rwlocks[path] = RWLock()
+        return lock
+
+
+class RWLockShelf(LockedShelf):
+    """
+    Synchronizes the threads of a process with an `RWLock` (so that many
+    readers can access the shelve object at once, but only one writer),
+    without any system call. With `use_flock=True` the flock used by `RWShelf`
+    is taken as well (after the `RWLock`), so that other processes using
+    `RWShelf` or `RWLockShelf` are synchronized too.
+
+    Intended to be used as a context manager:
+
+        >>> with RWLockShelf(filename, flag='r') as shelf:
+        >>>     value = shelf[key] # reader lock (because of 'r' flag)
+
+        >>> with RWLockShelf(filename, flag='c', use_flock=True) as shelf:
+        >>>     shelf[key] = value # writer lock (because of non-'r' flag)
+    """
+
+    def __init__(self, filename: str, flag='c', lock: Optional[RWLock]=None,
+                 use_flock: bool=False) -> None:
+        """
+        Locks the database and opens the shelf (sets shelve object to `shelf`
+        attribute). If the database does not exist and the flag is 'r', then
+        raises a FileNotFoundError exception.
+
+        :param filename: path to the shelve database file
+        :param flag: flag to pass to `dbm.open()`
+        :param lock: the lock to use (by default, one shared by every
+            RWLockShelf opening `filename` in this process, see
+            :func:`rwlock_for`)
+        :param use_flock: also lock the database file with flock
+        """
+        self.lock = rwlock_for(filename) if lock is None else lock
+        self.filename = filename
+        self.flag = flag
+        self.fd = None
+        if flag == 'r':
+            self.lock.acquire_read()
+        else:
+            self.lock.acquire_write()
+        try:
+            if use_flock:
+                self._flock()
+            logger.debug("Acquired lock for {} ({})".format(filename, flag))
+            if flag == 'r' and not os.path.exists(db_file(filename)):
+                raise FileNotFoundError(db_file(filename))
+            self.shelf = shelve.open(filename, flag)
+        except BaseException:
+            self._release()
+            raise
+
+    def _flock(self) -> None:
+        if self.flag == 'r':
+            ltype = fcntl.LOCK_SH
+        else:
+            ltype = fcntl.LOCK_EX
+            create_db(self.filename)
+        self.fd = open(db_file(self.filename), 'r+')
+        flock(self.fd, ltype)
+
+    def _release(self) -> None:
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+        if self.flag == 'r':
+            self.lock.release_read()
+        else:
+            self.lock.release_write()
+
+    def close(self) -> None:
+        """
+        Closes shelf and releases lock.
+        """
+        try:
+            self.shelf.close()
+            if self.flag != 'r':
+                gen = Generation(self.filename)
+                gen.bump()
+                gen.close()
+        finally:
+            self._release()
+            logger.debug("Released lock for shelf")
+
+    def __enter__(self) -> shelve.Shelf:
+        """
+        Allows the underlying shelve object to be used in a `with` context.
+        """
+        return self.shelf
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        """
+        Close when exiting from `with` context.
+        """
+        self.close()
+
+
+_handles = weakref.WeakSet()  # type: weakref.WeakSet
+
+
+def _reset_handles_after_fork() -> None:
+    for handle in list(_handles):
+        handle._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_handles_after_fork)
+
+
+class ShelfHandle:
+    """
+    A long-lived handle on a shelve database which uses the same flock
+    protocol as `RWShelf` (so it interoperates with other processes using
+    `RWShelf`), but keeps the lock file descriptor and the underlying dbm
+    object open between acquisitions instead of re-opening them every time.
+
+    Before handing out the shelf, the handle compares the database's
+    `Generation` counter with the value it saw last: if another process has
+    written in the meantime the dbm object is re-opened so that its writes are
+    visible. After a write the shelf is synced and the counter bumped before
+    the lock is released.
+
+    Threads within a process are serialized by a mutex (the dbm object is
+    shared). After a fork the child discards the inherited descriptors and
+    opens its own on first use, so a handle created before forking (eg. in a
+    prefork server) is safe to use in the workers.
+
+    Intended to be used as a context manager factory:
+
+        >>> handle = ShelfHandle(filename)
+        >>> with handle.open('r') as shelf:
+        >>>     value = shelf[key]
+        >>> handle.close()
+    """
+
+    def __init__(self, filename: str) -> None:
+        """
+        :param filename: path to the shelve database file
+        """
+        self.filename = filename
+        self.generation = Generation(filename)
+        self._mutex = threading.Lock()
+        self._pid = os.getpid()
+        self.fd = None
+        self.shelf = None  # type: Optional[shelve.Shelf]
+        self._seen = None  # type: Optional[int]
+        _handles.add(self)
+
+    def _after_fork(self) -> None:
+        # The descriptors (and any flock held on them) are shared with the
+        # parent, so they must not be used or closed in the child.
+        self._mutex = threading.Lock()
+        self._pid = os.getpid()
+        self.fd = None
+        self.shelf = None
+        self._seen = None
+        self.generation = Generation(self.filename)
+
+    def _dbm_flag(self, flag: str) -> str:
+        # gdbm's own lock would conflict with ours while the handle is open
+        if dbm.whichdb(self.filename) == 'dbm.gnu':
+            return flag + 'u'
+        return flag
+
+    def _open_fd(self, flag: str) -> None:
+        if flag != 'r':
+            create_db(self.filename)
+        self.fd = open(db_file(self.filename), 'r+')
+        self.generation.create()
+
+    def _reopen_shelf(self) -> None:
+        if self.shelf is not None:
+            self.shelf.close()
+        self.shelf = shelve.open(self.filename, self._dbm_flag('w'))
+        logger.debug("Opened persistent shelf for {}".format(self.filename))
+
+    def _sync(self) -> None:
+        self.shelf.sync()
+        if isinstance(self.shelf.dict, dbm.dumb._Database):
+            # dbm.dumb never clears its dirty flag, so closing this (later
+            # stale) object would write our old index over other writers'
+            self.shelf.dict._modified = False
+
+    @contextmanager
+    def open(self, flag: str='r') -> Iterator[shelve.Shelf]:
+        """
+        Acquire a shared (flag 'r') or exclusive (any other flag) lock on the
+        database and yield the open shelve object. If the database does not
+        exist and the flag is 'r', raises FileNotFoundError.
+
+        :param flag: 'r' for read access, anything else for write access
+        """
+        if self._pid != os.getpid():
+            self._after_fork()
+        with self._mutex:
+            if self.fd is None:
+                self._open_fd(flag)
+            ltype = fcntl.LOCK_SH if flag == 'r' else fcntl.LOCK_EX
+            flock(self.fd, ltype)
+            logger.debug("Acquired lock for {} ({})".format(self.filename,
+                                                           ltype))
+            try:
+                seen = self.generation.read()
+                if self.shelf is None or seen != self._seen:
+                    self._reopen_shelf()
+                    self._seen = seen
+                try:
+                    yield self.shelf
+                finally:
+                    if flag != 'r':
+                        self._sync()
+                        self._seen = self.generation.bump()
+            finally:
+                flock(self.fd, fcntl.LOCK_UN)
+                logger.debug("Released lock for shelf")
+
+    def close(self) -> None:
+        """
+        Close the shelf and the lock file descriptor. The handle may be used
+        again afterwards (it will re-open them).
+        """
+        if self._pid != os.getpid():
+            self._after_fork()
+            return
+        with self._mutex:
+            if self.shelf is not None:
+                self.shelf.close()
+                self.shelf = None
+            if self.fd is not None:
+                self.fd.close()
+                self.fd = None
+            self.generation.close()
+            self._seen = None
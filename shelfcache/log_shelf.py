@@ -0,0 +1,437 @@
+"""
+A `LockedShelf` implementation which does not use dbm at all: the shelf is
+stored as an append-only log of (key, value) entries, split into segment files
+(`<filename>.000001.log`, ...) which are read through `mmap`:
+
+    >>> cache = ShelfCache('cache.db', shelf_t=LogShelf)
+
+Every process keeps an in-memory hash index mapping each key to the position
+of its latest value in the segments, so a read is a dictionary lookup and a
+slice of a memory map (no system calls), and a write is a single sequential
+`write()` at the end of the active segment. Deleting a key appends a
+tombstone.
+
+When the active segment grows past `segment_size` a new one is started, and
+when more than half of the log is taken by overwritten or deleted entries a
+writer compacts it (copies the live entries into a new segment and removes the
+old ones).
+
+Access is synchronized with the same flock protocol as `RWShelf`, on
+`<filename>` itself, which also holds an epoch counter bumped whenever the set
+of segments changes (rollover, compaction or truncation). Processes catch up
+with the entries appended by others when they acquire the lock, and rebuild
+their index from scratch only when the epoch has changed.
+
+Each entry carries a CRC of its contents, so a torn write at the end of the
+log (left by a crash) is ignored and truncated by the next writer.
+
+Only the standard library is used.
+"""
+from .locked_shelf import LockedShelf, Generation
+from collections.abc import MutableMapping
+from typing import Dict, Iterator, List, Optional, Tuple
+import shelve
+import threading
+import fcntl
+from fcntl import flock
+import mmap
+import struct
+import zlib
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+_ENTRY = struct.Struct('<IIIB')  # key length, value length, crc32, op
+_PUT = 0
+_DELETE = 1
+_EPOCH = struct.Struct('<Q')
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+"""The size after which a new segment is started."""
+
+COMPACT_MIN = 1024 * 1024
+"""Logs smaller than this (in bytes) are never compacted."""
+
+
+class _Segment:
+    """One segment file and its (read-only) memory map."""
+
+    def __init__(self, path: str, number: int) -> None:
+        self.path = path
+        self.number = number
+        self.fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self.map = None  # type: Optional[mmap.mmap]
+        self.end = 0  # the end of the last valid entry
+
+    def remap(self) -> int:
+        """
+        Map the whole file if it has grown, and return its size.
+        """
+        size = os.fstat(self.fd).st_size
+        if size and (self.map is None or len(self.map) < size):
+            self.map = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+        return size
+
+    def read(self, offset: int, length: int) -> bytes:
+        if self.map is None or offset + length > len(self.map):
+            self.remap()
+        return self.map[offset:offset + length]
+
+    def close(self) -> None:
+        # The map is left to the garbage collector: another thread may
+        # still be slicing it
+        self.map = None
+        os.close(self.fd)
+
+
+class _Log:
+    """
+    The state of one log shared by the threads of a process: its segments
+    and the index of the latest entry of every key. Must only be modified
+    while holding the flock of a `LogShelf` (and `mutex`).
+    """
+
+    def __init__(self, filename: str, segment_size: int=SEGMENT_SIZE,
+                 compact_min: int=COMPACT_MIN) -> None:
+        self.filename = filename
+        self.segment_size = segment_size
+        self.compact_min = compact_min
+        self.mutex = threading.Lock()
+        self.epoch = None  # type: Optional[int]
+        self.segments = []  # type: List[_Segment]
+        # key -> (segment, offset of the value, length of the value)
+        self.index = {}  # type: Dict[bytes, Tuple[_Segment, int, int]]
+        self.live = 0  # the number of bytes taken by the indexed entries
+
+    # Reading the log
+
+    def _segment_path(self, number: int) -> str:
+        return '{}.{:06d}.log'.format(self.filename, number)
+
+    def _list_segments(self) -> List[int]:
+        directory = os.path.dirname(self.filename) or '.'
+        prefix = os.path.basename(self.filename) + '.'
+        numbers = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name.endswith('.log'):
+                number = name[len(prefix):-len('.log')]
+                if number.isdigit():
+                    numbers.append(int(number))
+        return sorted(numbers)
+
+    def sync(self, epoch: int) -> None:
+        """
+        Bring the index up to date with the log (whose current epoch is
+        `epoch`).
+        """
+        if epoch != self.epoch or not self.segments:
+            self.reload()
+            self.epoch = epoch
+        else:
+            self._scan(self.segments[-1])
+
+    def reload(self) -> None:
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+        self.index = {}
+        self.live = 0
+        for number in self._list_segments():
+            segment = _Segment(self._segment_path(number), number)
+            self.segments.append(segment)
+            self._scan(segment)
+        logger.debug("Loaded {} entries from {} segments of {}".format(
+            len(self.index), len(self.segments), self.filename))
+
+    def _scan(self, segment: _Segment) -> None:
+        """
+        Index the entries appended to `segment` since it was last scanned.
+        """
+        size = segment.remap()
+        pos = segment.end
+        data = segment.map
+        while pos + _ENTRY.size <= size:
+            klen, vlen, crc, op = _ENTRY.unpack_from(data, pos)
+            start = pos + _ENTRY.size
+            end = start + klen + vlen
+            if end > size or zlib.crc32(data[start:end]) != crc:
+                break  # torn write
+            key = data[start:start + klen]
+            self._indexed(key, op, segment, start + klen, vlen)
+            pos = end
+        segment.end = pos
+
+    def _indexed(self, key: bytes, op: int, segment: _Segment, offset: int,
+                 vlen: int) -> None:
+        prev = self.index.pop(key, None)
+        if prev is not None:
+            self.live -= _ENTRY.size + len(key) + prev[2]
+        if op == _PUT:
+            self.index[key] = (segment, offset, vlen)
+            self.live += _ENTRY.size + len(key) + vlen
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        segment, offset, vlen = entry
+        return segment.read(offset, vlen)
+
+    # Writing the log
+
+    def repair(self) -> None:
+        """
+        Truncate a torn entry at the end of the active segment (so that the
+        entries appended after it can be read back).
+        """
+        if self.segments:
+            segment = self.segments[-1]
+            if segment.remap() > segment.end:
+                os.ftruncate(segment.fd, segment.end)
+                segment.map = None
+                logger.warning("Truncated torn entry at the end of {}"
+                               .format(segment.path))
+
+    def _active(self) -> _Segment:
+        if not self.segments:
+            self._new_segment(1)
+        return self.segments[-1]
+
+    def _new_segment(self, number: int) -> _Segment:
+        segment = _Segment(self._segment_path(number), number)
+        self.segments.append(segment)
+        self.epoch += 1
+        return segment
+
+    def append(self, key: bytes, value: Optional[bytes]) -> None:
+        """
+        Append a put (or a delete if `value` is None) of `key`.
+        """
+        segment = self._active()
+        op = _PUT if value is not None else _DELETE
+        body = key + (value or b'')
+        os.write(segment.fd, _ENTRY.pack(len(key), len(body) - len(key),
+                                         zlib.crc32(body), op) + body)
+        offset = segment.end + _ENTRY.size + len(key)
+        segment.end += _ENTRY.size + len(body)
+        self._indexed(key, op, segment, offset, len(body) - len(key))
+        if segment.end >= self.segment_size:
+            self._new_segment(segment.number + 1)
+
+    def size(self) -> int:
+        return sum(segment.end for segment in self.segments)
+
+    def should_compact(self) -> bool:
+        size = self.size()
+        return size >= self.compact_min and size > 2 * self.live
+
+    def compact(self) -> None:
+        """
+        Copy the live entries into a new segment and delete the old ones.
+        """
+        old = self.segments
+        number = old[-1].number + 1 if old else 1
+        path = self._segment_path(number)
+        tmp = path + '.tmp'
+        index = {}  # type: Dict[bytes, Tuple[int, int]]
+        with open(tmp, 'wb') as f:
+            pos = 0
+            for key in list(self.index):
+                value = self.get(key)
+                body = key + value
+                f.write(_ENTRY.pack(len(key), len(value), zlib.crc32(body),
+                                    _PUT) + body)
+                index[key] = (pos + _ENTRY.size + len(key), len(value))
+                pos += _ENTRY.size + len(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        segment = _Segment(path, number)
+        segment.end = pos
+        self.index = {key: (segment, offset, vlen)
+                      for key, (offset, vlen) in index.items()}
+        self.segments = [segment]
+        for stale in old:
+            stale.close()
+            os.remove(stale.path)
+        self.epoch += 1
+        logger.info("Compacted {} ({} bytes)".format(self.filename, pos))
+
+    def truncate(self) -> None:
+        """
+        Delete every segment.
+        """
+        for segment in self.segments:
+            segment.close()
+            os.remove(segment.path)
+        self.segments = []
+        self.index = {}
+        self.live = 0
+        self.epoch += 1
+
+
+_logs = {}  # type: Dict[str, _Log]
+_logs_lock = threading.Lock()
+_logs_pid = os.getpid()
+
+
+def _get_log(filename: str, **kwargs) -> _Log:
+    global _logs, _logs_lock, _logs_pid
+    if _logs_pid != os.getpid():
+        # Forked: the locks may have been held by another thread
+        _logs, _logs_lock, _logs_pid = {}, threading.Lock(), os.getpid()
+    path = os.path.abspath(filename)
+    with _logs_lock:
+        log = _logs.get(path)
+        if log is None:
+            log = _logs[path] = _Log(path, **kwargs)
+        return log
+
+
+class LogDict(MutableMapping):
+    """
+    The bytes to bytes mapping view of a log (the `dict` of the
+    `shelve.Shelf` yielded by `LogShelf`).
+    """
+
+    def __init__(self, log: _Log, writable: bool) -> None:
+        self.log = log
+        self.writable = writable
+
+    def get(self, key: bytes, default=None):
+        value = self.log.get(key)
+        return default if value is None else value
+
+    def __getitem__(self, key: bytes) -> bytes:
+        value = self.log.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def _check_writable(self) -> None:
+        if not self.writable:
+            raise PermissionError("The shelf is opened for reading only")
+
+    def __setitem__(self, key: bytes, value: bytes) -> None:
+        self._check_writable()
+        self.log.append(bytes(key), bytes(value))
+
+    def __delitem__(self, key: bytes) -> None:
+        self._check_writable()
+        if key not in self.log.index:
+            raise KeyError(key)
+        self.log.append(bytes(key), None)
+
+    def __contains__(self, key) -> bool:
+        return key in self.log.index
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(list(self.log.index))
+
+    def __len__(self) -> int:
+        return len(self.log.index)
+
+    def clear(self) -> None:
+        self._check_writable()
+        self.log.truncate()
+
+    def close(self) -> None:
+        pass
+
+
+class LogShelf(LockedShelf):
+    """
+    Opens a shelf stored as an append-only log (see the module
+    documentation), holding a shared (flag 'r') or exclusive (any other flag)
+    flock on `filename` until it is closed.
+
+    Intended to be used as a context manager, like the other `LockedShelf`
+    implementations:
+
+        >>> with LogShelf(filename, flag='r') as shelf:
+        >>>     value = shelf[key]
+
+    To change the segment size or the compaction threshold when used by a
+    `ShelfCache`, pass a partial: `shelf_t=functools.partial(LogShelf,
+    segment_size=...)`.
+    """
+
+    def __init__(self, filename: str, flag='c',
+                 segment_size: int=SEGMENT_SIZE,
+                 compact_min: int=COMPACT_MIN) -> None:
+        """
+        :param filename: path to the lock file (the segments are stored next
+            to it)
+        :param flag: 'r' to read (raises FileNotFoundError if the log does not
+            exist), 'n' to truncate the log, anything else to write
+        :param segment_size: start a new segment once the active one is this
+            large
+        :param compact_min: never compact logs smaller than this
+        """
+        self.filename = filename
+        self.flag = flag
+        if flag == 'r':
+            self.fd = os.open(filename, os.O_RDONLY)
+            flock(self.fd, fcntl.LOCK_SH)
+        else:
+            self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+            flock(self.fd, fcntl.LOCK_EX)
+        logger.debug("Acquired lock for {} ({})".format(filename, flag))
+        try:
+            self.log = _get_log(filename, segment_size=segment_size,
+                                compact_min=compact_min)
+            self.log.mutex.acquire()
+            try:
+                self.log.sync(self._read_epoch())
+                self.epoch = self.log.epoch
+                if flag == 'n':
+                    self.log.truncate()
+                elif flag != 'r':
+                    self.log.repair()
+            except BaseException:
+                # A writer keeps the mutex until close(), which won't be
+                # called now
+                if flag != 'r':
+                    self.log.mutex.release()
+                raise
+            finally:
+                if flag == 'r':
+                    self.log.mutex.release()
+        except BaseException:
+            os.close(self.fd)
+            raise
+        self.shelf = shelve.Shelf(LogDict(self.log, flag != 'r'))
+
+    def _read_epoch(self) -> int:
+        data = os.pread(self.fd, _EPOCH.size, 0)
+        if len(data) < _EPOCH.size:
+            return 0
+        return _EPOCH.unpack(data)[0]
+
+    def close(self) -> None:
+        """
+        Closes the shelf (compacting the log if needed) and releases the lock.
+        """
+        try:
+            self.shelf.close()
+            if self.flag != 'r':
+                try:
+                    if self.log.should_compact():
+                        self.log.compact()
+                    if self.log.epoch != self.epoch:
+                        os.pwrite(self.fd, _EPOCH.pack(self.log.epoch), 0)
+                finally:
+                    self.log.mutex.release()
+                gen = Generation(self.filename)
+                gen.bump()
+                gen.close()
+        finally:
+            os.close(self.fd)
+            logger.debug("Released lock for shelf")
+
+    def __enter__(self) -> shelve.Shelf:
+        return self.shelf
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
@@ -0,0 +1,111 @@
+"""
+An in-process, bounded LRU tier which `ShelfCache` can keep in front of the
+on-disk shelf so that repeated reads of hot keys are served without touching
+dbm or unpickling anything.
+
+Entries are tagged with the database's `Generation` counter (which every
+writer bumps): as soon as the counter moves on, the whole tier is dropped, so
+an entry is never older than the last write made by any process. Writes made
+through the owning `ShelfCache` only invalidate the keys they touch.
+"""
+from collections import OrderedDict
+from typing import Any, Iterable, Optional
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryTier:
+    """
+    A thread-safe LRU mapping bounded by item count and/or total bytes.
+    """
+
+    def __init__(self, max_items: int=0, max_bytes: int=0) -> None:
+        """
+        :param max_items: Maximum number of entries to keep (0 means no limit)
+        :param max_bytes: Maximum total size (as reported to :meth:`put`) of
+            the entries to keep (0 means no limit)
+        """
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.generation = None  # type: Optional[int]
+        self.nbytes = 0
+        self._entries = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _check(self, generation: int) -> None:
+        if generation != self.generation:
+            if self._entries:
+                logger.debug("Dropping memory tier (generation {} -> {})"
+                             .format(self.generation, generation))
+            self._entries.clear()
+            self.nbytes = 0
+            self.generation = generation
+
+    def get(self, key, generation: int) -> Optional[Any]:
+        """
+        Return the value cached for `key`, or None if it is not cached or the
+        database has been written since it was.
+
+        :param generation: The database's current generation
+        """
+        with self._lock:
+            self._check(generation)
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, nbytes: int, generation: int) -> None:
+        """
+        Cache `value` (whose serialized size is `nbytes`) for `key`, evicting
+        the least recently used entries if the tier is over its limits.
+
+        :param generation: The generation of the database the value was read
+            from (read while holding the database lock)
+        """
+        if self.max_bytes and nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self._check(generation)
+            self._discard(key)
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while ((self.max_items and len(self._entries) > self.max_items) or
+                   (self.max_bytes and self.nbytes > self.max_bytes)):
+                _, (_, size) = self._entries.popitem(last=False)
+                self.nbytes -= size
+
+    def _discard(self, key) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def written(self, seen: int, keys: Optional[Iterable]=None) -> None:
+        """
+        Record a write made by the owner of this tier. Must be called before
+        the exclusive lock is released (and hence before the generation is
+        bumped).
+
+        :param seen: The generation read while holding the exclusive lock
+        :param keys: The keys which were modified (None means any key may have
+            been modified)
+        """
+        with self._lock:
+            if self.generation != seen or keys is None:
+                self._entries.clear()
+                self.nbytes = 0
+            else:
+                for key in keys:
+                    self._discard(key)
+            self.generation = seen + 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
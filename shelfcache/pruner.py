@@ -0,0 +1,162 @@
+"""
+A background thread which periodically deletes the expired (and optionally
+the old) items of a `ShelfCache`.
+
+Rather than holding the exclusive lock for a whole prune (as
+:meth:`ShelfCache.prune_expired` does), the `Pruner` uses
+:meth:`ShelfCache.iter_prune` to delete items a chunk at a time and pauses
+between chunks, so readers and writers only ever wait for one small chunk.
+The pace can be limited further with `max_rate`, and each run can be capped
+with `max_items`.
+
+    >>> cache = ShelfCache('cache.db', index=True)
+    >>> pruner = cache.start_pruner(interval=300, max_age=timedelta(days=7))
+    >>> ...
+    >>> cache.close()  # stops the pruner
+"""
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional, TYPE_CHECKING
+import threading
+import time
+import logging
+
+if TYPE_CHECKING:
+    from .shelfcache import ShelfCache
+
+logger = logging.getLogger(__name__)
+
+
+PruneReport = NamedTuple('PruneReport', [('items', int), ('bytes', int)])
+"""
+The amount of space reclaimed by a pruning run.
+
+:param int items: The number of items deleted
+:param int bytes: Their total size on disk (0 if unknown)
+"""
+
+
+class Pruner:
+    """
+    Prune a `ShelfCache` every `interval` seconds in a daemon thread (or on
+    demand with :meth:`run_once`).
+
+    :ivar items: The total number of items deleted so far
+    :ivar bytes: The total number of bytes reclaimed so far
+    :ivar runs: The number of completed runs
+    :ivar last_report: The `PruneReport` of the last run (or None)
+    """
+
+    def __init__(self, cache: 'ShelfCache', interval: float=60,
+                 chunk_size: int=100, pause: float=0.01,
+                 max_rate: float=0, max_items: int=0,
+                 max_age: Optional[timedelta]=None) -> None:
+        """
+        :param cache: The cache to prune
+        :param interval: The number of seconds between the start of two runs
+        :param chunk_size: The number of items deleted under each exclusive
+            lock
+        :param pause: The minimum number of seconds to wait (without holding
+            the lock) between two chunks
+        :param max_rate: Do not delete more than this many items per second
+            (0 means no limit)
+        :param max_items: End a run once it has deleted this many items (0
+            means no limit)
+        :param max_age: Also delete the items which have not been updated for
+            this long (by default only expired items are deleted)
+        """
+        self.cache = cache
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.max_rate = max_rate
+        self.max_items = max_items
+        self.max_age = max_age
+        self.items = 0
+        self.bytes = 0
+        self.runs = 0
+        self.last_report = None  # type: Optional[PruneReport]
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def run_once(self) -> PruneReport:
+        """
+        Prune the cache now (in the calling thread).
+        """
+        now = datetime.utcnow()
+        report = self._prune(now, 'expire_dt', self.max_items)
+        if self.max_age is not None and not self._stop.is_set():
+            budget = 0
+            if self.max_items:
+                budget = self.max_items - report.items
+            if not self.max_items or budget > 0:
+                old = self._prune(now - self.max_age, 'updated_dt', budget)
+                report = PruneReport(report.items + old.items,
+                                     report.bytes + old.bytes)
+        self.items += report.items
+        self.bytes += report.bytes
+        self.runs += 1
+        self.last_report = report
+        logger.info("Pruned {} items ({} bytes) from {}".format(
+            report.items, report.bytes, self.cache.db_path))
+        return report
+
+    def _prune(self, older_than: datetime, field_name: str,
+               budget: int) -> PruneReport:
+        items = nbytes = 0
+        start = time.monotonic()
+        chunks = self.cache.iter_prune(older_than, field_name,
+                                       self.chunk_size)
+        try:
+            for count, size in chunks:
+                items += count
+                nbytes += size
+                if budget and items >= budget:
+                    break
+                delay = self.pause
+                if self.max_rate:
+                    # Don't get ahead of max_rate items per second
+                    ahead = items / self.max_rate - (time.monotonic() - start)
+                    delay = max(delay, ahead)
+                if self._stop.wait(delay):
+                    break
+        finally:
+            chunks.close()
+        return PruneReport(items, nbytes)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Pruning {} failed"
+                                 .format(self.cache.db_path))
+            self._stop.wait(max(0, self.interval -
+                                (time.monotonic() - started)))
+
+    def start(self) -> 'Pruner':
+        """
+        Start pruning in a daemon thread (the first run starts immediately).
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='shelfcache-pruner')
+            self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float]=None) -> None:
+        """
+        Stop the thread (after the chunk being deleted, if any).
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                return
+            self._thread = None
+        self._stop.clear()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
@@ -0,0 +1,146 @@
+"""
+The on-disk layout of the items written by `ShelfCache`.
+
+Instead of pickling an `Item` (its metadata and its data together), each
+value stored in the dbm is a small fixed-size header followed by the payload:
+
+    +-------+--------+---------+---------+--------+-------+---------+---------+
+    | magic | format | created | updated | expire | codec | version | payload |
+    +-------+--------+---------+---------+--------+-------+---------+---------+
+
+The timestamps are stored as seconds since the epoch (`inf` for an item which
+never expires), `codec` says how the payload was serialized (in its low four
+bits, see the `serializers` module) and compressed (in its high four bits, see
+:func:`compress`) and `version` is incremented every time the item is written
+(format 1 records, which have no version field, are read as version 0). The
+header can be read with a single `struct.unpack_from`, so metadata queries
+never have to deserialize the payload.
+
+Values which don't start with the magic bytes (which can't start a pickle) are
+pickled `Item` objects written by older versions, and are still read
+transparently.
+"""
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional, Tuple
+import importlib
+import math
+import struct
+
+EPOCH = datetime(1970, 1, 1)
+
+MAGIC = b'\xffSC'
+FORMAT = 2
+
+PICKLE = 0
+"""Codec: the payload is a pickle of the item's data."""
+
+ZLIB = 0x10
+LZMA = 0x20
+BZ2 = 0x30
+"""Codecs (combined with the serialization codec): the serialized payload is
+compressed with zlib, lzma or bz2."""
+
+COMPRESSORS = {'zlib': ZLIB, 'lzma': LZMA, 'bz2': BZ2}
+_MODULES = {ZLIB: 'zlib', LZMA: 'lzma', BZ2: 'bz2'}
+_COMPRESSION = 0xf0
+
+_HEADERS = {1: struct.Struct('<3sBdddB'),
+            2: struct.Struct('<3sBdddBQ')}
+_HEADER = _HEADERS[FORMAT]
+_MAGIC_FORMAT = struct.Struct('<3sB')
+
+ItemMeta = NamedTuple('ItemMeta', [('created_dt', datetime),
+                                   ('updated_dt', datetime),
+                                   ('expire_dt', Optional[datetime]),
+                                   ('size', int),
+                                   ('version', int)])
+"""
+The metadata of a cached item.
+
+:param created_dt: The date the item was first cached
+:param updated_dt: The date the item was last updated in cache
+:param expire_dt: The date the item expires (None if it never expires)
+:param int size: The size of the stored item in bytes (0 if unknown)
+:param int version: The number of times the item has been written (0 for
+    items written by older versions)
+"""
+
+
+def to_timestamp(dt: Optional[datetime]) -> float:
+    """Convert a naive UTC datetime to seconds since the epoch (None -> inf)"""
+    if dt is None:
+        return math.inf
+    return (dt - EPOCH).total_seconds()
+
+
+def from_timestamp(ts: float) -> Optional[datetime]:
+    """The inverse of :func:`to_timestamp`"""
+    if ts == math.inf:
+        return None
+    return EPOCH + timedelta(seconds=ts)
+
+
+def is_record(raw: bytes) -> bool:
+    """
+    Return True if `raw` was written in this format (and False if it is a
+    legacy pickled `Item`).
+    """
+    return raw[:len(MAGIC)] == MAGIC
+
+
+def pack(created_dt: datetime, updated_dt: datetime,
+         expire_dt: Optional[datetime], codec: int, payload: bytes,
+         version: int=0) -> bytes:
+    """
+    Return the bytes to store for an item.
+    """
+    header = _HEADER.pack(MAGIC, FORMAT, to_timestamp(created_dt),
+                          to_timestamp(updated_dt), to_timestamp(expire_dt),
+                          codec, version)
+    return header + payload
+
+
+def unpack_meta(raw: bytes) -> Tuple[ItemMeta, int, int]:
+    """
+    Parse the header of a stored item.
+
+    Returns:
+        The item's metadata, its codec, and the offset of its payload in `raw`
+    """
+    fmt = _MAGIC_FORMAT.unpack_from(raw)[1]
+    header = _HEADERS.get(fmt)
+    if header is None:
+        raise ValueError("Unknown record format: {}".format(fmt))
+    fields = header.unpack_from(raw)
+    created, updated, expire, codec = fields[2:6]
+    version = fields[6] if len(fields) > 6 else 0
+    meta = ItemMeta(from_timestamp(created), from_timestamp(updated),
+                    from_timestamp(expire), len(raw), version)
+    return meta, codec, header.size
+
+
+def compress(codec: int, payload: bytes,
+             compression: str) -> Tuple[int, bytes]:
+    """
+    Compress a serialized `payload` with the named `compression` ('zlib',
+    'lzma' or 'bz2'), returning the codec to store it with along with the
+    compressed payload (or `codec` and `payload` unchanged if compressing it
+    doesn't make it smaller).
+    """
+    method = COMPRESSORS[compression]
+    compressed = importlib.import_module(compression).compress(payload)
+    if len(compressed) >= len(payload):
+        return codec, payload
+    return codec | method, compressed
+
+
+def decompress(codec: int, payload: bytes) -> bytes:
+    """
+    Undo the compression (if any) of a payload stored with `codec`.
+    """
+    method = codec & _COMPRESSION
+    if not method:
+        return payload
+    if method not in _MODULES:
+        raise ValueError("Unknown compression codec: {:#x}".format(codec))
+    return importlib.import_module(_MODULES[method]).decompress(payload)
@@ -0,0 +1,143 @@
+"""
+A compact, picklable stand-in for `requests.Response`.
+
+Pickling a `requests.Response` also pickles its `request`, cookies, history,
+connection details and every header. `CachedResponse` only keeps what a cached
+resource needs: the status, the url, the encoding, a few headers (see
+`HEADERS`) and the body. It has the attributes of a response which are used
+most (`status_code`, `headers`, `content`, `url`, `encoding`, `reason`);
+anything else (eg. `text`, `json()` or `raise_for_status()`) is delegated to a
+real `requests.Response`, built from it the first time it is needed:
+
+    >>> response = cache_get(cache, url, compact=True)
+    >>> response.status_code
+    200
+    >>> response.json()
+
+The body of a response cached by a streaming `cache_get` is stored in the
+cache's blob store: its `body` is a `BlobRef`, which :meth:`iter_content`
+reads a chunk at a time (reading `content` loads the whole body).
+"""
+from .blobs import BlobRef, CHUNK_SIZE
+from requests.structures import CaseInsensitiveDict
+from typing import Any, Iterable, Iterator, Optional, Tuple, Union
+import requests
+
+HEADERS = ('age', 'cache-control', 'content-language', 'content-type', 'date',
+           'etag', 'expires', 'last-modified', 'link', 'location', 'vary')
+"""The headers kept by default (the body is stored decoded, so its
+content-encoding and content-length are not kept)."""
+
+
+class CachedResponse:
+    __slots__ = ('status_code', 'reason', 'url', 'encoding', 'body',
+                 '_headers', '_response')
+
+    def __init__(self, status_code: int, url: str,
+                 content: Union[bytes, BlobRef],
+                 headers: Iterable[Tuple[str, str]]=(),
+                 encoding: Optional[str]=None, reason: str='') -> None:
+        """
+        :param status_code: The HTTP status
+        :param url: The final url of the response
+        :param content: The (decoded) body, or a reference to the blob
+            holding it
+        :param headers: The headers, as (name, value) pairs
+        :param encoding: The encoding of the body's text
+        :param reason: The HTTP reason phrase
+        """
+        self.status_code = status_code
+        self.reason = reason
+        self.url = url
+        self.encoding = encoding
+        self.body = content
+        self._headers = CaseInsensitiveDict(headers)
+        self._response = None  # type: Optional[requests.Response]
+
+    @classmethod
+    def from_response(cls, response, headers: Iterable[str]=HEADERS,
+                      content: Union[bytes, BlobRef, None]=None
+                      ) -> 'CachedResponse':
+        """
+        Build a CachedResponse from a `requests.Response` (or another
+        CachedResponse), keeping only the named `headers`.
+
+        :param content: The body (by default, the response's content)
+        """
+        kept = [(name, response.headers[name]) for name in headers
+                if name in response.headers]
+        if content is None:
+            content = getattr(response, 'body', None)
+            if content is None:
+                content = response.content
+        return cls(response.status_code, response.url, content, kept,
+                   response.encoding, response.reason)
+
+    @property
+    def content(self) -> bytes:
+        body = self.body
+        if isinstance(body, BlobRef):
+            return body.read()
+        return body
+
+    def iter_content(self, chunk_size: Optional[int]=CHUNK_SIZE,
+                     decode_unicode: bool=False) -> Iterator:
+        """
+        Iterate over the body `chunk_size` bytes at a time (like
+        `requests.Response.iter_content`), without loading it all if it is
+        stored in a blob.
+        """
+        if decode_unicode:
+            return self.to_response().iter_content(chunk_size, True)
+        body = self.body
+        if isinstance(body, BlobRef):
+            return body.chunks(chunk_size or CHUNK_SIZE)
+        if not chunk_size:
+            return iter([body])
+        return (body[start:start + chunk_size]
+                for start in range(0, len(body), chunk_size))
+
+    @property
+    def headers(self) -> CaseInsensitiveDict:
+        return self._headers
+
+    @headers.setter
+    def headers(self, value) -> None:
+        self._headers = CaseInsensitiveDict(value)
+        self._response = None
+
+    def to_response(self) -> requests.Response:
+        """
+        Return a `requests.Response` with the same status, headers and body
+        (built once).
+        """
+        response = self._response
+        if response is None:
+            response = requests.Response()
+            response.status_code = self.status_code
+            response.reason = self.reason
+            response.url = self.url
+            response.encoding = self.encoding
+            response.headers = CaseInsensitiveDict(self._headers)
+            response._content = self.content
+            self._response = response
+        return response
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for the attributes not defined above
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.to_response(), name)
+
+    def __getstate__(self) -> tuple:
+        return (self.status_code, self.reason, self.url, self.encoding,
+                tuple(self._headers.items()), self.body)
+
+    def __setstate__(self, state: tuple) -> None:
+        (self.status_code, self.reason, self.url, self.encoding, headers,
+         self.body) = state
+        self._headers = CaseInsensitiveDict(headers)
+        self._response = None
+
+    def __repr__(self) -> str:
+        return '<CachedResponse [{}]>'.format(self.status_code)
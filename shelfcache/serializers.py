@@ -0,0 +1,262 @@
+"""
+The serializers `ShelfCache` can store item data with.
+
+By default data is pickled (with the shelf's protocol), but a cache can be
+given any `Encoder` (usually a `Serializer`):
+
+    >>> cache = ShelfCache('cache.db', serializer=Chain(Raw(), Pickle(5)))
+
+Every record says which serializer wrote it (in the low four bits of its codec
+byte, see the `record` module), so records are always read with the right
+one, whatever serializer the reading cache writes with. Codecs 0 to 7 are used
+by this module; custom serializers can use 8 to 15 (see :func:`register`).
+
+- `Pickle` pickles with a given protocol.
+- `OutOfBand` pickles with protocol 5, storing the buffers of the objects
+  which support it (eg. bytearrays or numpy arrays) out-of-band, after the
+  pickle. They are unpickled straight from the stored record, without copying
+  them (so eg. numpy arrays read back are read-only).
+- `Raw` stores bytes-like objects as they are (:meth:`ShelfCache.get_bytes`
+  returns them as a `memoryview` of the stored record).
+- `Json` and `Marshal` store simple types.
+- `Chain` uses the first of several serializers which accepts a value.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+import abc
+import json
+import marshal
+import pickle
+import struct
+
+PICKLE = 0
+"""Codec: the payload is a pickle of the item's data."""
+
+OUT_OF_BAND = 1
+"""Codec: a protocol 5 pickle followed by its out-of-band buffers."""
+
+RAW = 2
+"""Codec: the payload is the data (bytes)."""
+
+JSON = 3
+"""Codec: the payload is the data encoded as UTF-8 JSON."""
+
+MARSHAL = 4
+"""Codec: the payload is the data serialized with `marshal`."""
+
+BLOBS = 5
+"""Codec: a pickle whose large binary values are stored in a `BlobStore`
+(read by `ShelfCache` itself, see the `blobs` module)."""
+
+_SERIALIZER = 0x0f
+_OOB_HEADER = struct.Struct('<IQ')
+_OOB_LENGTH = struct.Struct('<Q')
+
+
+class Encoder(abc.ABC):
+    """
+    Base class of what a cache writes item data with: the records are always
+    read back by the `Serializer` registered for their codec.
+    """
+
+    def accepts(self, obj) -> bool:
+        """
+        Whether `obj` can be serialized (used by `Chain`).
+        """
+        return True
+
+    @abc.abstractmethod
+    def encode(self, obj, protocol: Optional[int]=None) -> Tuple[int, bytes]:
+        """
+        Serialize `obj`, returning the codec to store it with along with the
+        payload.
+
+        :param protocol: The protocol of the shelf (for pickling serializers
+            which don't have one of their own)
+        """
+
+
+class Serializer(Encoder):
+    """
+    Base class of the serializers, which write and read a codec of their own.
+
+    :cvar codec: The codec stored in the records written by the serializer
+    """
+    codec = PICKLE
+
+    @abc.abstractmethod
+    def dumps(self, obj, protocol: Optional[int]=None) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    def loads(self, payload: memoryview) -> Any:
+        pass
+
+    def encode(self, obj, protocol: Optional[int]=None) -> Tuple[int, bytes]:
+        return self.codec, self.dumps(obj, protocol)
+
+
+class Pickle(Serializer):
+    codec = PICKLE
+
+    def __init__(self, protocol: Optional[int]=None) -> None:
+        """
+        :param protocol: The pickle protocol to use (None means the shelf's)
+        """
+        self.protocol = protocol
+
+    def dumps(self, obj, protocol: Optional[int]=None) -> bytes:
+        if self.protocol is not None:
+            protocol = self.protocol
+        return pickle.dumps(obj, protocol)
+
+    def loads(self, payload: memoryview) -> Any:
+        return pickle.loads(payload)
+
+
+class OutOfBand(Serializer):
+    """
+    Pickles with protocol 5 and out-of-band buffers. The payload is laid out
+    as the number of buffers, the length of the pickle and the length of each
+    buffer followed by the pickle and the buffers.
+    """
+    codec = OUT_OF_BAND
+
+    def dumps(self, obj, protocol: Optional[int]=None) -> bytes:
+        buffers = []  # type: List[pickle.PickleBuffer]
+        data = pickle.dumps(obj, 5, buffer_callback=buffers.append)
+        raws = []  # type: List[Any]
+        for buffer in buffers:
+            try:
+                raws.append(buffer.raw())
+            except BufferError:
+                # Not contiguous
+                raws.append(memoryview(buffer).tobytes())
+        header = [_OOB_HEADER.pack(len(raws), len(data))]
+        header.extend(_OOB_LENGTH.pack(memoryview(raw).nbytes)
+                      for raw in raws)
+        return b''.join(header + [data] + raws)
+
+    def loads(self, payload: memoryview) -> Any:
+        payload = memoryview(payload)
+        count, size = _OOB_HEADER.unpack_from(payload)
+        offset = _OOB_HEADER.size
+        lengths = []
+        for _ in range(count):
+            lengths.append(_OOB_LENGTH.unpack_from(payload, offset)[0])
+            offset += _OOB_LENGTH.size
+        data = payload[offset:offset + size]
+        offset += size
+        buffers = []
+        for length in lengths:
+            buffers.append(payload[offset:offset + length])
+            offset += length
+        return pickle.loads(data, buffers=buffers)
+
+
+class Raw(Serializer):
+    """
+    Stores bytes-like objects as they are (they are read back as bytes).
+    """
+    codec = RAW
+
+    def accepts(self, obj) -> bool:
+        return isinstance(obj, (bytes, bytearray, memoryview))
+
+    def dumps(self, obj, protocol: Optional[int]=None) -> bytes:
+        if not self.accepts(obj):
+            raise TypeError("Raw serializer needs a bytes-like object, not {}"
+                            .format(type(obj).__name__))
+        return bytes(obj)
+
+    def loads(self, payload: memoryview) -> Any:
+        return bytes(payload)
+
+
+class Json(Serializer):
+    """
+    Stores JSON-compatible data (note that tuples are read back as lists and
+    that dict keys are read back as strings).
+    """
+    codec = JSON
+
+    def accepts(self, obj) -> bool:
+        return obj is None or isinstance(obj, (dict, list, str, int, float))
+
+    def dumps(self, obj, protocol: Optional[int]=None) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, payload: memoryview) -> Any:
+        return json.loads(bytes(payload).decode('utf-8'))
+
+
+class Marshal(Serializer):
+    """
+    Stores the simple built-in types supported by `marshal`.
+    """
+    codec = MARSHAL
+
+    def accepts(self, obj) -> bool:
+        try:
+            marshal.dumps(obj)
+        except ValueError:
+            return False
+        return True
+
+    def dumps(self, obj, protocol: Optional[int]=None) -> bytes:
+        return marshal.dumps(obj)
+
+    def loads(self, payload: memoryview) -> Any:
+        return marshal.loads(payload)
+
+
+class Chain(Encoder):
+    """
+    Serializes each value with the first of `serializers` which accepts it
+    and manages to serialize it (eg. ``Chain(Raw(), Json(), Pickle())``:
+    `Json` only checks the type of the value itself, so a dict holding a
+    datetime is pickled). Each record is read back by the serializer which
+    wrote it.
+    """
+
+    def __init__(self, *serializers: Encoder) -> None:
+        if not serializers:
+            raise ValueError("Chain needs at least one serializer")
+        self.serializers = serializers
+
+    def accepts(self, obj) -> bool:
+        return any(serializer.accepts(obj) for serializer in self.serializers)
+
+    def encode(self, obj, protocol: Optional[int]=None) -> Tuple[int, bytes]:
+        for serializer in self.serializers:
+            if serializer.accepts(obj):
+                try:
+                    return serializer.encode(obj, protocol)
+                except (TypeError, ValueError):
+                    continue
+        raise TypeError("No serializer accepts {}".format(type(obj).__name__))
+
+
+_registry = {}  # type: Dict[int, Serializer]
+
+
+def register(serializer: Serializer) -> None:
+    """
+    Make `serializer` the one used to read the records with its codec.
+    """
+    if not 0 <= serializer.codec <= _SERIALIZER:
+        raise ValueError("Invalid codec: {}".format(serializer.codec))
+    _registry[serializer.codec] = serializer
+
+
+for _serializer in (Pickle(), OutOfBand(), Raw(), Json(), Marshal()):
+    register(_serializer)
+
+
+def loads(codec: int, payload: memoryview) -> Any:
+    """
+    Deserialize a (decompressed) payload stored with `codec`.
+    """
+    serializer = _registry.get(codec & _SERIALIZER)
+    if serializer is None:
+        raise ValueError("Unknown serializer codec: {}".format(codec))
+    return serializer.loads(payload)
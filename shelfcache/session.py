@@ -0,0 +1,129 @@
+"""
+A pooled, keep-alive HTTP session bound to a cache.
+
+`cache_get` fetches with `requests.get` by default, which opens a new
+connection (and does a new TLS handshake) for every miss or revalidation.
+`CachedSession` fetches with one `requests.Session` instead, whose
+`HTTPAdapter` keeps up to `pool_maxsize` idle connections to each of up to
+`pool_connections` hosts open, so that revalidating many urls of the same
+origin re-uses its connections:
+
+    >>> session = CachedSession(cache, pool_maxsize=8,
+    >>>                         host_pool_sizes={'https://hnrss.org': 32})
+    >>> response = session.get('https://hnrss.org/newest')
+    >>> for url, response in session.get_many(urls, per_host_limit=8):
+    >>>     ...
+
+A `CachedSession` can be shared by any number of threads (the connection
+pools of `urllib3` are thread-safe). As with a `requests.Session`, cookies set
+by responses are kept and sent with later requests.
+"""
+from .cache_get import cache_get, cache_get_many
+from requests.adapters import HTTPAdapter
+from typing import Any, Dict, Iterable, Iterator, Mapping, Optional, Tuple
+import threading
+import requests
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CachedSession:
+    """
+    Calls `cache_get` with `cache`, fetching through a pooled
+    `requests.Session`.
+
+    :ivar cache: The cache (a `ShelfCache` or `ShardedShelfCache`)
+    :ivar session: The `requests.Session` used to fetch
+    """
+
+    def __init__(self, cache, pool_connections: int=100,
+                 pool_maxsize: int=10, pool_block: bool=False,
+                 max_retries: int=0,
+                 host_pool_sizes: Optional[Mapping[str, int]]=None,
+                 session: Optional[requests.Session]=None,
+                 **kwargs) -> None:
+        """
+        :param cache: The cache to use
+        :param pool_connections: The number of hosts to keep connection pools
+            for
+        :param pool_maxsize: The number of connections kept open per host
+        :param pool_block: Whether to wait for a free connection when a
+            host's pool is full (instead of opening one which is discarded
+            after use)
+        :param max_retries: Passed to the `HTTPAdapter` (an int or a
+            `urllib3.util.Retry`)
+        :param host_pool_sizes: The `pool_maxsize` of particular origins (eg.
+            ``{'https://example.com': 32}``), see :meth:`set_pool_size`
+        :param session: The session to use (by default a new one), which is
+            closed with the `CachedSession`
+        :param kwargs: Default keyword args of :meth:`get` (eg. `compact` or
+            `timeout`)
+        """
+        self.cache = cache
+        self.session = session if session is not None else requests.Session()
+        self.defaults = kwargs  # type: Dict[str, Any]
+        self._adapter_args = dict(pool_connections=pool_connections,
+                                  pool_block=pool_block,
+                                  max_retries=max_retries)
+        self._mount_lock = threading.Lock()
+        adapter = self._adapter(pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        for origin, size in (host_pool_sizes or {}).items():
+            self.set_pool_size(origin, size)
+
+    def _adapter(self, pool_maxsize: int) -> HTTPAdapter:
+        return HTTPAdapter(pool_maxsize=pool_maxsize, **self._adapter_args)
+
+    def set_pool_size(self, origin: str, pool_maxsize: int) -> None:
+        """
+        Keep `pool_maxsize` connections open to `origin` (eg.
+        ``https://example.com``, or a bare host name for both http and
+        https), with an adapter of its own.
+        """
+        if '://' in origin:
+            prefixes = [origin.rstrip('/') + '/']
+        else:
+            prefixes = ['http://{}/'.format(origin),
+                        'https://{}/'.format(origin)]
+        adapter = self._adapter(pool_maxsize)
+        with self._mount_lock:
+            for prefix in prefixes:
+                old = self.session.adapters.get(prefix)
+                self.session.mount(prefix, adapter)
+                if old is not None:
+                    old.close()
+        logger.debug("Pool size of {} set to {}".format(origin, pool_maxsize))
+
+    def get(self, url: str, headers=None, **kwargs) -> requests.Response:
+        """
+        Get `url` through the cache (see `cache_get`, which gets all the
+        keyword args, on top of the defaults given to the constructor).
+        """
+        args = dict(self.defaults, **kwargs)
+        args.setdefault('get_meth', self.session.get)
+        return cache_get(self.cache, url, headers, **args)
+
+    def get_many(self, urls: Iterable[str], headers=None,
+                 **kwargs) -> Iterator[Tuple[str, Any]]:
+        """
+        Get several urls through the cache at once (see `cache_get_many`).
+        With a `per_host_limit` no greater than the pool sizes, every request
+        can re-use a pooled connection.
+        """
+        args = dict(self.defaults, **kwargs)
+        args.setdefault('get_meth', self.session.get)
+        return cache_get_many(self.cache, urls, headers, **args)
+
+    def close(self) -> None:
+        """
+        Close the session's connections (the cache is left open).
+        """
+        self.session.close()
+
+    def __enter__(self) -> 'CachedSession':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
@@ -0,0 +1,218 @@
+"""
+A `ShelfCache` split across several database files.
+
+Every write to a `ShelfCache` takes the exclusive lock on its single database,
+so writers serialize even when they touch unrelated keys. A
+`ShardedShelfCache` hashes each key to one of N `ShelfCache` shards (stored
+in `<db_path>.0`, `<db_path>.1`, ...), each with its own lock, so writers only
+contend when their keys land in the same shard:
+
+    >>> cache = ShardedShelfCache('cache.db', shards=8, exp_seconds=3600)
+    >>> cache['key'] = 'value'
+    >>> cache.get('key').data
+    'value'
+
+It offers the same API as `ShelfCache` (including the batch methods, which
+group keys by shard) except for :meth:`ShelfCache.transaction`, which cannot
+span shards. Operations on the whole cache (pruning, clearing, stats) run on
+the shards in parallel threads.
+
+A key is always mapped to the same shard (the CRC32 of its UTF-8 encoding
+modulo the number of shards), so every process must use the same number of
+shards for a given `db_path`.
+"""
+from .shelfcache import ShelfCache, CacheResult, Item
+from .record import ItemMeta
+from .stats import CacheStats
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import (Any, Callable, Dict, Iterable, List, Mapping, Optional,
+                    Tuple, TypeVar, Union)
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class ShardedShelfCache:
+    def __init__(self, db_path='shelfcache.db', shards: int=8,
+                 exp_seconds=-1, workers: Optional[int]=None,
+                 **kwargs) -> None:
+        """
+        :param db_path: Path prefix of the shard databases
+        :param shards: The number of shards
+        :param exp_seconds: The default expiry time to use for a cached item
+            (see `ShelfCache`)
+        :param workers: The number of threads used to run operations on every
+            shard (defaults to the number of shards)
+        :param kwargs: Passed to the `ShelfCache` of each shard (note that the
+            `max_items`, `max_bytes`, `memory_items` and `memory_bytes` limits
+            apply to each shard, while the shards share one `metrics`)
+        """
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        self.db_path = db_path
+        self.workers = workers or shards
+        metrics = kwargs.get('metrics')
+        if metrics is True:
+            metrics = kwargs['metrics'] = CacheStats()
+        self.metrics = metrics or None  # type: Optional[CacheStats]
+        self.shards = [ShelfCache('{}.{}'.format(db_path, i), exp_seconds,
+                                  **kwargs)
+                       for i in range(shards)]
+
+    @property
+    def exp_seconds(self) -> int:
+        return self.shards[0].exp_seconds
+
+    @exp_seconds.setter
+    def exp_seconds(self, value: int) -> None:
+        for shard in self.shards:
+            shard.exp_seconds = value
+
+    @property
+    def blob_threshold(self) -> int:
+        return self.shards[0].blob_threshold
+
+    def shard(self, key) -> ShelfCache:
+        """
+        Return the shard which stores `key`.
+        """
+        return self.shards[zlib.crc32(key.encode('utf-8')) % len(self.shards)]
+
+    def _group(self, keys: Iterable) -> Dict[int, List]:
+        groups = {}  # type: Dict[int, List]
+        for key in keys:
+            index = zlib.crc32(key.encode('utf-8')) % len(self.shards)
+            groups.setdefault(index, []).append(key)
+        return groups
+
+    def _map(self, fn: Callable[[ShelfCache], T]) -> List[T]:
+        """
+        Call `fn` on every shard, in parallel.
+        """
+        if len(self.shards) == 1 or self.workers == 1:
+            return [fn(shard) for shard in self.shards]
+        with ThreadPoolExecutor(min(self.workers, len(self.shards))) as pool:
+            return list(pool.map(fn, self.shards))
+
+    def close(self) -> None:
+        for shard in self.shards:
+            shard.close()
+
+    def __enter__(self) -> 'ShardedShelfCache':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    # Single items
+
+    def get(self, key) -> Optional[CacheResult]:
+        return self.shard(key).get(key)
+
+    def get_item(self, key) -> Optional[Item]:
+        return self.shard(key).get_item(key)
+
+    def meta(self, key) -> Optional[ItemMeta]:
+        return self.shard(key).meta(key)
+
+    def ttl(self, key) -> Optional[timedelta]:
+        return self.shard(key).ttl(key)
+
+    def is_fresh(self, key) -> bool:
+        return self.shard(key).is_fresh(key)
+
+    def __getitem__(self, key) -> CacheResult:
+        return self.shard(key)[key]
+
+    def create_or_update(self, key, data=None,
+                         expire_dt: Optional[datetime]=None,
+                         exp_seconds: Optional[int]=None) -> None:
+        self.shard(key).create_or_update(key, data, expire_dt, exp_seconds)
+
+    def __setitem__(self, key, value) -> None:
+        self.shard(key)[key] = value
+
+    def update(self, key, fn: Callable[[Any], Any], default: Any=None,
+               expire_dt: Optional[datetime]=None,
+               exp_seconds: Optional[int]=None) -> Any:
+        return self.shard(key).update(key, fn, default, expire_dt,
+                                      exp_seconds)
+
+    def incr(self, key, n: int=1, initial: int=0) -> int:
+        return self.shard(key).incr(key, n, initial)
+
+    def compare_and_set(self, key, expected_version: int, data=None,
+                        expire_dt: Optional[datetime]=None,
+                        exp_seconds: Optional[int]=None) -> bool:
+        return self.shard(key).compare_and_set(key, expected_version, data,
+                                               expire_dt, exp_seconds)
+
+    def update_expires(self, key, expire_dt: Optional[datetime]=None) -> None:
+        self.shard(key).update_expires(key, expire_dt)
+
+    def replace_data(self, key, data: Optional[object]=None) -> None:
+        self.shard(key).replace_data(key, data)
+
+    def delete(self, key: str) -> None:
+        self.shard(key).delete(key)
+
+    def __delitem__(self, key) -> None:
+        self.delete(key)
+
+    # Batches (one lock acquisition per shard)
+
+    def get_many(self, keys: Iterable) -> Dict[Any, CacheResult]:
+        results = {}  # type: Dict[Any, CacheResult]
+        for index, group in self._group(keys).items():
+            results.update(self.shards[index].get_many(group))
+        return results
+
+    def set_many(self, items: Union[Mapping, Iterable[Tuple[Any, Any]]],
+                 expire_dt: Optional[datetime]=None,
+                 exp_seconds: Optional[int]=None) -> None:
+        if isinstance(items, Mapping):
+            items = items.items()
+        data = dict(items)
+        for index, group in self._group(data).items():
+            self.shards[index].set_many([(key, data[key]) for key in group],
+                                        expire_dt, exp_seconds)
+
+    def delete_many(self, keys: Iterable) -> int:
+        return sum(self.shards[index].delete_many(group)
+                   for index, group in self._group(keys).items())
+
+    # Whole cache (shards in parallel)
+
+    def prune_expired(self, older_than: Optional[datetime]=None) -> int:
+        if older_than is None:
+            older_than = datetime.utcnow()
+        return sum(self._map(lambda shard: shard.prune_expired(older_than)))
+
+    def prune_old(self, older_than: Optional[datetime]=None) -> int:
+        if older_than is None:
+            older_than = datetime.utcnow()
+        return sum(self._map(lambda shard: shard.prune_old(older_than)))
+
+    def clear(self) -> None:
+        self._map(ShelfCache.clear)
+
+    def stats(self) -> Dict[str, Any]:
+        totals = {}  # type: Dict[str, Any]
+        for stats in self._map(ShelfCache._content_stats):
+            for name, value in stats.items():
+                totals[name] = totals.get(name, 0) + value
+        if self.metrics is not None:
+            totals.update(self.metrics.snapshot())
+        return totals
+
+    def expiring(self, within: timedelta,
+                 now: Optional[datetime]=None) -> List[Any]:
+        if now is None:
+            now = datetime.utcnow()
+        return [key for keys in self._map(
+                    lambda shard: shard.expiring(within, now))
+                for key in keys]
@@ -8,23 +8,86 @@ ShelfCache will always return the cached data along with a boolean indicating
 whether it is expired or not. Application code can then decide what to do with
 the data.
 
-No automatic database size management is done while saving or retrieving values,
-but applications/scripts can make use of the :meth:`prune_expired`,
-:meth:`prune_old`, and :meth:`clear` methods to delete old items.
+By default no automatic database size management is done while saving or
+retrieving values, but applications/scripts can make use of the
+:meth:`prune_expired`, :meth:`prune_old`, and :meth:`clear` methods to delete
+old items. With `index=True` a sidecar metadata index is maintained so that
+pruning (and :meth:`stats`) do not need to read every item.
+
+Setting `max_items` and/or `max_bytes` bounds the cache instead: every write
+which takes the cache over a limit evicts just enough items to get back under
+it, chosen by the eviction `policy` ('lru', 'lfu' or 'ttl'). The bookkeeping
+(item sizes, and the recency and frequency of reads) is kept in the metadata
+index, so evicting never requires reading the cached items.
+
+Items are stored with their metadata in a small header in front of the
+serialized data (see the `record` module), so that :meth:`meta`, :meth:`ttl`
+and :meth:`is_fresh` never deserialize the cached data. Databases written by
+older versions (which pickled whole `Item` objects) are still read. With
+`compression` set, large values are compressed (each record says how, so
+compressed and uncompressed records can be mixed). The data is pickled unless
+another `serializer` is given (see the `serializers` module); with the `Raw`
+serializer, :meth:`get_bytes` returns cached bytes without copying them. With
+a `blob_threshold`, large binary values are stored once each in separate files
+(see the `blobs` module) instead of in the database.
 
 Caching to disk is handled by a locking wrapper around the standard library's
-`Shelf <https://docs.python.org/3/library/shelve.html>`_ class. Two
+`Shelf <https://docs.python.org/3/library/shelve.html>`_ class. Three
 implementations of the wrapper are included in the `locked_shelf` module:
-`MutexShelf` and the flock-based `RWShelf` (which is used by ShelfCache by
-default).
+`MutexShelf`, the flock-based `RWShelf` (which is used by ShelfCache by
+default) and `RWLockShelf`, based on an in-process reader-writer lock. The
+`sqlite_shelf` module provides `SqliteShelf`, which stores the shelf in an
+SQLite database in WAL mode so that readers don't wait for writers, and the
+`log_shelf` module `LogShelf`, which replaces dbm with an append-only log read
+through `mmap`.
+
+By default the database is opened (and the lock acquired) anew for every
+operation. Passing `persistent=True` keeps a single `ShelfHandle` open instead,
+which avoids the per-operation setup cost while still seeing writes made by
+other processes.
+
+Setting `memory_items` and/or `memory_bytes` adds a bounded in-process LRU
+tier in front of the database: repeated reads of a key are served from memory
+until any process writes to the database.
+
+Expired items can also be deleted in the background (a few at a time, so the
+lock is never held for long) with :meth:`start_pruner`.
+
+The :meth:`get_many`, :meth:`set_many` and :meth:`delete_many` methods (and the
+:meth:`transaction` context manager) group many operations under a single lock
+acquisition, and :meth:`update`, :meth:`incr` and :meth:`compare_and_set` read
+and modify an item atomically.
+
+With `metrics` set, the cache counts its hits, misses, evictions and the bytes
+it reads and writes, and times its lock waits and deserializations (see the
+`stats` module); :meth:`stats` reports them along with its contents.
 
 For a similar approach (for Python 2) -- which implements caching on top of a
 locking wrapper around the shelve library -- see Doug Hellmann's feedcache
 package/article: http://feedcache.readthedocs.io/en/latest/
 """
-from .locked_shelf import LockedShelf, RWShelf
+from .locked_shelf import LockedShelf, RWShelf, ShelfHandle, Generation
+from .memory import MemoryTier
+from .index import MetaIndex, POLICIES
+from .pruner import Pruner
+from .record import ItemMeta
+from .serializers import Encoder, Pickle
+from .blobs import BlobStore
+from .stats import CacheStats
+from . import blobs
+from . import record
+from . import serializers
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from functools import partial
 from datetime import datetime, timedelta
-from typing import Type, Optional, NamedTuple, Any
+from typing import (Type, Optional, NamedTuple, Any, Iterator, Iterable,
+                    ContextManager, Tuple, Dict, Mapping, Union, List,
+                    Callable)
+import shelve
+import pickle
+import threading
+import time
 import logging
 
 logger = logging.getLogger(__name__)
@@ -40,78 +103,680 @@ The type returned when getting an item from the cache.
 """
 
 
+_PICKLE = Pickle()
+
+
 class Item:
-    """A wrapper class so we can add metadata to items stored in cache."""
+    """
+    A wrapper class so we can add metadata to items stored in cache.
+
+    Items read from the database keep their data serialized until the `data`
+    attribute is first accessed, so their metadata can be inspected without
+    paying for deserializing the data.
+    """
     def __init__(self, data, expire_dt: Optional[datetime]=None) -> None:
         """
         :ivar created_dt: The date the item was first cached
         :ivar update_dt: The date the item was last updated in cache
+        :ivar version: The number of times the item has been written
 
         :param data: The object to wrap (can be any pickle-able object)
         :param expire_dt: The date the item expires (None means the item never
             expires)
         """
         now = datetime.utcnow()
-        self.data = data
+        self._data = data
+        self._payload = None  # type: Optional[memoryview]
+        self._blobs = None  # type: Optional[BlobStore]
+        self._metrics = None  # type: Optional[CacheStats]
+        self.codec = record.PICKLE
         self.created_dt = now
         self.updated_dt = now
         self.expire_dt = expire_dt
+        self.version = 0
+
+    @classmethod
+    def from_record(cls, raw: bytes,
+                    blob_store: Optional[BlobStore]=None,
+                    metrics: Optional[CacheStats]=None) -> 'Item':
+        """
+        Build an item from a stored record (see the `record` module) without
+        deserializing its data.
+
+        :param blob_store: Where the large values of the item are stored (if
+            it was written with a `blob_threshold`)
+        :param metrics: Where to record how long deserializing the data takes
+        """
+        meta, codec, offset = record.unpack_meta(raw)
+        item = cls.__new__(cls)
+        item._data = None
+        item._payload = memoryview(raw)[offset:]
+        item._blobs = blob_store
+        item._metrics = metrics
+        item.codec = codec
+        item.created_dt, item.updated_dt, item.expire_dt = meta[:3]
+        item.version = meta.version
+        return item
+
+    @property
+    def data(self) -> Any:
+        payload = self._payload
+        if payload is not None:
+            if self._metrics is not None:
+                start = time.perf_counter()
+            payload = record.decompress(self.codec, payload)
+            if self.codec & 0x0f == serializers.BLOBS:
+                if self._blobs is None:
+                    raise ValueError("Item has blobs but no blob store")
+                self._data = blobs.loads(payload, self._blobs)
+            else:
+                self._data = serializers.loads(self.codec, payload)
+            self._payload = None
+            if self._metrics is not None:
+                self._metrics.observe('deserialize',
+                                      time.perf_counter() - start)
+        return self._data
+
+    @data.setter
+    def data(self, value) -> None:
+        self._data = value
+        self._payload = None
+
+    def view(self) -> memoryview:
+        """
+        Return the item's data as a memoryview, without copying it if it was
+        stored with the `Raw` serializer (and not compressed). Raises a
+        TypeError if the data is not a bytes-like object.
+        """
+        payload = self._payload
+        if payload is not None and self.codec == serializers.RAW:
+            return payload
+        return memoryview(self.data)
+
+    def to_record(self, protocol: Optional[int]=None,
+                  compression: Optional[str]=None,
+                  compress_threshold: int=0,
+                  serializer: Optional[Encoder]=None,
+                  blob_store: Optional[BlobStore]=None,
+                  blob_threshold: int=0) -> bytes:
+        """
+        Serialize the item with `serializer` (by default, pickle it with
+        `protocol`) unless the data was never deserialized, in which case its
+        stored payload is re-used. The payload is compressed with
+        `compression` if it is at least `compress_threshold` bytes long.
+
+        If the data is pickled and `blob_threshold` is set, its binary values
+        of at least `blob_threshold` bytes are stored in `blob_store`.
+        """
+        payload = self._payload
+        if payload is None:
+            if serializer is None:
+                serializer = _PICKLE
+            if (blob_threshold and blob_store is not None and
+                    isinstance(serializer, Pickle)):
+                if serializer.protocol is not None:
+                    protocol = serializer.protocol
+                spilled, payload = blobs.dumps(self._data, blob_store,
+                                               blob_threshold, protocol)
+                self.codec = serializers.BLOBS if spilled else record.PICKLE
+            else:
+                self.codec, payload = serializer.encode(self._data, protocol)
+            if compression is not None and len(payload) >= compress_threshold:
+                self.codec, payload = record.compress(self.codec, payload,
+                                                      compression)
+        return record.pack(self.created_dt, self.updated_dt, self.expire_dt,
+                           self.codec, payload, self.version)
+
+    @property
+    def meta(self) -> ItemMeta:
+        return ItemMeta(self.created_dt, self.updated_dt, self.expire_dt, 0,
+                        self.version)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Pickled with the same layout as older versions
+        return {'data': self.data, 'created_dt': self.created_dt,
+                'updated_dt': self.updated_dt, 'expire_dt': self.expire_dt,
+                'version': self.version}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        state = dict(state)
+        self._data = state.pop('data', None)
+        self._payload = None
+        self._blobs = None
+        self._metrics = None
+        self.codec = record.PICKLE
+        self.version = 0
+        self.__dict__.update(state)
+
+
+class _Transaction:
+    """The shelf opened by a thread's transaction and the keys it touched."""
+    def __init__(self, shelf: shelve.Shelf) -> None:
+        self.shelf = shelf
+        self.keys = set()  # type: Optional[set]
+
+    def touch(self, keys: Optional[Iterable]) -> None:
+        if keys is None:
+            self.keys = None
+        elif self.keys is not None:
+            self.keys.update(keys)
 
 
 class ShelfCache:
     def __init__(self, db_path='shelfcache.db', exp_seconds=-1, shelf_t:
-                 Type[LockedShelf]=RWShelf) -> None:
+                 Type[LockedShelf]=RWShelf, persistent: bool=False,
+                 memory_items: int=0, memory_bytes: int=0,
+                 index: bool=False, max_items: int=0, max_bytes: int=0,
+                 policy: str='lru', compression: Optional[str]=None,
+                 compress_threshold: int=1024,
+                 serializer: Optional[Encoder]=None,
+                 blob_threshold: int=0, blob_collect_every: int=10,
+                 metrics: Union[bool, CacheStats]=False) -> None:
         """
         :param db_path: Path to database (where it will be created if necessary)
         :param exp_seconds: The default expiry time to use for a cached item (in
             seconds). This can be overridden per-item in `create_or_update`. A
             negative number means the item will never expire.
         :param shelf_t: The type of shelf to use (any sublcass of `LockedShelf`,
-            ie `MutexShelf` or `RWShelf`)
+            ie `MutexShelf`, `RWShelf`, `RWLockShelf`, `SqliteShelf` or
+            `LogShelf`)
+        :param persistent: Keep the database and lock file open between
+            operations (see :class:`ShelfHandle`) instead of opening them for
+            every call. Only supported with the flock-based `RWShelf`. Call
+            :meth:`close` (or use the cache as a context manager) when done.
+        :param memory_items: Keep up to this many recently read items in an
+            in-process LRU tier in front of the database (see
+            :class:`MemoryTier`). 0 means no limit if `memory_bytes` is set.
+        :param memory_bytes: Limit the memory tier to this many (serialized)
+            bytes. The memory tier is disabled if both limits are 0.
+        :param index: Maintain a sidecar index of every item's metadata (see
+            :class:`MetaIndex`), which lets :meth:`prune_expired`,
+            :meth:`prune_old`, :meth:`stats` and :meth:`expiring` run without
+            reading the cached items. Once created, the index is kept up to
+            date by every ShelfCache writing to the database.
+        :param max_items: Evict items whenever the cache holds more than this
+            many (0 means no limit). Implies `index=True`.
+        :param max_bytes: Evict items whenever they take up more than this
+            many bytes in the database (0 means no limit). Implies
+            `index=True`. Note that how soon the space freed by deleted items
+            is reused depends on the dbm implementation.
+        :param policy: Which items to evict first: the least recently used
+            ('lru'), the least frequently used ('lfu'), or the ones closest to
+            expiring ('ttl'). See :meth:`MetaIndex.victims`.
+        :param compression: Compress the serialized data of the items written
+            with 'zlib', 'lzma' or 'bz2' (None means no compression). Items
+            are decompressed on read whatever this setting, so caches with
+            different settings can share a database.
+        :param compress_threshold: Only compress data which serializes to at
+            least this many bytes
+        :param serializer: How to serialize the data of the items written
+            (see the `serializers` module). By default they are pickled with
+            the shelf's protocol. Items are read with the serializer which
+            wrote them, whatever this setting.
+        :param blob_threshold: Store the binary values (bytes, bytearray or
+            memoryview objects) of at least this many bytes found in pickled
+            data in separate, content-addressed files in the `<db_path>.blobs`
+            directory (see the `blobs` module). 0 means never. Note that the
+            `max_bytes` limit does not count the size of the blobs.
+        :param blob_collect_every: When `blob_threshold` is set, delete the
+            blobs which no item refers to any more (see
+            :meth:`collect_blobs`) on the first prune and then every this
+            many prunes. 0 means only when `collect_blobs` is called.
+        :param metrics: Count hits, misses, evictions and bytes, and time
+            lock waits and deserializations (see the `stats` module). True
+            for a `CacheStats` of the cache's own, or one to share with other
+            caches.
         """
+        if policy not in POLICIES:
+            raise ValueError("Unknown eviction policy: {}".format(policy))
+        if compression is not None and compression not in record.COMPRESSORS:
+            raise ValueError("Unknown compression: {}".format(compression))
         self.db_path = db_path
         self.exp_seconds = exp_seconds
         self.shelf_t = shelf_t
+        self._handle = None  # type: Optional[ShelfHandle]
+        if persistent:
+            self._handle = self._make_handle()
+        # (SqliteShelf keeps the counter in the database itself)
+        self._generation = getattr(shelf_t, 'generation_t', Generation)(
+            db_path)
+        self._memory = None  # type: Optional[MemoryTier]
+        self._local = threading.local()
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.serializer = serializer
+        self.blob_threshold = blob_threshold
+        self.blob_store = BlobStore(db_path + '.blobs')
+        self.blob_collect_every = blob_collect_every
+        self._prunes = 0
+        self._prunes_lock = threading.Lock()
+        if metrics is True:
+            metrics = CacheStats()
+        self.metrics = metrics or None  # type: Optional[CacheStats]
+        # Reads served by the memory tier, not yet recorded in the index
+        self._accessed = Counter()  # type: Counter
+        self._accessed_lock = threading.Lock()
+        self._pruner = None  # type: Optional[Pruner]
+        self._index = MetaIndex(db_path)
+        if (index or self._bounded) and not self._index.exists():
+            self._build_index()
+        if memory_items or memory_bytes:
+            self._generation.create()
+            self._memory = MemoryTier(memory_items, memory_bytes)
 
-    def get(self, key) -> Optional[CacheResult]:
+    def _make_handle(self) -> ShelfHandle:
+        if not issubclass(self.shelf_t, RWShelf):
+            raise ValueError("persistent mode requires shelf_t=RWShelf")
+        return ShelfHandle(self.db_path)
+
+    def _open(self, flag: str='r') -> ContextManager[shelve.Shelf]:
         """
-        Get item from database and check if it is expired.
+        Lock and open the database, either through the persistent handle or
+        by instantiating `shelf_t` (or reuse the shelf already opened by the
+        current thread's transaction).
+        """
+        if self._transaction is not None:
+            return nullcontext(self._transaction.shelf)
+        if self._handle is not None:
+            opener = partial(self._handle.open, flag)
+        else:
+            opener = partial(self.shelf_t, self.db_path, flag=flag)
+        if self.metrics is not None:
+            # The lock is taken when the shelf is created (or the handle's
+            # context entered)
+            return self.metrics.timed_open('lock_wait', opener)
+        return opener()
+
+    @contextmanager
+    def session(self) -> Iterator['ShelfCache']:
+        """
+        Use a persistent handle for the duration of a `with` block (if the
+        cache was not already created with `persistent=True`):
+
+            >>> with cache.session():
+            >>>     for key in keys:
+            >>>         cache[key] = compute(key)
+        """
+        if self._handle is not None:
+            yield self
+            return
+        self._handle = self._make_handle()
+        try:
+            yield self
+        finally:
+            handle, self._handle = self._handle, None
+            handle.close()
+
+    def close(self) -> None:
+        """
+        Stop the background pruner and close the persistent handle, if any.
+        """
+        if self._pruner is not None:
+            self._pruner.stop()
+            self._pruner = None
+        if self._handle is not None:
+            self._handle.close()
+        self._generation.close()
+        self._index.close()
+
+    def __enter__(self) -> 'ShelfCache':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def _load(self, shelf, key) -> Tuple[Optional[Item], int]:
+        """
+        Read the item stored for `key` from an open shelf, returning it along
+        with its size on disk (0 if the shelf does not expose its raw dbm).
+        """
+        if isinstance(shelf, shelve.Shelf):
+            raw = shelf.dict.get(key.encode(shelf.keyencoding))
+            if raw is None:
+                return None, 0
+            if self.metrics is not None:
+                self.metrics.incr('bytes_read', len(raw))
+            if record.is_record(raw):
+                return (Item.from_record(raw, self.blob_store, self.metrics),
+                        len(raw))
+            return pickle.loads(raw), len(raw)
+        return shelf.get(key), 0
+
+    @staticmethod
+    def _load_meta(shelf, key) -> Optional[ItemMeta]:
+        """
+        Read the metadata of the item stored for `key` from an open shelf,
+        without deserializing its data (unless it was written by an older
+        version).
+        """
+        if isinstance(shelf, shelve.Shelf):
+            raw = shelf.dict.get(key.encode(shelf.keyencoding))
+            if raw is None:
+                return None
+            if record.is_record(raw):
+                return record.unpack_meta(raw)[0]
+            return pickle.loads(raw).meta._replace(size=len(raw))
+        item = shelf.get(key)
+        return item.meta if item is not None else None
+
+    def _dump(self, shelf, key, item: Item) -> int:
+        """
+        Write `item` for `key` to an open shelf, returning its size on disk (0
+        if the shelf does not expose its raw dbm).
+        """
+        if isinstance(shelf, shelve.Shelf):
+            raw = item.to_record(shelf._protocol, self.compression,
+                                 self.compress_threshold, self.serializer,
+                                 self.blob_store, self.blob_threshold)
+            shelf.dict[key.encode(shelf.keyencoding)] = raw
+            if self.metrics is not None:
+                self.metrics.incr('bytes_written', len(raw))
+            return len(raw)
+        shelf[key] = item
+        return 0
+
+    @property
+    def _bounded(self) -> bool:
+        return bool(self.max_items or self.max_bytes)
+
+    def _record_access(self, keys: Iterable=(), locked: bool=True) -> None:
+        """
+        Record reads of `keys` in the index (if the eviction policy depends
+        on them). Reads which don't take the database lock (`locked=False`)
+        are only counted, and recorded along with the next locked operation.
+        """
+        if not self._bounded or self.policy == 'ttl':
+            return
+        with self._accessed_lock:
+            self._accessed.update(keys)
+            if not locked or not self._accessed:
+                return
+            hits, self._accessed = self._accessed, Counter()
+        self._index.access(hits, datetime.utcnow())
+
+    def _lookup_many(self, keys: Iterable) -> Dict[Any, Item]:
+        """
+        Get the items for `keys` from the memory tier if it is enabled and up
+        to date, and the rest from the database (under a single lock).
         """
+        found = {}  # type: Dict[Any, Item]
+        keys = missing = list(keys)
+        in_transaction = self._transaction is not None
+        use_memory = self._memory is not None and not in_transaction
+        if use_memory:
+            generation = self._generation.read()
+            missing = []
+            for key in keys:
+                item = self._memory.get(key, generation)
+                if item is None:
+                    missing.append(key)
+                else:
+                    found[key] = item
+            if not missing:
+                self._record_access(list(found), locked=False)
+                return found
         try:
-            with self.shelf_t(self.db_path, flag='r') as shelf:
-                val = shelf.get(key)  # type: Optional[Item]
-                if val is not None:
-                    now = datetime.utcnow()
-                    if val.expire_dt is None:
-                        expired = False
-                    else:
-                        expired = val.expire_dt < now
-                    return CacheResult(data=val.data, expired=expired)
+            with self._open('r') as shelf:
+                if use_memory:
+                    generation = self._generation.read()
+                for key in missing:
+                    item, nbytes = self._load(shelf, key)
+                    if item is None:
+                        continue
+                    found[key] = item
+                    if use_memory:
+                        self._memory.put(key, item, nbytes, generation)
+                self._record_access(list(found))
         except FileNotFoundError:
             logger.info("Cache db file does not exist at {}"
                         .format(self.db_path))
-        return None
+        return found
+
+    def _lookup(self, key) -> Optional[Item]:
+        return self._lookup_many([key]).get(key)
+
+    @property
+    def _transaction(self) -> Optional['_Transaction']:
+        return getattr(self._local, 'transaction', None)
+
+    @contextmanager
+    def _write(self, keys: Optional[Iterable]=None) -> Iterator[shelve.Shelf]:
+        """
+        Open the database for writing, and keep the memory tier (if any)
+        consistent with the modification of `keys` (None means any key may be
+        modified).
+        """
+        transaction = self._transaction
+        if transaction is not None:
+            transaction.touch(keys)
+            yield transaction.shelf
+            return
+        with self._open('c') as shelf:
+            seen = None
+            if self._memory is not None:
+                seen = self._generation.read()
+            modified = keys
+            try:
+                yield shelf
+                modified = None  # until we know which keys were evicted
+                evicted = self._evict(shelf, keys)
+                if keys is not None:
+                    modified = list(keys) + evicted
+            finally:
+                if self._memory is not None:
+                    self._memory.written(seen, modified)
+
+    def _evict(self, shelf, keep: Optional[Iterable]=()) -> List:
+        """
+        If the cache is over its size limits, delete items (preferably not
+        the ones in `keep`, which were just written) according to the eviction
+        policy. Must be called while holding the exclusive lock.
+
+        Returns:
+            The keys which were evicted.
+        """
+        if not self._bounded or not self._index.refresh():
+            return []
+        self._record_access()
+        self._index.refresh()
+        count = nbytes = 0
+        if self.max_items:
+            count = len(self._index) - self.max_items
+        if self.max_bytes:
+            nbytes = self._index.total_size() - self.max_bytes
+        victims = []  # type: List
+        if count > 0 or nbytes > 0:
+            victims = self._index.victims(self.policy, count, nbytes,
+                                          keep or ())
+            for key in victims:
+                try:
+                    del shelf[key]
+                except KeyError:
+                    pass
+                self._index.delete(key)
+            logger.info("Evicted {} items ({})".format(len(victims),
+                                                       self.policy))
+            if self.metrics is not None:
+                self.metrics.incr('evictions', len(victims))
+            self._index.refresh()
+        self._index.compact()
+        return victims
+
+    @contextmanager
+    def transaction(self) -> Iterator['ShelfCache']:
+        """
+        Hold the exclusive lock for the duration of a `with` block, so that
+        every operation made on this cache by the current thread inside the
+        block uses the same open database, and other threads and processes
+        see the whole group of operations at once:
+
+            >>> with cache.transaction():
+            >>>     count = cache['count'].data
+            >>>     cache['count'] = count + 1
+
+        Note that there is no rollback: if the block raises an exception, the
+        writes made before it are kept.
+        """
+        if self._transaction is not None:
+            yield self
+            return
+        with self._open('c') as shelf:
+            transaction = _Transaction(shelf)
+            seen = None
+            if self._memory is not None:
+                seen = self._generation.read()
+            self._local.transaction = transaction
+            try:
+                yield self
+            finally:
+                self._local.transaction = None
+                modified = None
+                try:
+                    evicted = self._evict(shelf, transaction.keys)
+                    if transaction.keys is not None:
+                        modified = list(transaction.keys) + evicted
+                finally:
+                    if self._memory is not None:
+                        self._memory.written(seen, modified)
+
+    @staticmethod
+    def _result(item: Item) -> CacheResult:
+        if item.expire_dt is None:
+            expired = False
+        else:
+            expired = item.expire_dt < datetime.utcnow()
+        return CacheResult(data=item.data, expired=expired)
+
+    def _count_results(self, results: Iterable[CacheResult],
+                       misses: int) -> None:
+        hits = stale = 0
+        for result in results:
+            if result.expired:
+                stale += 1
+            else:
+                hits += 1
+        for name, n in (('hits', hits), ('stale_hits', stale),
+                        ('misses', misses)):
+            if n:
+                self.metrics.incr(name, n)
+
+    def get(self, key) -> Optional[CacheResult]:
+        """
+        Get item from database and check if it is expired.
+
+        When the memory tier is enabled, the returned data may be shared with
+        other callers and should be treated as read-only.
+        """
+        val = self._lookup(key)
+        result = self._result(val) if val is not None else None
+        if self.metrics is not None:
+            self._count_results([result] if result else [], result is None)
+        return result
+
+    def get_many(self, keys: Iterable) -> Dict[Any, CacheResult]:
+        """
+        Like :meth:`get` for several keys at once, but only acquires the lock
+        once. Keys which are not in the cache are left out of the returned
+        dictionary.
+        """
+        keys = list(keys)
+        items = self._lookup_many(keys)
+        results = {key: self._result(item) for key, item in items.items()}
+        if self.metrics is not None:
+            self._count_results(results.values(),
+                                len(set(keys)) - len(results))
+        return results
 
     def get_item(self, key) -> Optional[Item]:
         """
         Get item from database. Like get(), but return an Item (with all
         metadata) instead of the simpler CacheResult.
         """
+        return self._lookup(key)
+
+    def get_bytes(self, key) -> Optional[memoryview]:
+        """
+        Get the data cached for `key` (whether expired or not) as a
+        memoryview, or None if there is no such item. Data stored with the
+        `Raw` serializer is returned without being copied (the view is
+        read-only). Raises a TypeError if the data is not bytes-like.
+        """
+        item = self._lookup(key)
+        return item.view() if item is not None else None
+
+    def meta(self, key) -> Optional[ItemMeta]:
+        """
+        Get the metadata of the item cached for `key` (or None if there is no
+        such item) without deserializing its data. If the metadata index is
+        enabled the item is not read at all.
+        """
         try:
-            with self.shelf_t(self.db_path, flag='r') as shelf:
-                val = shelf.get(key)  # type: Optional[Item]
-                return val
+            with self._open('r') as shelf:
+                if self._index.refresh():
+                    return self._index.entry(key)
+                return self._load_meta(shelf, key)
         except FileNotFoundError:
             logger.info("Cache db file does not exist at {}"
                         .format(self.db_path))
         return None
 
+    def ttl(self, key) -> Optional[timedelta]:
+        """
+        Return the time left before the item cached for `key` expires
+        (negative if it has already expired), or None if it never expires.
+        Raises a KeyError if there is no such item.
+        """
+        meta = self.meta(key)
+        if meta is None:
+            raise KeyError(key)
+        if meta.expire_dt is None:
+            return None
+        return meta.expire_dt - datetime.utcnow()
+
+    def is_fresh(self, key) -> bool:
+        """
+        Return True if an item is cached for `key` and it has not expired.
+        """
+        meta = self.meta(key)
+        if meta is None:
+            return False
+        return meta.expire_dt is None or meta.expire_dt >= datetime.utcnow()
+
     def __getitem__(self, key) -> CacheResult:
         val = self.get(key)
         if val is None:
             raise KeyError(key)
         return val
 
+    def _put(self, shelf, key, item: Item) -> None:
+        nbytes = self._dump(shelf, key, item)
+        self._index.put(key, item.created_dt, item.updated_dt, item.expire_dt,
+                        nbytes, item.version)
+
+    def _store(self, shelf, key, data, expire_dt: Optional[datetime]=None,
+               exp_seconds: Optional[int]=None) -> Item:
+        item = Item(data=data)
+        if expire_dt is None and exp_seconds and exp_seconds > -1:
+            expire_dt = item.created_dt + timedelta(seconds=exp_seconds)
+        item.expire_dt = expire_dt
+
+        prev = self._load_meta(shelf, key)
+        if prev is not None:
+            # If this item already exists, preserve its created_dt and
+            # update its updated_dt
+            item.created_dt = prev.created_dt
+            item.updated_dt = datetime.utcnow()
+            item.version = prev.version + 1
+            logger.info("Updated item for key: {}".format(key))
+        else:
+            item.version = 1
+            logger.info("Created item for key: {}".format(key))
+        self._put(shelf, key, item)
+        return item
+
     def create_or_update(self, key, data=None,
                          expire_dt: Optional[datetime]=None,
                          exp_seconds: Optional[int]=None) -> None:
@@ -126,23 +791,89 @@ class ShelfCache:
         :param data: The data to cache (can be any pickle-able object)
         :param expire_dt: The date the cached item expires.
         :param exp_seconds: The number of seconds into the future that the
-            cached item expires.
+            cached item expires (0 or a negative number means never).
         """
-        item = Item(data=data)
-        if expire_dt is None and exp_seconds and exp_seconds > -1:
-            expire_dt = item.created_dt + timedelta(seconds=exp_seconds)
-        item.expire_dt = expire_dt
+        with self._write([key]) as shelf:
+            self._store(shelf, key, data, expire_dt, exp_seconds)
+
+    def set_many(self, items: Union[Mapping, Iterable[Tuple[Any, Any]]],
+                 expire_dt: Optional[datetime]=None,
+                 exp_seconds: Optional[int]=None) -> None:
+        """
+        Like :meth:`create_or_update` for several items at once, but only
+        acquires the lock once.
+
+        :param items: A mapping (or an iterable of (key, data) pairs) of the
+            data to cache
+        :param expire_dt: The date the cached items expire.
+        :param exp_seconds: The number of seconds into the future that the
+            cached items expire.
+        """
+        if isinstance(items, Mapping):
+            items = items.items()
+        items = list(items)
+        with self._write([key for key, _ in items]) as shelf:
+            for key, data in items:
+                self._store(shelf, key, data, expire_dt, exp_seconds)
+
+    def update(self, key, fn: Callable[[Any], Any], default: Any=None,
+               expire_dt: Optional[datetime]=None,
+               exp_seconds: Optional[int]=None) -> Any:
+        """
+        Atomically replace the data cached for `key` with `fn(data)` (or
+        `fn(default)` if there is no such item): the read and the write are
+        made under a single exclusive lock, so no other writer can slip in
+        between.
+
+        The item keeps its expiry datetime unless `expire_dt` or `exp_seconds`
+        is given (as in :meth:`create_or_update`).
 
-        with self.shelf_t(self.db_path, flag='c') as shelf:
-            if key in shelf.keys():
-                # If this item already exists, preserve its created_dt and
-                # update its updated_dt
-                item.created_dt = shelf.get(key).created_dt
-                item.updated_dt = datetime.utcnow()
-                logger.info("Updated item for key: {}".format(key))
+        Returns:
+            The new data.
+        """
+        with self._write([key]) as shelf:
+            item, _ = self._load(shelf, key)
+            if item is None:
+                data = default
             else:
-                logger.info("Created item for key: {}".format(key))
-            shelf[key] = item
+                data = item.data
+                if expire_dt is None and exp_seconds is None:
+                    expire_dt = item.expire_dt
+            data = fn(data)
+            self._store(shelf, key, data, expire_dt, exp_seconds)
+        return data
+
+    def incr(self, key, n: int=1, initial: int=0) -> int:
+        """
+        Atomically add `n` to the number cached for `key` (which is created
+        with the value `initial` if it doesn't exist yet).
+
+        Returns:
+            The new value.
+        """
+        return self.update(key, lambda value: value + n, default=initial)
+
+    def compare_and_set(self, key, expected_version: int, data=None,
+                        expire_dt: Optional[datetime]=None,
+                        exp_seconds: Optional[int]=None) -> bool:
+        """
+        Store `data` for `key` (like :meth:`create_or_update`) only if the
+        cached item's version is still `expected_version` (see
+        :meth:`meta`). A key which is not in the cache has version 0, so
+        `compare_and_set(key, 0, data)` only creates new items.
+
+        Returns:
+            True if the data was stored, False if the item had been modified.
+        """
+        with self._write([key]) as shelf:
+            prev = self._load_meta(shelf, key)
+            version = prev.version if prev is not None else 0
+            if version != expected_version:
+                logger.info("Version mismatch for key: {} ({} != {})"
+                            .format(key, version, expected_version))
+                return False
+            self._store(shelf, key, data, expire_dt, exp_seconds)
+        return True
 
     def __setitem__(self, key, value) -> None:
         """
@@ -157,38 +888,103 @@ class ShelfCache:
         """
         if expire_dt is None:
             expire_dt = datetime.utcnow()
-        d, _ = self[key]
-        self.create_or_update(key, data=d, expire_dt=expire_dt)
+        with self._write([key]) as shelf:
+            item, _ = self._load(shelf, key)
+            if item is None:
+                raise KeyError(key)
+            # The data is stored again as is, without being deserialized
+            item.expire_dt = expire_dt
+            item.updated_dt = datetime.utcnow()
+            item.version += 1
+            self._put(shelf, key, item)
 
     def replace_data(self, key, data: Optional[object]=None) -> None:
         """
         Update a cached item's data without affecting its expire_dt.
         """
-        item = self.get_item(key)
-        self.create_or_update(key, data=data, expire_dt=item.expire_dt)
+        with self._write([key]) as shelf:
+            prev = self._load_meta(shelf, key)
+            if prev is None:
+                raise KeyError(key)
+            self._store(shelf, key, data, expire_dt=prev.expire_dt)
 
     def delete(self, key: str) -> None:
         """
         Delete `key` from cache database.
         """
-        with self.shelf_t(self.db_path, flag='c') as shelf:
+        with self._write([key]) as shelf:
             del shelf[key]
+            self._index.delete(key)
             logger.info("Deleted item for key: {}".format(key))
 
     def __delitem__(self, key) -> None:
         self.delete(key)
 
-    def __prune(self, dt: datetime, field_name='expire_dt') -> int:
-        keys_to_delete = []
-        with self.shelf_t(self.db_path, flag='c') as shelf:
-            for key, item in shelf.items():
-                exp_d = getattr(item, field_name)
-                if exp_d < dt:
-                    keys_to_delete.append(key)
+    def delete_many(self, keys: Iterable) -> int:
+        """
+        Delete several keys from the cache database under a single lock. Keys
+        which are not in the cache are ignored.
+
+        Returns:
+            The number of items that were deleted.
+        """
+        keys = list(keys)
+        count = 0
+        with self._write(keys) as shelf:
+            for key in keys:
+                if key in shelf:
+                    del shelf[key]
+                    self._index.delete(key)
+                    count += 1
+            logger.info("Deleted {} items".format(count))
+        return count
+
+    @staticmethod
+    def _table(shelf) -> Optional[Any]:
+        """
+        Return the mapping underlying `shelf` if it can select items by date
+        (like `SqliteDict`), otherwise None.
+        """
+        mapping = getattr(shelf, 'dict', None)
+        if hasattr(mapping, 'delete_before'):
+            return mapping
+        return None
+
+    def _prunable(self, shelf, dt: datetime, field_name='expire_dt') -> List:
+        """
+        Return the keys of the items whose `field_name` is before `dt`.
+        """
+        if self._index.refresh():
+            return self._index.before(field_name, dt)
+        table = self._table(shelf)
+        if table is not None:
+            return [key.decode(shelf.keyencoding)
+                    for key in table.before(field_name, dt)]
+        keys = []
+        for key in list(shelf.keys()):
+            exp_d = getattr(self._load_meta(shelf, key), field_name)
+            if exp_d is not None and exp_d < dt:
+                keys.append(key)
+        return keys
 
+    def __prune(self, dt: datetime, field_name='expire_dt') -> int:
+        with self._write() as shelf:
+            indexed = self._index.refresh()
+            table = self._table(shelf)
+            if not indexed and table is not None:
+                # A single range delete
+                count = len(table.delete_before(field_name, dt))
+                logger.info("Pruned {} items".format(count))
+                return count
+            keys_to_delete = self._prunable(shelf, dt, field_name)
             for k in keys_to_delete:
-                del shelf[k]
-                logger.info("Pruned item for key: {}".format(key))
+                if k in shelf:
+                    del shelf[k]
+                self._index.delete(k)
+                logger.info("Pruned item for key: {}".format(k))
+            if indexed:
+                self._index.refresh()
+                self._index.compact()
         return len(keys_to_delete)
 
     def prune_expired(self, older_than: Optional[datetime]=None) -> int:
@@ -201,7 +997,9 @@ class ShelfCache:
         """
         if older_than is None:
             older_than = datetime.utcnow()
-        return self.__prune(older_than, field_name='expire_dt')
+        count = self.__prune(older_than, field_name='expire_dt')
+        self._pruned()
+        return count
 
     def prune_old(self, older_than: Optional[datetime]=None) -> int:
         """
@@ -213,12 +1011,215 @@ class ShelfCache:
         """
         if older_than is None:
             older_than = datetime.utcnow()
-        return self.__prune(older_than, field_name='updated_dt')
+        count = self.__prune(older_than, field_name='updated_dt')
+        self._pruned()
+        return count
+
+    def iter_prune(self, older_than: Optional[datetime]=None,
+                   field_name: str='expire_dt',
+                   chunk_size: int=100) -> Iterator[Tuple[int, int]]:
+        """
+        Like :meth:`prune_expired` (or :meth:`prune_old` with
+        `field_name='updated_dt'`), but without holding the exclusive lock for
+        the whole operation: the items to delete are found under a shared lock,
+        then deleted `chunk_size` at a time, each chunk under its own
+        exclusive lock (items which were updated in the meantime are kept).
+        The lock is released whenever a chunk is yielded, so the caller can
+        pause between chunks (see :class:`Pruner`).
+
+        Yields:
+            The number of items and the number of bytes reclaimed by each chunk
+        """
+        if older_than is None:
+            older_than = datetime.utcnow()
+        try:
+            with self._open('r') as shelf:
+                keys = self._prunable(shelf, older_than, field_name)
+        except FileNotFoundError:
+            logger.info("Cache db file does not exist at {}"
+                        .format(self.db_path))
+            return
+        try:
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                count = nbytes = 0
+                with self._write(chunk) as shelf:
+                    indexed = self._index.refresh()
+                    for key in chunk:
+                        if indexed:
+                            meta = self._index.entry(key)
+                        else:
+                            meta = self._load_meta(shelf, key)
+                        if meta is None:
+                            continue
+                        dt = getattr(meta, field_name)
+                        if dt is None or dt >= older_than:
+                            continue
+                        del shelf[key]
+                        self._index.delete(key)
+                        count += 1
+                        nbytes += meta.size
+                    if indexed:
+                        self._index.refresh()
+                        self._index.compact()
+                    logger.info("Pruned {} items ({} bytes)"
+                                .format(count, nbytes))
+                yield count, nbytes
+        finally:
+            # Even if the caller stopped early (eg. a Pruner's max_items)
+            self._pruned()
+
+    def _pruned(self) -> None:
+        """
+        Count a prune, collecting the unreferenced blobs if it is due (see
+        `blob_collect_every`).
+        """
+        if not self.blob_threshold or not self.blob_collect_every:
+            return
+        with self._prunes_lock:
+            due = self._prunes % self.blob_collect_every == 0
+            self._prunes += 1
+        if due:
+            self.collect_blobs()
+
+    def start_pruner(self, interval: float=60, **kwargs) -> Pruner:
+        """
+        Start pruning expired items in a background thread every `interval`
+        seconds (see :class:`Pruner` for the other arguments). The pruner is
+        stopped by :meth:`close`.
+        """
+        if self._pruner is not None:
+            self._pruner.stop()
+        self._pruner = Pruner(self, interval, **kwargs).start()
+        return self._pruner
 
     def clear(self) -> None:
         """
         Delete all items in cache.
         """
-        with self.shelf_t(self.db_path, flag='c') as shelf:
-            shelf.clear()
+        with self._write() as shelf:
+            if isinstance(shelf, shelve.Shelf):
+                # Shelf.clear() would unpickle every value it pops
+                mapping = shelf.dict
+                if hasattr(mapping, 'clear'):
+                    mapping.clear()
+                else:
+                    for key in list(mapping.keys()):
+                        del mapping[key]
+            else:
+                shelf.clear()
+            self._index.clear()
             logger.info("Deleted all items in cache.")
+        # No item is left to read, but a blob being written may be about to
+        # be referred to (eg. by a StreamingResponse): keep the grace period
+        self.collect_blobs()
+
+    def collect_blobs(self, grace: float=60) -> Tuple[int, int]:
+        """
+        Delete the blobs (see `blob_threshold`) which no item refers to any
+        more, except those stored less than `grace` seconds ago. This reads
+        the header of every item which has blobs, so the pruning methods only
+        do it every `blob_collect_every` prunes (it is also done by
+        :meth:`clear`).
+
+        Returns:
+            The number of blobs deleted and their total size
+        """
+        if not self.blob_store.exists():
+            return 0, 0
+        referenced = set()
+        try:
+            with self._open('r') as shelf:
+                if not isinstance(shelf, shelve.Shelf):
+                    return 0, 0
+                mapping = shelf.dict
+                for key in list(mapping.keys()):
+                    raw = mapping.get(key)
+                    if raw is None or not record.is_record(raw):
+                        continue
+                    _, codec, offset = record.unpack_meta(raw)
+                    if codec & 0x0f == serializers.BLOBS:
+                        payload = record.decompress(
+                            codec, memoryview(raw)[offset:])
+                        referenced.update(blobs.references(payload))
+                # Collect while writers are locked out (with the flock-based
+                # shelves, at least)
+                return self.blob_store.collect(referenced, grace)
+        except FileNotFoundError:
+            return 0, 0
+
+    def _scan(self, shelf) -> Iterator[Tuple[Any, datetime, datetime,
+                                              Optional[datetime], int, int]]:
+        """
+        Yield the metadata (key, created_dt, updated_dt, expire_dt, size,
+        version) of every item by reading the whole database.
+        """
+        for key in list(shelf.keys()):
+            yield (key,) + tuple(self._load_meta(shelf, key))
+
+    def _build_index(self) -> None:
+        with self._write(()) as shelf:
+            if not self._index.exists():
+                self._index.rebuild(self._scan(shelf))
+
+    def _entries(self, shelf) -> Iterable[Tuple[Any, datetime, datetime,
+                                                Optional[datetime], int, int]]:
+        if self._index.refresh():
+            return self._index.entries()
+        return self._scan(shelf)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return a summary of the cache's contents: the number of `items`, their
+        total size on disk in `bytes` and the number which have `expired`.
+        With `metrics`, the counters and latencies recorded so far are added
+        (see :meth:`CacheStats.snapshot`).
+
+        This is answered from the metadata index if it is enabled, and by
+        reading every item otherwise.
+        """
+        stats = self._content_stats()  # type: Dict[str, Any]
+        if self.metrics is not None:
+            stats.update(self.metrics.snapshot())
+        return stats
+
+    def _content_stats(self) -> Dict[str, int]:
+        now = datetime.utcnow()
+        stats = {'items': 0, 'bytes': 0, 'expired': 0}
+        try:
+            with self._open('r') as shelf:
+                if self._index.refresh():
+                    stats['items'] = len(self._index)
+                    stats['bytes'] = self._index.total_size()
+                    stats['expired'] = len(self._index.before('expire_dt',
+                                                              now))
+                    return stats
+                for _, _, _, expire_dt, nbytes, _ in self._scan(shelf):
+                    stats['items'] += 1
+                    stats['bytes'] += nbytes
+                    if expire_dt is not None and expire_dt < now:
+                        stats['expired'] += 1
+        except FileNotFoundError:
+            logger.info("Cache db file does not exist at {}"
+                        .format(self.db_path))
+        return stats
+
+    def expiring(self, within: timedelta,
+                 now: Optional[datetime]=None) -> List[Any]:
+        """
+        Return the keys of the items which will expire in the next `within`
+        (from `now`, which defaults to datetime.utcnow()).
+        """
+        if now is None:
+            now = datetime.utcnow()
+        end = now + within
+        try:
+            with self._open('r') as shelf:
+                if self._index.refresh():
+                    return self._index.between('expire_dt', now, end)
+                return [key for key, _, _, expire_dt, _, _ in self._scan(shelf)
+                        if expire_dt is not None and now <= expire_dt < end]
+        except FileNotFoundError:
+            logger.info("Cache db file does not exist at {}"
+                        .format(self.db_path))
+        return []
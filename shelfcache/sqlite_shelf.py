@@ -0,0 +1,269 @@
+"""
+A `LockedShelf` implementation which stores the shelf in an SQLite database
+instead of a dbm file:
+
+    >>> cache = ShelfCache('cache.sqlite', shelf_t=SqliteShelf)
+
+The database is used in WAL mode, so readers never wait for a writer (they
+see the last committed state of the database) and the only lock is SQLite's
+own write lock, taken with ``BEGIN IMMEDIATE`` by writers. Each thread keeps
+its own connection to the database open (along with its cache of compiled
+statements) for the life of the thread, so opening a `SqliteShelf` costs no
+more than starting a transaction.
+
+Besides the stored value, each row holds the created, updated and expiry
+timestamps of the `ShelfCache` item it contains (parsed from the record
+header, see the `record` module) in indexed columns, so that
+:meth:`SqliteDict.before` and :meth:`SqliteDict.delete_before` can answer
+pruning queries with a single range query.
+
+The `Generation` counter of the database (see the `memory` module) is kept in
+the database too (see :class:`SqliteGeneration`), so that it is bumped in the
+same transaction as the writes, and readers see the counter which goes with
+their snapshot.
+"""
+from .locked_shelf import LockedShelf
+from . import record
+from collections.abc import MutableMapping
+from datetime import datetime
+from typing import Dict, Iterator, List
+import shelve
+import sqlite3
+import threading
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shelf (
+    key BLOB PRIMARY KEY,
+    value BLOB NOT NULL,
+    created REAL,
+    updated REAL,
+    expire REAL
+);
+CREATE INDEX IF NOT EXISTS shelf_expire ON shelf (expire);
+CREATE INDEX IF NOT EXISTS shelf_updated ON shelf (updated);
+CREATE TABLE IF NOT EXISTS generation (value INTEGER NOT NULL);
+"""
+
+_COLUMNS = {'created_dt': 'created', 'updated_dt': 'updated',
+            'expire_dt': 'expire'}
+
+_local = threading.local()
+
+
+def _connect(filename: str, timeout: float) -> sqlite3.Connection:
+    """
+    Return the current thread's connection to `filename`, opening it if
+    necessary (connections are not shared with forked children).
+    """
+    pid = os.getpid()
+    if getattr(_local, 'pid', None) != pid:
+        _local.connections = {}  # type: Dict[str, sqlite3.Connection]
+        _local.pid = pid
+    conn = _local.connections.get(filename)
+    if conn is None:
+        conn = sqlite3.connect(filename, timeout=timeout,
+                               isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(_SCHEMA)
+        _local.connections[filename] = conn
+        logger.debug("Connected to {}".format(filename))
+    return conn
+
+
+def close_connections() -> None:
+    """
+    Close the current thread's connections (they are re-opened on demand).
+    """
+    if getattr(_local, 'pid', None) == os.getpid():
+        for conn in _local.connections.values():
+            conn.close()
+    _local.connections = {}
+    _local.pid = os.getpid()
+
+
+class SqliteDict(MutableMapping):
+    """
+    A bytes to bytes mapping stored in the `shelf` table of an SQLite
+    database (the `dict` of the `shelve.Shelf` yielded by `SqliteShelf`).
+    """
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+
+    def get(self, key: bytes, default=None):
+        row = self.conn.execute('SELECT value FROM shelf WHERE key = ?',
+                                (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def __getitem__(self, key: bytes) -> bytes:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: bytes, value: bytes) -> None:
+        created = updated = expire = None
+        if record.is_record(value):
+            meta = record.unpack_meta(value)[0]
+            created = record.to_timestamp(meta.created_dt)
+            updated = record.to_timestamp(meta.updated_dt)
+            expire = record.to_timestamp(meta.expire_dt)
+        self.conn.execute('INSERT OR REPLACE INTO shelf (key, value, created, '
+                          'updated, expire) VALUES (?, ?, ?, ?, ?)',
+                          (key, value, created, updated, expire))
+
+    def __delitem__(self, key: bytes) -> None:
+        cursor = self.conn.execute('DELETE FROM shelf WHERE key = ?', (key,))
+        if not cursor.rowcount:
+            raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        return self.conn.execute('SELECT 1 FROM shelf WHERE key = ?',
+                                 (key,)).fetchone() is not None
+
+    def __iter__(self) -> Iterator[bytes]:
+        rows = self.conn.execute('SELECT key FROM shelf').fetchall()
+        return (row[0] for row in rows)
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM shelf').fetchone()[0]
+
+    def clear(self) -> None:
+        self.conn.execute('DELETE FROM shelf')
+
+    def before(self, field: str, dt: datetime) -> List[bytes]:
+        """
+        Return the keys of the items whose `field` ('created_dt', 'updated_dt'
+        or 'expire_dt') is before `dt` (like :meth:`MetaIndex.before`).
+        """
+        sql = 'SELECT key FROM shelf WHERE {} < ?'.format(_COLUMNS[field])
+        rows = self.conn.execute(sql, (record.to_timestamp(dt),)).fetchall()
+        return [row[0] for row in rows]
+
+    def delete_before(self, field: str, dt: datetime) -> List[bytes]:
+        """
+        Delete the items whose `field` is before `dt`, returning their keys.
+        """
+        keys = self.before(field, dt)
+        sql = 'DELETE FROM shelf WHERE {} < ?'.format(_COLUMNS[field])
+        self.conn.execute(sql, (record.to_timestamp(dt),))
+        return keys
+
+    def close(self) -> None:
+        # The connection belongs to the thread, not to the shelf
+        pass
+
+
+class SqliteGeneration:
+    """
+    The `Generation` counter of an SQLite database, stored in its `generation`
+    table. It is read and bumped through the current thread's connection, so
+    inside the transaction of the `SqliteShelf` the thread has open, if any: a
+    writer bumps it atomically with its writes, and a reader sees the value
+    which goes with the data it reads.
+    """
+
+    def __init__(self, filename: str, timeout: float=30.0) -> None:
+        """
+        :param filename: path to the SQLite database file
+        :param timeout: seconds to wait for another writer (if the connection
+            is opened by the counter)
+        """
+        self.filename = filename
+        self.timeout = timeout
+
+    def create(self) -> None:
+        # The table is created along with the database
+        pass
+
+    def read(self) -> int:
+        """
+        Return the current value of the counter (0 if the database does not
+        exist).
+        """
+        if not os.path.exists(self.filename):
+            return 0
+        conn = _connect(self.filename, self.timeout)
+        row = conn.execute('SELECT value FROM generation').fetchone()
+        return 0 if row is None else row[0]
+
+    def bump(self) -> int:
+        """
+        Increment the counter and return its new value. Must be called inside
+        a write transaction.
+        """
+        conn = _connect(self.filename, self.timeout)
+        if not conn.execute('UPDATE generation SET value = value + 1')\
+                .rowcount:
+            conn.execute('INSERT INTO generation (value) VALUES (1)')
+        return conn.execute('SELECT value FROM generation').fetchone()[0]
+
+    def close(self) -> None:
+        # The connection belongs to the thread
+        pass
+
+
+class SqliteShelf(LockedShelf):
+    """
+    Opens a shelf stored in an SQLite database, inside a read transaction
+    (flag 'r') or a write transaction (any other flag) which lasts until the
+    shelf is closed. Readers and writers do not block each other; writers are
+    serialized by SQLite (waiting up to `timeout` seconds for the lock).
+
+    Intended to be used as a context manager, like the other `LockedShelf`
+    implementations:
+
+        >>> with SqliteShelf(filename, flag='r') as shelf:
+        >>>     value = shelf[key]
+
+    Note that the writes made in the `with` block are committed even if it
+    raises an exception (there is no rollback with the dbm-based shelves
+    either).
+
+    :cvar generation_t: The type of the database's `Generation` counter (used
+        by `ShelfCache`)
+    """
+    generation_t = SqliteGeneration
+
+    def __init__(self, filename: str, flag='c', timeout: float=30.0) -> None:
+        """
+        :param filename: path to the SQLite database file
+        :param flag: 'r' to read, 'n' to truncate the shelf, anything else to
+            write (the database is created if necessary, unless the flag is
+            'r' in which case a FileNotFoundError is raised)
+        :param timeout: seconds to wait for another writer to finish
+        """
+        if flag == 'r' and not os.path.exists(filename):
+            raise FileNotFoundError(filename)
+        self.filename = filename
+        self.flag = flag
+        self.conn = _connect(filename, timeout)
+        self.conn.execute('BEGIN' if flag == 'r' else 'BEGIN IMMEDIATE')
+        logger.debug("Began transaction on {} ({})".format(filename, flag))
+        self.dict = SqliteDict(self.conn)
+        if flag == 'n':
+            self.dict.clear()
+        self.shelf = shelve.Shelf(self.dict)
+
+    def close(self) -> None:
+        """
+        Commits the transaction and closes the shelf.
+        """
+        self.shelf.close()
+        if self.flag != 'r':
+            # Committed along with the writes: no reader can see the new
+            # generation with the old data
+            self.generation_t(self.filename).bump()
+        self.conn.execute('COMMIT')
+        logger.debug("Committed transaction on {}".format(self.filename))
+
+    def __enter__(self) -> shelve.Shelf:
+        return self.shelf
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
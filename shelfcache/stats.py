@@ -0,0 +1,182 @@
+"""
+Counters and latency histograms of cache operations.
+
+A `ShelfCache` created with ``metrics=True`` (or given a `CacheStats` to
+share with other caches) counts its hits, misses and stale hits, the bytes it
+reads from and writes to the database and the items it evicts, and records
+how long it waits for the database lock and spends deserializing data.
+`cache_get` adds the revalidations of stale responses which the server says
+are still fresh (304), the full refetches, and how long fetches take. The
+counters are added to :meth:`ShelfCache.stats`:
+
+    >>> cache = ShelfCache('cache.db', metrics=True)
+    >>> cache.stats()['hits']
+    42
+    >>> cache.stats()['latency']['lock_wait']['p99']
+    0.0017782794100389228
+
+Every event can also be passed on to a callback (eg. to export it to a
+metrics system):
+
+    >>> cache = ShelfCache('cache.db', metrics=CacheStats(statsd_callback))
+
+The statistics are kept in memory, per process. When metrics are disabled (the
+default) the cache only checks that its `metrics` is None.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import (Any, Callable, ContextManager, Dict, Iterator, List,
+                    Optional)
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = ('hits', 'misses', 'stale_hits', 'revalidations', 'refetches',
+            'bytes_read', 'bytes_written', 'evictions')
+"""The counters (all of them are reported, even when they are 0)."""
+
+TIMERS = ('lock_wait', 'deserialize', 'fetch')
+"""The operations timed (in seconds): acquiring the lock and opening the
+database, deserializing an item's data, and fetching a url (`cache_get`)."""
+
+BUCKETS = tuple(10 ** (exponent / 4) for exponent in range(-24, 9))
+"""The upper bounds of the histogram buckets (4 per decade, from 1µs to
+100s; slower operations go to an extra, unbounded bucket)."""
+
+Callback = Callable[[str, float], None]
+
+
+class Histogram:
+    """
+    The distribution of the durations of an operation, in `BUCKETS`.
+    """
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate the `q`-quantile (eg. 0.99) as the upper bound of the bucket
+        it falls in (or the maximum duration if that is less).
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                if bucket == len(BUCKETS):
+                    break
+                return min(BUCKETS[bucket], self.max)
+        return self.max
+
+    def snapshot(self) -> Dict[str, float]:
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99)}
+
+
+class CacheStats:
+    """
+    Thread-safe counters and histograms, which can be shared by several
+    caches.
+    """
+
+    def __init__(self, callback: Optional[Callback]=None) -> None:
+        """
+        :param callback: Called with the name and value (the increment, or
+            the duration in seconds) of every event, see :meth:`add_callback`
+        """
+        self._lock = threading.Lock()
+        self._callbacks = []  # type: List[Callback]
+        if callback is not None:
+            self._callbacks.append(callback)
+        self.reset()
+
+    def add_callback(self, callback: Callback) -> None:
+        """
+        Call `callback(name, value)` for every counter increment and every
+        duration recorded (from the thread which recorded it: it should be
+        quick, and must not use the cache). Its exceptions are logged.
+        """
+        with self._lock:
+            self._callbacks = self._callbacks + [callback]
+
+    def _notify(self, name: str, value: float) -> None:
+        for callback in self._callbacks:
+            try:
+                callback(name, value)
+            except Exception:
+                logger.exception("Metrics callback failed for {}"
+                                 .format(name))
+
+    def incr(self, name: str, n: int=1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+        if self._callbacks:
+            self._notify(name, n)
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds)
+        if self._callbacks:
+            self._notify(name, seconds)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """
+        Record the duration of a `with` block.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    @contextmanager
+    def timed_open(self, name: str,
+                   opener: Callable[[], ContextManager]) -> Iterator[Any]:
+        """
+        Call `opener` and enter the context manager it returns, recording how
+        long both took (eg. to acquire a lock, whether it is taken by the
+        constructor of a shelf or when entering it), and yield what it
+        returns.
+        """
+        start = time.perf_counter()
+        with opener() as value:
+            self.observe(name, time.perf_counter() - start)
+            yield value
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Return the counters, and a summary of each histogram (its `count`,
+        `total` and `max` duration and estimated `p50`, `p90` and `p99`)
+        under 'latency'.
+        """
+        with self._lock:
+            stats = dict.fromkeys(COUNTERS, 0)  # type: Dict[str, Any]
+            stats.update(self._counters)
+            stats['latency'] = {name: histogram.snapshot() for name, histogram
+                                in self._histograms.items()}
+        return stats
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters = {}  # type: Dict[str, int]
+            self._histograms = {}  # type: Dict[str, Histogram]
@@ -0,0 +1,75 @@
+from shelfcache import AsyncShelfCache, async_cache_get
+from shelfcache.shelfcache import CacheResult
+from test.test_cache_get import build_response, mock_shelfcache, NOT_MODIFIED
+from unittest.mock import AsyncMock
+import asyncio
+import unittest
+import tempfile
+import os
+
+
+class TestAsyncShelfCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'cache.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_operations(self):
+        async def run():
+            async with AsyncShelfCache(self.db, max_workers=2) as cache:
+                self.assertIsNone(await cache.get('key'))
+                await cache.create_or_update('key', 'data', exp_seconds=60)
+                await asyncio.gather(*(cache.incr('count')
+                                       for _ in range(20)))
+                self.assertEqual('data', (await cache.get('key')).data)
+                self.assertTrue(await cache.is_fresh('key'))
+                self.assertEqual(20, (await cache.get('count')).data)
+                await cache.delete('key')
+                self.assertEqual(0, await cache.prune_expired())
+                self.assertEqual(1, (await cache.stats())['items'])
+
+        asyncio.run(run())
+
+
+class TestAsyncCacheGet(unittest.TestCase):
+    def test_new(self):
+        new = build_response()
+        mock_cache = mock_shelfcache(None)
+        getter = AsyncMock(return_value=new)
+
+        async def run():
+            cache = AsyncShelfCache(cache=mock_cache)
+            resp = await async_cache_get(cache, 'fake_url', get_meth=getter)
+            await cache.close()
+            return resp
+
+        self.assertEqual(new, asyncio.run(run()))
+        getter.assert_awaited_once_with('fake_url', headers={})
+        mock_cache.create_or_update.assert_called_with(
+            'fake_url', data=new, expire_dt=None, exp_seconds=-1)
+
+    def test_fresh(self):
+        fresh = build_response()
+        mock_cache = mock_shelfcache(CacheResult(data=fresh, expired=False))
+        getter = AsyncMock(return_value=fresh)
+        cache = AsyncShelfCache(cache=mock_cache)
+        resp = asyncio.run(async_cache_get(cache, 'fake_url',
+                                           get_meth=getter))
+        self.assertEqual(fresh, resp)
+        getter.assert_not_awaited()
+
+    def test_stale_not_modified(self):
+        stale = build_response(status=NOT_MODIFIED)
+        mock_cache = mock_shelfcache(CacheResult(data=stale, expired=True))
+        getter = AsyncMock(return_value=stale)
+        cache = AsyncShelfCache(cache=mock_cache)
+        resp = asyncio.run(async_cache_get(cache, 'fake_url',
+                                           get_meth=getter))
+        h = {'If-None-Match': 'etag', 'If-Modified-Since': 'modified'}
+        getter.assert_awaited_once_with('fake_url', headers=h)
+        self.assertIsNot(stale, resp)
+        self.assertEqual(stale.headers, resp.headers)
+        mock_cache.create_or_update.assert_called_with(
+            'fake_url', data=resp, expire_dt=None, exp_seconds=-1)
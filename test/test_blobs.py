@@ -0,0 +1,81 @@
+from shelfcache.blobs import BlobStore, BlobRef
+from shelfcache import blobs
+import unittest
+import tempfile
+import pickle
+import os
+
+
+class TestBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = BlobStore(os.path.join(self.tmpdir.name, 'cache.blobs'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_put_get(self):
+        self.assertFalse(self.store.exists())
+        digest = self.store.put(b'data')
+        self.assertEqual(digest, self.store.put(bytearray(b'data')))
+        self.assertIn(digest, self.store)
+        self.assertEqual([digest], list(self.store.digests()))
+        self.assertEqual(b'data', self.store.get(digest))
+        self.assertRaises(FileNotFoundError, self.store.get, '00' * 32)
+
+    def test_collect(self):
+        keep = self.store.put(b'keep')
+        drop = self.store.put(b'drop')
+        self.assertEqual((0, 0), self.store.collect({keep}))
+        self.assertEqual((1, 4), self.store.collect({keep}, grace=0))
+        self.assertNotIn(drop, self.store)
+        self.assertIn(keep, self.store)
+
+    def test_dumps(self):
+        big = b'x' * 1000
+        obj = {'a': big, 'b': bytearray(big), 'c': memoryview(big),
+               'small': b'small'}
+        spilled, payload = blobs.dumps(obj, self.store, 100)
+        self.assertTrue(spilled)
+        self.assertLess(len(payload), 500)
+        self.assertEqual(3, len(blobs.references(payload)))
+        self.assertEqual(1, len(list(self.store.digests())))
+        loaded = blobs.loads(payload, self.store)
+        self.assertEqual(big, loaded['a'])
+        self.assertIsInstance(loaded['a'], bytes)
+        self.assertIsInstance(loaded['b'], bytearray)
+        self.assertIsInstance(loaded['c'], memoryview)
+        self.assertEqual(big, loaded['c'])
+        self.assertEqual(b'small', loaded['small'])
+
+        spilled, payload = blobs.dumps('small', self.store, 100)
+        self.assertFalse(spilled)
+        self.assertEqual('small', pickle.loads(payload))
+
+    def test_writer(self):
+        writer = self.store.writer()
+        for chunk in (b'ab', b'cd', b'ef'):
+            writer.write(chunk)
+        ref = writer.commit()
+        self.assertEqual(6, ref.size)
+        self.assertEqual([b'abcd', b'ef'], list(ref.chunks(4)))
+        self.assertEqual(b'abcdef', ref.read())
+        self.assertEqual(ref.digest, self.store.put(b'abcdef'))
+
+        writer = self.store.writer()
+        writer.write(b'gone')
+        writer.abort()
+        self.assertEqual([ref.digest], list(self.store.digests()))
+
+    def test_blob_ref(self):
+        """
+        BlobRefs are pickled as references, whatever the threshold.
+        """
+        ref = BlobRef(self.store.put(b'data'), 4)
+        spilled, payload = blobs.dumps([ref], self.store, 100)
+        self.assertTrue(spilled)
+        self.assertEqual([ref.digest], blobs.references(payload))
+        loaded = blobs.loads(payload, self.store)[0]
+        self.assertEqual(ref, loaded)
+        self.assertEqual(b'data', loaded.read())
+        self.assertIsNone(pickle.loads(pickle.dumps(loaded)).store)
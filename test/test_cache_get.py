@@ -1,9 +1,22 @@
 import requests
 import requests.exceptions
-from shelfcache import cache_get
+from shelfcache import cache_get, cache_get_many
+from shelfcache.cache_get import wait_for_refreshes
 import unittest
 from unittest.mock import MagicMock
-from shelfcache.shelfcache import CacheResult
+from shelfcache.shelfcache import CacheResult, ShelfCache
+from shelfcache.sharded import ShardedShelfCache
+from shelfcache.flight import flight_for, LEAD
+from shelfcache.response import CachedResponse
+from shelfcache.cache_get import StreamingResponse
+from shelfcache.blobs import BlobRef
+from requests.structures import CaseInsensitiveDict
+from datetime import datetime, timedelta
+import threading
+import tempfile
+import io
+import time
+import os
 
 NOT_MODIFIED = 304
 OK = 200
@@ -112,7 +125,8 @@ class TestCacheGet(unittest.TestCase):
 
         h = {'If-None-Match': 'etag', 'If-Modified-Since': 'modified'}
         mock_getter.assert_called_once_with('fake_url', headers=h)
-        self.assertEqual(resp, stale)
+        self.assertIsNot(resp, stale)
+        self.assertEqual(stale.headers, resp.headers)
 
     def test_stale_modified(self):
         """Simulate a stale cached item and verify that cache_get fetches it and
@@ -156,3 +170,471 @@ class TestCacheGet(unittest.TestCase):
             cache_get(mock_shelf, url='http://notfound/', get_meth=mock_getter)
         self.assertEqual(404, e.exception.response.status_code)
         mock_getter.assert_called_once_with('http://notfound/', headers={})
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ShelfCache(os.path.join(self.tmpdir.name, 'cache.db'))
+        yesterday = datetime.utcnow() - timedelta(days=1)
+        self.cache.create_or_update('fake_url', data=build_response(),
+                                    expire_dt=yesterday)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_coalesced(self):
+        """Concurrent callers finding a stale item only fetch it once."""
+        new = build_response(max_age=60)
+
+        def slow_get(url, **kwargs):
+            time.sleep(0.2)
+            return new
+        mock_getter = MagicMock(side_effect=slow_get)
+
+        results = []
+
+        def get():
+            results.append(cache_get(self.cache, 'fake_url',
+                                     get_meth=mock_getter, single_flight=True))
+        threads = [threading.Thread(target=get) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        mock_getter.assert_called_once()
+        self.assertEqual(5, len(results))
+        self.assertTrue(self.cache.is_fresh('fake_url'))
+
+    def test_fetched_before_lead(self):
+        """
+        A caller which gets the slot after the previous leader stored the
+        url uses what it stored.
+        """
+        first_getter = build_getter(build_response(max_age=60))
+        second_getter = build_getter(build_response(max_age=60))
+        other = ShelfCache(self.cache.db_path)
+        get = other.get
+
+        def get_then_fetched(key):
+            item = get(key)
+            other.get = get
+            # Somebody else fetches it before this caller gets to the slot
+            cache_get(self.cache, 'fake_url', get_meth=first_getter,
+                      single_flight=True)
+            return item
+        other.get = get_then_fetched
+
+        cache_get(other, 'fake_url', get_meth=second_getter,
+                  single_flight=True)
+        first_getter.assert_called_once()
+        second_getter.assert_not_called()
+
+    def test_timeout_stale(self):
+        """A caller which doesn't wait gets the stale item."""
+        mock_getter = build_getter(build_response(max_age=60))
+        with flight_for(self.cache.db_path).flight('fake_url', 1):
+            thread = threading.Thread(target=lambda: self.assertEqual(
+                'etag', cache_get(self.cache, 'fake_url', get_meth=mock_getter,
+                                  single_flight=True, flight_timeout=0)
+                .headers['etag']))
+            thread.start()
+            thread.join()
+        mock_getter.assert_not_called()
+        self.assertFalse(self.cache.is_fresh('fake_url'))
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+    def test_option(self):
+        """The stale item is returned and refreshed in the background."""
+        stale = build_response()
+        mock_shelf = mock_shelfcache(CacheResult(data=stale, expired=True))
+        new = build_response()
+        mock_getter = build_getter(new)
+
+        headers = {'Accept': 'text/html'}
+        resp = cache_get(mock_shelf, url='fake_url', headers=headers,
+                         get_meth=mock_getter, stale_while_revalidate=True)
+        self.assertIs(resp, stale)
+        wait_for_refreshes()
+
+        h = {'Accept': 'text/html', 'If-None-Match': 'etag',
+             'If-Modified-Since': 'modified'}
+        mock_getter.assert_called_once_with('fake_url', headers=h)
+        self.assertEqual({'Accept': 'text/html'}, headers)
+        mock_shelf.create_or_update.assert_called_once_with(
+            'fake_url', data=new, exp_seconds=-1)
+
+    def test_not_modified(self):
+        """A 304 doesn't modify the stale response returned to the caller."""
+        stale = build_response()
+        mock_shelf = mock_shelfcache(CacheResult(data=stale, expired=True))
+        mock_getter = build_getter(build_response(status=NOT_MODIFIED,
+                                                  etag='new'))
+
+        resp = cache_get(mock_shelf, url='fake_url', get_meth=mock_getter,
+                         stale_while_revalidate=True)
+        wait_for_refreshes()
+        self.assertIs(resp, stale)
+        self.assertEqual('etag', resp.headers['etag'])
+        data = mock_shelf.create_or_update.call_args[1]['data']
+        self.assertEqual('new', data.headers['etag'])
+
+    def test_directive(self):
+        """The stale-while-revalidate directive is honored in its window."""
+        stale = build_response()
+        stale.headers['cache-control'] = 'max-age=10, stale-while-revalidate=60'
+        mock_shelf = mock_shelfcache(CacheResult(data=stale, expired=True))
+        new = build_response()
+        mock_getter = build_getter(new)
+
+        mock_shelf.ttl.return_value = timedelta(seconds=-30)
+        self.assertIs(stale, cache_get(mock_shelf, url='fake_url',
+                                       get_meth=mock_getter))
+        wait_for_refreshes()
+        mock_getter.assert_called_once()
+
+        mock_shelf.ttl.return_value = timedelta(seconds=-90)
+        self.assertIs(new, cache_get(mock_shelf, url='fake_url',
+                                     get_meth=mock_getter))
+        self.assertEqual(2, mock_getter.call_count)
+
+    def test_deduplicated(self):
+        """A url is only refreshed once at a time."""
+        stale = build_response()
+        mock_shelf = mock_shelfcache(CacheResult(data=stale, expired=True))
+        release = threading.Event()
+
+        def slow_get(url, **kwargs):
+            release.wait(5)
+            return build_response()
+        mock_getter = MagicMock(side_effect=slow_get)
+
+        for i in range(3):
+            cache_get(mock_shelf, url='fake_url', get_meth=mock_getter,
+                      stale_while_revalidate=True)
+        release.set()
+        wait_for_refreshes()
+        mock_getter.assert_called_once()
+
+    def test_error(self):
+        """Errors while refreshing keep the stale item."""
+        stale = build_response()
+        mock_shelf = mock_shelfcache(CacheResult(data=stale, expired=True))
+        mock_getter = build_getter(build_response(status=404))
+
+        with self.assertLogs('shelfcache.cache_get', 'ERROR'):
+            resp = cache_get(mock_shelf, url='fake_url', get_meth=mock_getter,
+                             stale_while_revalidate=True)
+            wait_for_refreshes()
+        self.assertIs(resp, stale)
+        mock_shelf.create_or_update.assert_not_called()
+
+
+class TestCompact(unittest.TestCase):
+    def test_compact(self):
+        """Responses are cached as CachedResponse objects."""
+        new = build_response(max_age=10)
+        new.url = 'fake_url'
+        new._content = b'content'
+        mock_shelf = mock_shelfcache(None)
+        mock_getter = build_getter(new)
+
+        resp = cache_get(mock_shelf, url='fake_url', get_meth=mock_getter,
+                         compact=True)
+        self.assertIs(new, resp)
+        data = mock_shelf.create_or_update.call_args[1]['data']
+        self.assertIsInstance(data, CachedResponse)
+        self.assertEqual(b'content', data.content)
+        self.assertEqual('etag', data.headers['etag'])
+
+    def test_compact_not_modified(self):
+        """A revalidated CachedResponse gets the new headers."""
+        stale = CachedResponse(OK, 'fake_url', b'content',
+                               [('etag', 'etag'), ('last-modified', 'modified')])
+        mock_shelf = mock_shelfcache(CacheResult(data=stale, expired=True))
+        mock_getter = build_getter(build_response(status=NOT_MODIFIED,
+                                                  etag='new'))
+
+        resp = cache_get(mock_shelf, url='fake_url', get_meth=mock_getter,
+                         compact=True)
+        h = {'If-None-Match': 'etag', 'If-Modified-Since': 'modified'}
+        mock_getter.assert_called_once_with('fake_url', headers=h)
+        self.assertEqual(b'content', resp.content)
+        data = mock_shelf.create_or_update.call_args[1]['data']
+        self.assertEqual('new', data.headers['etag'])
+
+
+def build_stream(body, max_age=60):
+    """Make a streamed requests.Response reading `body`."""
+    response = build_response(max_age=max_age)
+    response.raw = io.BytesIO(body)
+    response._content = False
+    return response
+
+
+class TestStream(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ShelfCache(os.path.join(self.tmpdir.name, 'cache.db'),
+                                blob_threshold=1000)
+        self.body = bytes(range(256)) * 100
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_stream(self):
+        """The body is cached as it is read, and streamed from the cache."""
+        mock_getter = build_getter(build_stream(self.body))
+        resp = cache_get(self.cache, 'fake_url', get_meth=mock_getter,
+                         stream=True)
+        mock_getter.assert_called_once_with('fake_url', headers={},
+                                            stream=True)
+        self.assertIsInstance(resp, StreamingResponse)
+        self.assertIsNone(self.cache.get('fake_url'))
+        chunks = list(resp.iter_content(1000))
+        self.assertEqual(self.body, b''.join(chunks))
+        self.assertRaises(requests.exceptions.StreamConsumedError,
+                          resp.iter_content)
+
+        resp = cache_get(self.cache, 'fake_url', get_meth=mock_getter,
+                         stream=True)
+        mock_getter.assert_called_once()
+        self.assertIsInstance(resp, CachedResponse)
+        self.assertIsInstance(resp.body, BlobRef)
+        self.assertEqual(resp.headers['etag'], 'etag')
+        chunks = list(resp.iter_content(1000))
+        self.assertEqual(26, len(chunks))
+        self.assertEqual(self.body, b''.join(chunks))
+        self.assertEqual(self.body, resp.content)
+        self.assertLess(self.cache.stats()['bytes'], 1000)
+
+    def test_abandoned(self):
+        """A body which isn't read entirely is not cached."""
+        mock_getter = build_getter(build_stream(self.body))
+        resp = cache_get(self.cache, 'fake_url', get_meth=mock_getter,
+                         stream=True)
+        chunks = resp.iter_content(1000)
+        next(chunks)
+        chunks.close()
+        self.assertIsNone(self.cache.get('fake_url'))
+        self.assertEqual([], list(self.cache.blob_store.digests()))
+        self.assertEqual([], os.listdir(self.cache.blob_store.path))
+
+    def test_sharded(self):
+        """The blobs of a streamed response go to the url's shard."""
+        cache = ShardedShelfCache(os.path.join(self.tmpdir.name, 'sharded.db'),
+                                  shards=4, blob_threshold=1000)
+        mock_getter = build_getter(build_stream(self.body))
+        resp = cache_get(cache, 'fake_url', get_meth=mock_getter, stream=True)
+        self.assertEqual(self.body, resp.content)
+        shard = cache.shard('fake_url')
+        self.assertEqual(1, len(list(shard.blob_store.digests())))
+        self.assertEqual((0, 0), shard.collect_blobs(grace=0))
+        self.assertEqual(self.body, cache.get('fake_url').data.content)
+
+    def test_single_flight(self):
+        """
+        The slot is held until the body is cached, so the callers waiting for
+        it read it from the cache.
+        """
+        mock_getter = build_getter(build_stream(self.body))
+        resp = cache_get(self.cache, 'fake_url', get_meth=mock_getter,
+                         stream=True, single_flight=True)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(cache_get(
+            self.cache, 'fake_url', get_meth=mock_getter, stream=True,
+            single_flight=True)))
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual([], results)
+        self.assertEqual(self.body, resp.content)
+        thread.join()
+        mock_getter.assert_called_once()
+        self.assertIsInstance(results[0], CachedResponse)
+        self.assertEqual(self.body, results[0].content)
+
+    def test_single_flight_closed(self):
+        """Closing a streamed response releases the slot."""
+        mock_getter = build_getter(build_stream(self.body))
+        resp = cache_get(self.cache, 'fake_url', get_meth=mock_getter,
+                         stream=True, single_flight=True)
+        resp.close()
+        with flight_for(self.cache.db_path).flight('fake_url', 0) as status:
+            self.assertEqual(LEAD, status)
+        self.assertIsNone(self.cache.get('fake_url'))
+
+    def test_needs_blobs(self):
+        cache = ShelfCache(os.path.join(self.tmpdir.name, 'other.db'))
+        with self.assertRaises(ValueError):
+            cache_get(cache, 'fake_url', get_meth=build_getter(None),
+                      stream=True)
+
+
+class TestFreshness(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ShelfCache(os.path.join(self.tmpdir.name, 'cache.db'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def fetch(self, response, **kwargs):
+        mock_getter = build_getter(response)
+        return cache_get(self.cache, 'fake_url', get_meth=mock_getter,
+                         **kwargs), mock_getter
+
+    def test_expires(self):
+        """The Expires header sets the expiry time."""
+        new = build_response()
+        expires = datetime.utcnow() + timedelta(hours=1)
+        new.headers = CaseInsensitiveDict({
+            'Expires': expires.strftime('%a, %d %b %Y %H:%M:%S GMT')})
+        self.fetch(new)
+        self.assertGreater(self.cache.ttl('fake_url'), timedelta(minutes=59))
+
+    def test_no_store(self):
+        new = build_response()
+        new.headers = CaseInsensitiveDict({'Cache-Control': 'no-store'})
+        resp, _ = self.fetch(new)
+        self.assertIs(new, resp)
+        self.assertIsNone(self.cache.get('fake_url'))
+
+    def test_exp_seconds_zero(self):
+        """A cache's exp_seconds of 0 means no expiry, as for ShelfCache."""
+        self.cache.exp_seconds = 0
+        new = build_response()
+        new.headers = CaseInsensitiveDict({'ETag': 'etag'})
+        self.fetch(new)
+        self.assertIsNone(self.cache.meta('fake_url').expire_dt)
+
+    def test_no_cache(self):
+        """no-cache responses are stored, but always revalidated."""
+        new = build_response()
+        new.headers = CaseInsensitiveDict({'Cache-Control': 'no-cache',
+                                           'ETag': 'etag'})
+        self.fetch(new)
+        self.assertFalse(self.cache.is_fresh('fake_url'))
+        _, mock_getter = self.fetch(build_response(status=NOT_MODIFIED),
+                                    headers={'Cache-Control': 'max-stale'})
+        mock_getter.assert_called_once()
+
+    def test_request_directives(self):
+        yesterday = datetime.utcnow() - timedelta(days=1)
+        self.cache.create_or_update('fake_url', data=build_response(),
+                                    expire_dt=yesterday)
+        resp, mock_getter = self.fetch(
+            build_response(), headers={'Cache-Control': 'max-stale'})
+        mock_getter.assert_not_called()
+        resp, mock_getter = self.fetch(
+            build_response(), headers={'Cache-Control': 'max-stale=3600'})
+        mock_getter.assert_called_once()
+
+        self.cache.create_or_update('fake_url', data=build_response(),
+                                    exp_seconds=30)
+        resp, mock_getter = self.fetch(
+            build_response(), headers={'Cache-Control': 'min-fresh=60'})
+        mock_getter.assert_called_once()
+
+
+class TestCacheGetMany(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ShelfCache(os.path.join(self.tmpdir.name, 'cache.db'),
+                                exp_seconds=60)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def test_many(self):
+        """
+        Fresh items are returned from the cache, the others are fetched
+        (revalidating stale items) and cached.
+        """
+        yesterday = datetime.utcnow() - timedelta(days=1)
+        self.cache.create_or_update('http://a/fresh', data=build_response())
+        self.cache.create_or_update('http://a/stale', data=build_response(),
+                                    expire_dt=yesterday)
+
+        def get(url, headers, **kwargs):
+            if url == 'http://a/stale':
+                self.assertEqual('etag', headers['If-None-Match'])
+                return build_response(status=NOT_MODIFIED)
+            if url == 'http://b/error':
+                raise requests.exceptions.ConnectionError(url)
+            return build_response()
+        mock_getter = MagicMock(side_effect=get)
+
+        urls = ['http://a/fresh', 'http://a/stale', 'http://a/new',
+                'http://b/error', 'http://a/new']
+        results = list(cache_get_many(self.cache, urls,
+                                      get_meth=mock_getter, timeout=5))
+        self.assertEqual(('http://a/fresh', OK),
+                         (results[0][0], results[0][1].status_code))
+        results = dict(results)
+        self.assertEqual(4, len(results))
+        self.assertEqual(3, mock_getter.call_count)
+        self.assertEqual(5, mock_getter.call_args[1]['timeout'])
+        self.assertIsInstance(results['http://b/error'],
+                              requests.exceptions.ConnectionError)
+        self.assertEqual(OK, results['http://a/stale'].status_code)
+        self.assertTrue(self.cache.is_fresh('http://a/stale'))
+        self.assertTrue(self.cache.is_fresh('http://a/new'))
+        self.assertIsNone(self.cache.get('http://b/error'))
+
+    def test_per_host_limit(self):
+        """
+        No more than per_host_limit requests to a host are in flight.
+        """
+        lock = threading.Lock()
+        in_flight = {}
+        peaks = {}
+
+        def get(url, headers, **kwargs):
+            host = url.split('/')[2]
+            with lock:
+                in_flight[host] = in_flight.get(host, 0) + 1
+                peaks[host] = max(peaks.get(host, 0), in_flight[host])
+            time.sleep(0.01)
+            with lock:
+                in_flight[host] -= 1
+            return build_response()
+
+        urls = ['http://{}/{}'.format(host, i) for i in range(6)
+                for host in ('a', 'b', 'c')]
+        results = list(cache_get_many(self.cache, urls, get_meth=get,
+                                      max_workers=8, per_host_limit=2,
+                                      batch_size=4))
+        self.assertEqual(18, len(results))
+        self.assertEqual({'a': 2, 'b': 2, 'c': 2}, peaks)
+        self.assertEqual(18, len(self.cache.get_many(urls)))
+
+    def test_close(self):
+        """
+        What was fetched is cached when the caller stops early.
+        """
+        urls = ['http://a/{}'.format(i) for i in range(10)]
+        results = cache_get_many(self.cache, urls,
+                                 get_meth=build_getter(build_response()),
+                                 max_workers=1)
+        url, _ = next(results)
+        results.close()
+        self.assertTrue(self.cache.is_fresh(url))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_metrics(self):
+        """Revalidations and refetches are counted, and fetches timed."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = ShelfCache(os.path.join(tmpdir, 'cache.db'), metrics=True)
+            yesterday = datetime.utcnow() - timedelta(days=1)
+            for status in (OK, NOT_MODIFIED, OK):
+                cache_get(cache, 'fake_url',
+                          get_meth=build_getter(build_response(status)))
+                cache.update_expires('fake_url', yesterday)
+            stats = cache.stats()
+            self.assertEqual((1, 1), (stats['revalidations'],
+                                      stats['refetches']))
+            self.assertEqual(3, stats['latency']['fetch']['count'])
@@ -0,0 +1,87 @@
+from shelfcache.flight import SingleFlight, flight_for, LEAD, WAITED, TIMEOUT
+import unittest
+import tempfile
+import threading
+import time
+import os
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'cache.db')
+        self.flight = SingleFlight(self.db)
+
+    def tearDown(self):
+        self.flight.close()
+        self.tmpdir.cleanup()
+
+    def test_lead(self):
+        with self.flight.flight('key', 1) as status:
+            self.assertEqual(LEAD, status)
+            self.assertTrue(os.path.exists(self.db + '.flight'))
+        with self.flight.flight('key', 1) as status:
+            self.assertEqual(LEAD, status)
+
+    def test_threads(self):
+        """
+        Only one thread holds a key at a time; the others wait or time out.
+        """
+        statuses = []
+        holding = []
+        entered = threading.Event()
+
+        def leader():
+            with self.flight.flight('key', 1) as status:
+                statuses.append(status)
+                holding.append(1)
+                entered.set()
+                time.sleep(0.2)
+                holding.pop()
+
+        def follower(timeout):
+            entered.wait()
+            with self.flight.flight('key', timeout) as status:
+                statuses.append(status)
+                if status != TIMEOUT:
+                    self.assertFalse(holding)
+
+        threads = [threading.Thread(target=leader),
+                   threading.Thread(target=follower, args=(2,)),
+                   threading.Thread(target=follower, args=(0,))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([LEAD, TIMEOUT, WAITED], statuses)
+
+    def test_processes(self):
+        """
+        A key held by another process times out, and is acquired once the
+        other process releases it.
+        """
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                child = SingleFlight(self.db)
+                with child.flight('key', 1):
+                    os.write(write_fd, b'x')
+                    time.sleep(0.5)
+            finally:
+                os._exit(0)
+        os.read(read_fd, 1)
+        try:
+            with self.flight.flight('key', 0.05) as status:
+                self.assertEqual(TIMEOUT, status)
+            with self.flight.flight('other key', 0.05) as status:
+                self.assertEqual(LEAD, status)
+            with self.flight.flight('key', 5) as status:
+                self.assertEqual(WAITED, status)
+        finally:
+            os.waitpid(pid, 0)
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def test_flight_for(self):
+        self.assertIs(flight_for(self.db), flight_for(self.db))
@@ -0,0 +1,78 @@
+from shelfcache.freshness import (Freshness, parse_cache_control, parse_date,
+                                  acceptable)
+from datetime import datetime
+from email.utils import format_datetime
+from datetime import timedelta, timezone
+import unittest
+
+
+def http_date(dt):
+    return format_datetime(dt.replace(tzinfo=timezone.utc), usegmt=True)
+
+
+class TestFreshness(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime(2020, 1, 1, 12, 0, 0)
+
+    def test_parse(self):
+        self.assertEqual({'max-age': '60', 'no-cache': None,
+                          'private': 'x-a, x-b'},
+                         parse_cache_control('Max-Age=60, no-cache, '
+                                             'private="x-a, x-b"'))
+        self.assertEqual({}, parse_cache_control(None))
+        self.assertEqual(self.now, parse_date(http_date(self.now)))
+        self.assertIsNone(parse_date('yesterday'))
+
+    def test_max_age(self):
+        headers = {'cache-control': 'max-age=600, s-maxage=60',
+                   'date': http_date(self.now - timedelta(seconds=100)),
+                   'age': '200',
+                   'expires': http_date(self.now)}
+        fresh = Freshness.from_headers(headers, self.now)
+        self.assertEqual((600, 200), (fresh.lifetime, fresh.age))
+        self.assertEqual(400, fresh.ttl)
+        shared = Freshness.from_headers(headers, self.now, shared=True)
+        self.assertEqual(60, shared.lifetime)
+
+    def test_expires(self):
+        headers = {'date': http_date(self.now),
+                   'expires': http_date(self.now + timedelta(hours=1))}
+        self.assertEqual(3600, Freshness.from_headers(headers, self.now).ttl)
+        headers['expires'] = '0'
+        self.assertEqual(0, Freshness.from_headers(headers, self.now).ttl)
+
+    def test_heuristic(self):
+        headers = {'last-modified': http_date(self.now - timedelta(days=2))}
+        fresh = Freshness.from_headers(headers, self.now)
+        self.assertTrue(fresh.heuristic)
+        self.assertAlmostEqual(0.2 * 24 * 3600, fresh.ttl)
+        headers = {'last-modified': http_date(self.now - timedelta(days=365))}
+        self.assertEqual(24 * 3600,
+                         Freshness.from_headers(headers, self.now).ttl)
+        self.assertIsNone(Freshness.from_headers({}, self.now).ttl)
+
+    def test_directives(self):
+        fresh = Freshness.from_headers({'cache-control': 'no-cache, max-age=60'},
+                                       self.now)
+        self.assertEqual(0, fresh.ttl)
+        self.assertTrue(fresh.must_revalidate)
+        self.assertTrue(fresh.storable)
+        fresh = Freshness.from_headers({'cache-control': 'no-store'}, self.now)
+        self.assertFalse(fresh.storable)
+        fresh = Freshness.from_headers({'cache-control': 'proxy-revalidate'},
+                                       self.now, shared=True)
+        self.assertTrue(fresh.must_revalidate)
+
+    def test_acceptable(self):
+        self.assertTrue(acceptable(10, 0, {}))
+        self.assertFalse(acceptable(-10, 0, {}))
+        self.assertTrue(acceptable(None, 1000, {}))
+        self.assertFalse(acceptable(10, 0, {'no-cache': None}))
+        self.assertFalse(acceptable(10, 100, {'max-age': '50'}))
+        self.assertFalse(acceptable(10, 0, {'min-fresh': '20'}))
+        self.assertTrue(acceptable(30, 0, {'min-fresh': '20'}))
+        self.assertTrue(acceptable(-10, 0, {'max-stale': None}))
+        self.assertTrue(acceptable(-10, 0, {'max-stale': '20'}))
+        self.assertFalse(acceptable(-30, 0, {'max-stale': '20'}))
+        self.assertFalse(acceptable(-10, 0, {'max-stale': None},
+                                    revalidate=True))
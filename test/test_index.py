@@ -0,0 +1,106 @@
+from shelfcache.index import MetaIndex
+from datetime import datetime, timedelta
+import unittest
+import tempfile
+import os
+
+
+class TestMetaIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'cache.db')
+        self.now = datetime.utcnow()
+        self.index = MetaIndex(self.db)
+        self.index.rebuild([])
+
+    def tearDown(self):
+        self.index.close()
+        self.tmpdir.cleanup()
+
+    def put(self, key, expire=None, index=None):
+        index = self.index if index is None else index
+        index.put(key, self.now, self.now, expire, 10)
+
+    def test_missing(self):
+        """
+        Nothing is written if the index file does not exist.
+        """
+        index = MetaIndex(os.path.join(self.tmpdir.name, 'other.db'))
+        self.put('key', index=index)
+        self.assertFalse(index.refresh())
+        self.assertFalse(index.exists())
+
+    def test_put_delete(self):
+        self.put('a', self.now + timedelta(days=1))
+        self.put('b')
+        self.index.delete('a')
+        self.put('c')
+        self.assertTrue(self.index.refresh())
+        self.assertEqual(2, len(self.index))
+        self.assertNotIn('a', self.index)
+        self.assertEqual(20, self.index.total_size())
+        entry = self.index.entry('b')
+        self.assertIsNone(entry.expire_dt)
+        self.assertEqual(self.now, entry.created_dt)
+
+    def test_before(self):
+        """
+        Items that never expire and deleted rows are never selected.
+        """
+        yesterday = self.now - timedelta(days=1)
+        self.put('old', yesterday)
+        self.put('deleted', yesterday)
+        self.put('never')
+        self.put('new', self.now + timedelta(days=1))
+        self.index.delete('deleted')
+        self.index.refresh()
+        self.assertEqual(['old'], self.index.before('expire_dt', self.now))
+        self.assertEqual(['new'], self.index.between(
+            'expire_dt', self.now, self.now + timedelta(days=2)))
+
+    def test_other_process(self):
+        """
+        Appends and compactions made through another instance (ie. another
+        process) are picked up by refresh().
+        """
+        other = MetaIndex(self.db)
+        self.put('a')
+        self.assertTrue(other.refresh())
+        self.assertIn('a', other)
+
+        self.put('b', index=other)
+        other.delete('a')
+        other.refresh()
+        other.compact(force=True)
+        self.put('c')
+        self.index.refresh()
+        self.assertEqual(['b', 'c'], sorted(self.index._rows))
+        other.close()
+
+    def test_victims(self):
+        yesterday = self.now - timedelta(days=1)
+        self.put('a', self.now + timedelta(days=1))
+        self.put('b', yesterday)
+        self.put('c')
+        self.index.access({'a': 3, 'c': 1}, self.now + timedelta(seconds=1))
+        self.index.refresh()
+        self.assertEqual(['b'], self.index.victims('lru', 1))
+        self.assertEqual(['b', 'c'], self.index.victims('lfu', 2))
+        self.assertEqual(['b', 'a'], self.index.victims('ttl', 2))
+        self.assertEqual(['b', 'a'], self.index.victims('ttl', nbytes=15))
+        # Kept keys come last
+        self.assertEqual(['c'], self.index.victims('lru', 1, keep=['a', 'b']))
+        self.assertRaises(ValueError, self.index.victims, 'fifo', 1)
+
+    def test_compact_keeps_usage(self):
+        self.put('a')
+        self.index.access({'a': 5}, self.now + timedelta(seconds=1))
+        self.index.refresh()
+        self.assertTrue(self.index.compact(force=True))
+        other = MetaIndex(self.db)
+        other.refresh()
+        row = other._rows['a']
+        self.assertEqual(6, other.hits[row])
+        self.assertEqual(self.index.atime[row], other.atime[row])
+        self.assertEqual(10, other.total_size())
+        other.close()
@@ -1,7 +1,9 @@
-from shelfcache.locked_shelf import MutexShelf, RWShelf
+from shelfcache.locked_shelf import (MutexShelf, RWShelf, ShelfHandle, Generation,
+                                     RWLock, RWLockShelf)
 import shelve
 import unittest
 import os
+import tempfile
 import time
 import threading
 import multiprocessing
@@ -296,3 +298,205 @@ class TestRW(unittest.TestCase):
 
     def tearDown(self):
         remove_db(TEST_DB)
+
+
+class TestShelfHandle(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'handle.db')
+        self.handle = ShelfHandle(self.db)
+
+    def tearDown(self):
+        self.handle.close()
+        self.tmpdir.cleanup()
+
+    def test_read_missing_db(self):
+        """
+        Reading a database which does not exist raises FileNotFoundError.
+        """
+        with self.assertRaises(FileNotFoundError):
+            with self.handle.open('r'):
+                pass
+
+    def test_reuses_shelf(self):
+        """
+        The shelve object and lock file stay open between acquisitions.
+        """
+        with self.handle.open('c') as shelf:
+            shelf['key'] = 'val'
+        fd, first = self.handle.fd, self.handle.shelf
+        with self.handle.open('r') as shelf:
+            self.assertEqual('val', shelf['key'])
+        self.assertIs(fd, self.handle.fd)
+        self.assertIs(first, self.handle.shelf)
+
+    def test_sees_other_writers(self):
+        """
+        Writes made through RWShelf (eg. by another process) are visible to
+        the handle.
+        """
+        with self.handle.open('c') as shelf:
+            shelf['key'] = 'val'
+        with RWShelf(self.db, flag='c') as shelf:
+            shelf['key'] = 'other'
+        with self.handle.open('r') as shelf:
+            self.assertEqual('other', shelf['key'])
+
+    def test_fork(self):
+        """
+        A handle opened before forking can be used in the child, and the
+        parent sees the child's writes.
+        """
+        with self.handle.open('c') as shelf:
+            shelf['key'] = 'parent'
+
+        def child():
+            with self.handle.open('c') as shelf:
+                shelf['key'] = 'child'
+
+        ctx = multiprocessing.get_context('fork')
+        proc = ctx.Process(target=child)
+        proc.start()
+        proc.join()
+        self.assertEqual(0, proc.exitcode)
+        with self.handle.open('r') as shelf:
+            self.assertEqual('child', shelf['key'])
+
+
+class TestGeneration(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'gen.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_bump_without_file(self):
+        """
+        Bumping is a no-op until somebody creates the counter file.
+        """
+        gen = Generation(self.db)
+        self.assertEqual(0, gen.bump())
+        self.assertFalse(os.path.exists(gen.path))
+
+    def test_bump(self):
+        gen = Generation(self.db)
+        gen.create()
+        gen.bump()
+        other = Generation(self.db)
+        self.assertEqual(1, other.read())
+        self.assertEqual(2, other.bump())
+        self.assertEqual(2, gen.read())
+        gen.close()
+        other.close()
+
+
+class TestRWLock(unittest.TestCase):
+    def test_readers_share(self):
+        lock = RWLock()
+        lock.acquire_read()
+        acquired = threading.Event()
+
+        def read():
+            with lock.read():
+                acquired.set()
+
+        t = threading.Thread(target=read)
+        t.start()
+        self.assertTrue(acquired.wait(5))
+        t.join()
+        lock.release_read()
+
+    def test_writer_excludes(self):
+        lock = RWLock()
+        events = []
+
+        def write():
+            with lock.write():
+                events.append('write')
+
+        with lock.read():
+            t = threading.Thread(target=write)
+            t.start()
+            time.sleep(0.1)
+            events.append('read')
+        t.join()
+        self.assertEqual(['read', 'write'], events)
+
+    def test_prefer_writers(self):
+        """
+        A new reader waits for a waiting writer (unless prefer_writers is
+        False).
+        """
+        for prefer, expected in ((True, ['write', 'read2']),
+                                 (False, ['read2', 'write'])):
+            lock = RWLock(prefer_writers=prefer)
+            events = []
+
+            def write():
+                with lock.write():
+                    events.append('write')
+
+            def read():
+                with lock.read():
+                    events.append('read2')
+
+            lock.acquire_read()
+            writer = threading.Thread(target=write)
+            writer.start()
+            while not lock._waiting_writers:
+                time.sleep(0.01)
+            reader = threading.Thread(target=read)
+            reader.start()
+            time.sleep(0.1)
+            lock.release_read()
+            writer.join()
+            reader.join()
+            self.assertEqual(expected, events)
+
+
+class TestRWLockShelf(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'rwlock.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_read_missing_db(self):
+        with self.assertRaises(FileNotFoundError):
+            RWLockShelf(self.db, flag='r')
+        # The lock was released
+        with RWLockShelf(self.db, flag='c') as shelf:
+            shelf['key'] = 'val'
+
+    def test_concurrent_readers(self):
+        """
+        Readers in the same process don't wait for each other, with or
+        without flock.
+        """
+        for use_flock in (False, True):
+            with RWLockShelf(self.db, flag='c', use_flock=use_flock) as shelf:
+                shelf['key'] = use_flock
+            barrier = threading.Barrier(2, timeout=5)
+            results = []
+
+            def read():
+                with RWLockShelf(self.db, flag='r',
+                                 use_flock=use_flock) as shelf:
+                    barrier.wait()
+                    results.append(shelf['key'])
+
+            threads = [threading.Thread(target=read) for _ in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual([use_flock, use_flock], results)
+
+    def test_cache(self):
+        from shelfcache.shelfcache import ShelfCache
+        sc = ShelfCache(db_path=self.db, shelf_t=RWLockShelf)
+        self.assertIsNone(sc.get('key'))
+        sc['key'] = 'val'
+        self.assertEqual('val', sc.get('key').data)
@@ -0,0 +1,88 @@
+from shelfcache.shelfcache import ShelfCache
+from shelfcache.log_shelf import LogShelf
+from shelfcache import log_shelf
+from functools import partial
+from unittest.mock import patch
+import unittest
+import tempfile
+import os
+
+
+class TestLogShelf(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'cache.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.tmpdir.name)
+                      if name.endswith('.log'))
+
+    def test_shelf(self):
+        self.assertRaises(FileNotFoundError, LogShelf, self.db, flag='r')
+        with LogShelf(self.db) as shelf:
+            shelf['key'] = [1, 2]
+            shelf['other'] = 'other'
+            self.assertEqual([1, 2], shelf['key'])
+            del shelf['other']
+            self.assertRaises(KeyError, shelf.__delitem__, 'other')
+        with LogShelf(self.db, flag='r') as shelf:
+            self.assertEqual([1, 2], shelf['key'])
+            self.assertEqual(['key'], list(shelf.keys()))
+            self.assertRaises(PermissionError, shelf.__setitem__, 'a', 1)
+        with LogShelf(self.db, flag='n') as shelf:
+            self.assertEqual(0, len(shelf))
+        self.assertEqual([], self.segments())
+
+    def test_rollover_and_compaction(self):
+        shelf_t = partial(LogShelf, segment_size=1000, compact_min=2000)
+        for i in range(50):
+            with shelf_t(self.db) as shelf:
+                shelf['key'] = 'x' * 100
+                shelf[str(i % 5)] = i
+        self.assertLess(len(self.segments()), 3)
+        with shelf_t(self.db, flag='r') as shelf:
+            self.assertEqual(6, len(shelf))
+            self.assertEqual(49, shelf['4'])
+
+    def test_torn_write(self):
+        with LogShelf(self.db) as shelf:
+            shelf['a'] = 'a'
+        segment = os.path.join(self.tmpdir.name, self.segments()[-1])
+        size = os.path.getsize(segment)
+        with open(segment, 'ab') as f:
+            f.write(b'\x05\x00\x00\x00garbage')
+        # Forget the log, like a new process
+        log_shelf._logs.clear()
+        with LogShelf(self.db, flag='r') as shelf:
+            self.assertEqual('a', shelf['a'])
+        with LogShelf(self.db) as shelf:
+            shelf['b'] = 'b'
+        self.assertGreater(os.path.getsize(segment), size)
+        log_shelf._logs.clear()
+        with LogShelf(self.db, flag='r') as shelf:
+            self.assertEqual(['a', 'b'], sorted(shelf.keys()))
+
+    def test_open_error(self):
+        """A writer which fails to open the log releases its mutex."""
+        with LogShelf(self.db) as shelf:
+            shelf['a'] = 'a'
+        with patch.object(log_shelf._Log, 'repair', side_effect=OSError):
+            self.assertRaises(OSError, LogShelf, self.db)
+        log = log_shelf._get_log(self.db)
+        self.assertTrue(log.mutex.acquire(timeout=1))
+        log.mutex.release()
+        with LogShelf(self.db) as shelf:
+            self.assertEqual('a', shelf['a'])
+
+    def test_cache(self):
+        sc = ShelfCache(db_path=self.db, shelf_t=LogShelf, index=True)
+        self.assertIsNone(sc.get('missing'))
+        sc.create_or_update('key', data='data', exp_seconds=60)
+        sc['other'] = 'other'
+        self.assertEqual('data', sc.get('key').data)
+        self.assertEqual(1, sc.meta('key').version)
+        sc.delete('other')
+        self.assertEqual(1, sc.stats()['items'])
@@ -0,0 +1,54 @@
+from shelfcache.memory import MemoryTier
+import unittest
+
+
+class TestMemoryTier(unittest.TestCase):
+    def test_lru_items(self):
+        """
+        The least recently used entry is evicted when over max_items.
+        """
+        tier = MemoryTier(max_items=2)
+        tier.put('a', 1, 10, 0)
+        tier.put('b', 2, 10, 0)
+        self.assertEqual(1, tier.get('a', 0))
+        tier.put('c', 3, 10, 0)
+        self.assertIsNone(tier.get('b', 0))
+        self.assertEqual(1, tier.get('a', 0))
+        self.assertEqual(3, tier.get('c', 0))
+
+    def test_max_bytes(self):
+        """
+        Entries are evicted to stay under max_bytes, and entries larger than
+        the limit are never cached.
+        """
+        tier = MemoryTier(max_bytes=100)
+        tier.put('a', 1, 60, 0)
+        tier.put('b', 2, 60, 0)
+        self.assertIsNone(tier.get('a', 0))
+        self.assertEqual(60, tier.nbytes)
+        tier.put('big', 3, 101, 0)
+        self.assertIsNone(tier.get('big', 0))
+
+    def test_generation(self):
+        """
+        A new generation drops every entry.
+        """
+        tier = MemoryTier(max_items=10)
+        tier.put('a', 1, 10, 0)
+        self.assertIsNone(tier.get('a', 1))
+        self.assertEqual(0, len(tier))
+
+    def test_written(self):
+        """
+        Writes made by the owner only invalidate the written keys, unless
+        somebody else wrote first.
+        """
+        tier = MemoryTier(max_items=10)
+        tier.put('a', 1, 10, 0)
+        tier.put('b', 2, 10, 0)
+        tier.written(0, ['a'])
+        self.assertIsNone(tier.get('a', 1))
+        self.assertEqual(2, tier.get('b', 1))
+
+        tier.written(5, ['a'])
+        self.assertIsNone(tier.get('b', 6))
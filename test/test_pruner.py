@@ -0,0 +1,86 @@
+from shelfcache.shelfcache import ShelfCache
+from shelfcache.pruner import Pruner, PruneReport
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+import unittest
+import tempfile
+import time
+import os
+
+
+class TestPruner(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'cache.db')
+        self.yesterday = datetime.utcnow() - timedelta(days=1)
+        self.sc = ShelfCache(db_path=self.db, index=True)
+        self.sc.set_many({'old{}'.format(i): i for i in range(10)},
+                         expire_dt=self.yesterday)
+        self.sc['new'] = 'new'
+
+    def tearDown(self):
+        self.sc.close()
+        self.tmpdir.cleanup()
+
+    def test_iter_prune(self):
+        """
+        Items are deleted in chunks, and items updated after the prune
+        started are kept.
+        """
+        chunks = self.sc.iter_prune(chunk_size=4)
+        count, nbytes = next(chunks)
+        self.assertEqual(4, count)
+        self.assertGreater(nbytes, 0)
+        self.sc['old9'] = 'updated'
+        self.assertEqual([4, 1], [count for count, _ in chunks])
+        self.assertEqual(2, self.sc.stats()['items'])
+        self.assertEqual('updated', self.sc.get('old9').data)
+
+    def test_run_once(self):
+        pruner = Pruner(self.sc, chunk_size=3, pause=0)
+        report = pruner.run_once()
+        self.assertEqual(10, report.items)
+        self.assertEqual(report, pruner.last_report)
+        self.assertEqual(10, pruner.items)
+        self.assertEqual(1, pruner.runs)
+        self.assertEqual(PruneReport(0, 0), pruner.run_once())
+        self.assertEqual(1, self.sc.stats()['items'])
+
+    def test_limits(self):
+        pruner = Pruner(self.sc, chunk_size=2, pause=0, max_items=4)
+        self.assertEqual(4, pruner.run_once().items)
+        pruner = Pruner(self.sc, chunk_size=2, pause=0, max_rate=100)
+        start = time.monotonic()
+        self.assertEqual(6, pruner.run_once().items)
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+    def test_max_age(self):
+        pruner = Pruner(self.sc, pause=0, max_age=timedelta(0))
+        self.assertEqual(11, pruner.run_once().items)
+
+    def test_collect_blobs(self):
+        """Blobs are collected on the first prune, then every few prunes."""
+        self.sc.collect_blobs = MagicMock(return_value=(0, 0))
+        Pruner(self.sc, pause=0).run_once()
+        self.sc.collect_blobs.assert_not_called()
+
+        sc = ShelfCache(db_path=self.db, blob_threshold=1000,
+                        blob_collect_every=2)
+        sc.collect_blobs = MagicMock(return_value=(0, 0))
+        pruner = Pruner(sc, pause=0, max_items=1)
+        pruner.run_once()
+        self.assertEqual(1, sc.collect_blobs.call_count)
+        pruner.run_once()
+        sc.prune_expired()
+        self.assertEqual(2, sc.collect_blobs.call_count)
+
+    def test_background(self):
+        pruner = self.sc.start_pruner(interval=0.01, pause=0)
+        deadline = time.monotonic() + 5
+        while pruner.items < 10 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(pruner.running)
+        self.sc.close()
+        self.assertFalse(pruner.running)
+        self.assertEqual(10, pruner.items)
+        self.assertIsNone(self.sc.get('old0'))
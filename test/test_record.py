@@ -0,0 +1,59 @@
+from shelfcache import record
+from datetime import datetime, timedelta
+import pickle
+import unittest
+
+
+class TestRecord(unittest.TestCase):
+    def test_roundtrip(self):
+        now = datetime.utcnow()
+        tomorrow = now + timedelta(days=1)
+        payload = pickle.dumps('data')
+        raw = record.pack(now, now, tomorrow, record.PICKLE, payload, 3)
+
+        self.assertTrue(record.is_record(raw))
+        meta, codec, offset = record.unpack_meta(raw)
+        self.assertEqual((now, now, tomorrow, len(raw), 3), meta)
+        self.assertEqual(record.PICKLE, codec)
+        self.assertEqual(payload, raw[offset:])
+
+    def test_format_1(self):
+        """
+        Records written before items had a version are read as version 0.
+        """
+        now = datetime.utcnow()
+        header = record._HEADERS[1].pack(record.MAGIC, 1,
+                                         record.to_timestamp(now),
+                                         record.to_timestamp(now),
+                                         record.to_timestamp(None),
+                                         record.PICKLE)
+        meta, codec, offset = record.unpack_meta(header + b'data')
+        self.assertEqual(0, meta.version)
+        self.assertEqual(now, meta.created_dt)
+        self.assertEqual(len(header), offset)
+
+    def test_never_expires(self):
+        now = datetime.utcnow()
+        raw = record.pack(now, now, None, record.PICKLE, b'')
+        self.assertIsNone(record.unpack_meta(raw)[0].expire_dt)
+
+    def test_legacy(self):
+        """
+        A pickle (of any protocol) is never mistaken for a record.
+        """
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertFalse(record.is_record(pickle.dumps('x', protocol)))
+
+    def test_compress(self):
+        payload = pickle.dumps('data' * 1000)
+        for name in ('zlib', 'lzma', 'bz2'):
+            codec, compressed = record.compress(record.PICKLE, payload, name)
+            self.assertEqual(record.COMPRESSORS[name], codec)
+            self.assertEqual(record.PICKLE, codec & 0x0f)
+            self.assertLess(len(compressed), len(payload))
+            self.assertEqual(payload, record.decompress(codec, compressed))
+        # Not worth it:
+        self.assertEqual((record.PICKLE, b'x'),
+                         record.compress(record.PICKLE, b'x', 'zlib'))
+        self.assertEqual(b'x', record.decompress(record.PICKLE, b'x'))
+        self.assertRaises(ValueError, record.decompress, 0xf0, b'x')
@@ -0,0 +1,57 @@
+from shelfcache.response import CachedResponse
+from requests.structures import CaseInsensitiveDict
+import requests
+import pickle
+import unittest
+
+
+def build_response():
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response.url = 'http://example.com/'
+    response.encoding = 'utf-8'
+    response.headers = CaseInsensitiveDict({
+        'Content-Type': 'application/json', 'ETag': '"etag"',
+        'Content-Encoding': 'gzip', 'Set-Cookie': 'a=b'})
+    response._content = b'{"a": 1}'
+    response.request = requests.Request('GET', response.url).prepare()
+    return response
+
+
+class TestCachedResponse(unittest.TestCase):
+    def test_from_response(self):
+        cached = CachedResponse.from_response(build_response())
+        self.assertEqual(200, cached.status_code)
+        self.assertEqual('http://example.com/', cached.url)
+        self.assertEqual('"etag"', cached.headers['etag'])
+        self.assertEqual({'content-type', 'etag'},
+                         {name.lower() for name in cached.headers})
+        self.assertEqual(b'{"a": 1}', cached.content)
+
+    def test_pickle(self):
+        response = build_response()
+        cached = CachedResponse.from_response(response)
+        data = pickle.dumps(cached)
+        self.assertLess(len(data), len(pickle.dumps(response)) / 2)
+        cached = pickle.loads(data)
+        self.assertEqual('application/json', cached.headers['Content-Type'])
+        self.assertEqual(b'{"a": 1}', cached.content)
+
+    def test_delegated(self):
+        cached = CachedResponse.from_response(build_response())
+        self.assertEqual({'a': 1}, cached.json())
+        self.assertEqual('{"a": 1}', cached.text)
+        self.assertTrue(cached.ok)
+        cached.raise_for_status()
+        self.assertIsInstance(cached.to_response(), requests.Response)
+        self.assertIs(cached.to_response(), cached.to_response())
+        with self.assertRaises(AttributeError):
+            cached.missing
+
+    def test_headers(self):
+        cached = CachedResponse.from_response(build_response())
+        cached.to_response()
+        cached.headers = {'ETag': '"new"'}
+        self.assertEqual('"new"', cached.headers['etag'])
+        self.assertEqual('"new"', cached.to_response().headers['etag'])
@@ -0,0 +1,75 @@
+from shelfcache import serializers
+from shelfcache.serializers import (Pickle, OutOfBand, Raw, Json, Marshal,
+                                    Chain)
+from datetime import datetime
+import pickle
+import unittest
+
+
+class TestSerializers(unittest.TestCase):
+    def roundtrip(self, serializer, obj):
+        codec, payload = serializer.encode(obj)
+        return serializers.loads(codec, memoryview(payload))
+
+    def test_pickle(self):
+        obj = {'a': (1, 2.5, None)}
+        self.assertEqual(obj, self.roundtrip(Pickle(), obj))
+        self.assertEqual(2, Pickle(2).dumps(obj)[1])
+        self.assertEqual(4, Pickle().dumps(obj, 4)[1])
+        self.assertEqual(2, Pickle(2).dumps(obj, 4)[1])
+
+    def test_out_of_band(self):
+        data = bytearray(b'x' * 100000)
+        obj = {'buf': data, 'other': [bytearray(b'yz'), 'str']}
+        codec, payload = OutOfBand().encode(obj)
+        self.assertEqual(serializers.OUT_OF_BAND, codec)
+        self.assertLess(len(payload), 100200)
+        self.assertEqual(obj, serializers.loads(codec, memoryview(payload)))
+        # In-band objects only:
+        self.assertEqual('str', self.roundtrip(OutOfBand(), 'str'))
+
+    def test_out_of_band_no_copy(self):
+        """
+        Buffers are unpickled straight from the payload.
+        """
+        payload = memoryview(OutOfBand().dumps(pickle.PickleBuffer(b'abc')))
+        self.assertEqual(b'abc', bytes(OutOfBand().loads(payload)))
+        view = OutOfBand().loads(payload)
+        self.assertIsInstance(view, memoryview)
+        self.assertIs(payload.obj, view.obj)
+
+    def test_raw(self):
+        self.assertEqual(b'abc', self.roundtrip(Raw(), b'abc'))
+        self.assertEqual(b'abc', self.roundtrip(Raw(), bytearray(b'abc')))
+        self.assertFalse(Raw().accepts('abc'))
+        self.assertRaises(TypeError, Raw().encode, 'abc')
+
+    def test_json_marshal(self):
+        obj = {'a': [1, 2.5, None, 'x']}
+        self.assertEqual(obj, self.roundtrip(Json(), obj))
+        self.assertEqual((1, b'x'), self.roundtrip(Marshal(), (1, b'x')))
+        self.assertFalse(Json().accepts(object()))
+        self.assertFalse(Marshal().accepts(object()))
+
+    def test_chain(self):
+        chain = Chain(Raw(), Json(), Pickle())
+        self.assertEqual(serializers.RAW, chain.encode(b'x')[0])
+        self.assertEqual(serializers.JSON, chain.encode([1])[0])
+        self.assertEqual(serializers.PICKLE, chain.encode({1, 2})[0])
+        self.assertRaises(TypeError, Chain(Raw()).encode, 'x')
+        self.assertRaises(ValueError, Chain)
+
+    def test_chain_fallback(self):
+        obj = {'a': datetime(2020, 1, 2)}
+        codec, payload = Chain(Json(), Pickle()).encode(obj)
+        self.assertEqual(serializers.PICKLE, codec)
+        self.assertEqual(obj, serializers.loads(codec, memoryview(payload)))
+        self.assertRaises(TypeError, Chain(Json()).encode, obj)
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, serializers.Encoder)
+        self.assertRaises(TypeError, serializers.Serializer)
+        self.assertFalse(hasattr(Chain, 'loads'))
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, serializers.loads, 15, b'')
@@ -0,0 +1,59 @@
+from shelfcache import CachedSession
+from shelfcache.shelfcache import ShelfCache
+from test.test_cache_get import build_response
+from unittest.mock import MagicMock
+import requests
+import unittest
+import tempfile
+import os
+
+
+class TestCachedSession(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ShelfCache(os.path.join(self.tmpdir.name, 'cache.db'),
+                                exp_seconds=60)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def test_get(self):
+        """
+        Misses are fetched with the session's get (with the default args),
+        hits are not.
+        """
+        session = CachedSession(self.cache, timeout=5)
+        session.session.get = MagicMock(return_value=build_response())
+        resp = session.get('http://example.com/feed', compact=True)
+        session.session.get.assert_called_once_with(
+            'http://example.com/feed', headers={}, timeout=5)
+        self.assertEqual(200, resp.status_code)
+        cached = session.get('http://example.com/feed')
+        session.session.get.assert_called_once()
+        self.assertEqual(resp.content, cached.content)
+
+    def test_pool_sizes(self):
+        session = CachedSession(self.cache, pool_maxsize=4,
+                                host_pool_sizes={'https://a.example': 16,
+                                                 'b.example': 8})
+        sizes = {url: session.session.get_adapter(url)._pool_maxsize
+                 for url in ('https://a.example/feed', 'http://a.example/',
+                             'http://b.example/', 'https://b.example/x',
+                             'https://c.example/')}
+        self.assertEqual({'https://a.example/feed': 16,
+                          'http://a.example/': 4,
+                          'http://b.example/': 8,
+                          'https://b.example/x': 8,
+                          'https://c.example/': 4}, sizes)
+        session.set_pool_size('https://c.example', 2)
+        adapter = session.session.get_adapter('https://c.example/')
+        self.assertEqual(2, adapter._pool_maxsize)
+        self.assertEqual(100, adapter._pool_connections)
+
+    def test_close(self):
+        mock_session = MagicMock(spec=requests.Session)
+        mock_session.adapters = {}
+        with CachedSession(self.cache, session=mock_session) as session:
+            self.assertIs(mock_session, session.session)
+        mock_session.close.assert_called_once()
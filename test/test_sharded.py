@@ -0,0 +1,76 @@
+from shelfcache import ShardedShelfCache
+from shelfcache.shelfcache import ShelfCache
+from datetime import datetime, timedelta
+import unittest
+import tempfile
+import os
+
+
+class TestShardedShelfCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'cache.db')
+        self.sc = ShardedShelfCache(self.db, shards=4)
+        self.yesterday = datetime.utcnow() - timedelta(days=1)
+
+    def tearDown(self):
+        self.sc.close()
+        self.tmpdir.cleanup()
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, ShardedShelfCache, self.db, shards=0)
+
+    def test_keys_spread(self):
+        """
+        Keys are mapped to the same shard by every instance.
+        """
+        for i in range(40):
+            self.sc[str(i)] = i
+        counts = [len(ShelfCache(shard.db_path).get_many(map(str, range(40))))
+                  for shard in self.sc.shards]
+        self.assertEqual(40, sum(counts))
+        self.assertNotIn(40, counts)
+        other = ShardedShelfCache(self.db, shards=4)
+        self.assertEqual(7, other['7'].data)
+
+    def test_single(self):
+        self.sc.create_or_update('key', data='data', exp_seconds=60)
+        self.assertEqual('data', self.sc.get('key').data)
+        self.assertTrue(self.sc.is_fresh('key'))
+        self.assertEqual(2, self.sc.incr('count', 2))
+        self.assertTrue(self.sc.compare_and_set('key', 1, 'new'))
+        self.sc.delete('key')
+        self.assertIsNone(self.sc.get('key'))
+
+    def test_batches(self):
+        self.sc.set_many({str(i): i for i in range(20)})
+        found = self.sc.get_many(str(i) for i in range(25))
+        self.assertEqual(list(range(20)),
+                         sorted(result.data for result in found.values()))
+        self.assertEqual(10, self.sc.delete_many(str(i) for i in range(10)))
+        self.assertEqual(10, self.sc.stats()['items'])
+
+    def test_prune_and_clear(self):
+        self.sc.set_many({str(i): i for i in range(10)},
+                         expire_dt=self.yesterday)
+        self.sc['new'] = 'new'
+        self.assertEqual(10, self.sc.prune_expired())
+        self.assertEqual(['new'], list(self.sc.get_many(['new', '1'])))
+        self.assertEqual(1, self.sc.prune_old())
+        self.sc['new'] = 'new'
+        self.sc.clear()
+        self.assertEqual(0, self.sc.stats()['items'])
+
+    def test_metrics(self):
+        """
+        The shards share the metrics, which are reported once.
+        """
+        sc = ShardedShelfCache(self.db + '.metrics', shards=4, metrics=True)
+        sc.set_many({str(i): i for i in range(10)})
+        sc.get_many(str(i) for i in range(20))
+        self.assertTrue(all(shard.metrics is sc.metrics
+                            for shard in sc.shards))
+        stats = sc.stats()
+        self.assertEqual((10, 10, 10), (stats['items'], stats['hits'],
+                                        stats['misses']))
+        sc.close()
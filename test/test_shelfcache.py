@@ -1,8 +1,20 @@
 from shelfcache.shelfcache import ShelfCache, Item
+from shelfcache import record, serializers
+from shelfcache.serializers import Chain, Raw, Json, Pickle
+from shelfcache.stats import CacheStats
 import unittest
+import unittest.mock
 from unittest.mock import MagicMock
-from shelfcache.locked_shelf import RWShelf
+from shelfcache.locked_shelf import RWShelf, MutexShelf
+from shelfcache.log_shelf import LogShelf
+from shelfcache.sqlite_shelf import SqliteShelf, close_connections
 from datetime import datetime, timedelta
+import tempfile
+import shelve
+import multiprocessing
+import threading
+import time
+import os
 
 
 def make_mock_locked_shelf(wrapped_dict=None):
@@ -18,6 +30,7 @@ def make_mock_locked_shelf(wrapped_dict=None):
     # wraps doesn't seem to actually wrap these magic methods:
     mock_dict.__setitem__.side_effect = wrapped_dict.__setitem__
     mock_dict.__delitem__.side_effect = wrapped_dict.__delitem__
+    mock_dict.__contains__.side_effect = wrapped_dict.__contains__
     mock_shelf.return_value.__enter__.return_value = mock_dict
     return mock_shelf
 
@@ -218,6 +231,19 @@ class TestSet(unittest.TestCase):
         self.assertEqual('val', data)
         self.assertEqual(exp, tomorrow)
 
+    def test_create_or_update_zero(self):
+        """
+        An exp_seconds of 0 means that the item never expires.
+        """
+        mock_shelf = make_mock_locked_shelf()
+        mock_dict = mock_shelf.return_value.__enter__.return_value
+
+        # DUT:
+        sc = ShelfCache(db_path='dummy', shelf_t=mock_shelf)
+        sc.create_or_update('key', data='val', exp_seconds=0)
+        item = mock_dict.get('key')
+        self.assertIsNone(item.expire_dt)
+
     def test_create_or_update_updates(self):
         """
         Check that updating an existing item with create_or_update will update
@@ -450,3 +476,607 @@ class TestPrune(unittest.TestCase):
 
         self.assertIsNone(old)
         self.assertEqual('new', new.data)
+
+    def test_iter_prune(self):
+        """
+        Each chunk is deleted under its own lock.
+        """
+        mock_shelf = make_mock_locked_shelf()
+        yesterday = datetime.utcnow() + timedelta(days=-1)
+
+        # DUT:
+        sc = ShelfCache(db_path='dummy', shelf_t=mock_shelf)
+        sc.set_many([('a', 1), ('b', 2), ('c', 3)], expire_dt=yesterday)
+        sc['new'] = 'new'
+        mock_shelf.reset_mock()
+
+        self.assertEqual([2, 1], [count for count, _ in
+                                  sc.iter_prune(chunk_size=2)])
+        flags = [call[1]['flag'] for call in mock_shelf.call_args_list]
+        self.assertEqual(['r', 'c', 'c'], flags)
+        self.assertEqual('new', sc.get('new').data)
+        self.assertIsNone(sc.get('a'))
+
+
+class TestPersistent(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'cache.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_roundtrip(self):
+        """
+        Items written in persistent mode can be read back, and are visible to
+        a non-persistent cache on the same file.
+        """
+        with ShelfCache(db_path=self.db, persistent=True) as sc:
+            self.assertIsNone(sc.get('key'))
+            sc['key'] = 'val'
+            self.assertEqual('val', sc['key'].data)
+            sc.replace_data('key', 'new')
+
+            other = ShelfCache(db_path=self.db)
+            self.assertEqual('new', other['key'].data)
+            other['key'] = 'other'
+            self.assertEqual('other', sc['key'].data)
+
+    def test_session(self):
+        """
+        session() opens a persistent handle only for the `with` block.
+        """
+        sc = ShelfCache(db_path=self.db)
+        with sc.session():
+            sc['key'] = 'val'
+            self.assertIsNotNone(sc._handle)
+        self.assertIsNone(sc._handle)
+        self.assertEqual('val', sc['key'].data)
+
+    def test_requires_rwshelf(self):
+        with self.assertRaises(ValueError):
+            ShelfCache(db_path=self.db, shelf_t=MutexShelf, persistent=True)
+
+
+class TestMemoryTier(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'cache.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_hit_skips_db(self):
+        """
+        Repeated reads are served from memory without opening the database.
+        """
+        sc = ShelfCache(db_path=self.db, memory_items=10)
+        sc['key'] = 'val'
+        self.assertEqual('val', sc['key'].data)
+        sc.shelf_t = MagicMock(side_effect=AssertionError)
+        self.assertEqual('val', sc['key'].data)
+
+    def test_own_write_invalidates(self):
+        sc = ShelfCache(db_path=self.db, memory_items=10)
+        sc['key'] = 'val'
+        sc['other'] = 'other'
+        self.assertEqual('val', sc['key'].data)
+        self.assertEqual('other', sc['other'].data)
+        sc['key'] = 'new'
+        self.assertEqual('new', sc['key'].data)
+        self.assertEqual(2, len(sc._memory))
+
+    def test_other_writer_invalidates(self):
+        """
+        A write by another cache on the same file (eg. in another process)
+        is never hidden by the memory tier.
+        """
+        sc = ShelfCache(db_path=self.db, memory_items=10)
+        sc['key'] = 'val'
+        self.assertEqual('val', sc['key'].data)
+        ShelfCache(db_path=self.db)['key'] = 'other'
+        self.assertEqual('other', sc['key'].data)
+        ShelfCache(db_path=self.db).delete('key')
+        self.assertIsNone(sc.get('key'))
+
+
+class TestBatch(unittest.TestCase):
+    def test_get_many(self):
+        """
+        get_many() returns the cached keys (and skips missing ones) under a
+        single lock acquisition.
+        """
+        yesterday = datetime.utcnow() + timedelta(days=-1)
+        wrapped_dict = {'a': Item(data='a'),
+                        'b': Item(data='b', expire_dt=yesterday)}
+        mock_shelf = make_mock_locked_shelf(wrapped_dict)
+
+        # DUT:
+        sc = ShelfCache(db_path='dummy', shelf_t=mock_shelf)
+        results = sc.get_many(['a', 'b', 'c'])
+
+        self.assertEqual({'a', 'b'}, set(results))
+        self.assertEqual(('a', False), results['a'])
+        self.assertEqual(('b', True), results['b'])
+        mock_shelf.assert_called_once_with('dummy', flag='r')
+
+    def test_set_many(self):
+        """
+        set_many() stores every item under a single lock acquisition.
+        """
+        mock_shelf = make_mock_locked_shelf()
+        mock_dict = mock_shelf.return_value.__enter__.return_value
+
+        # DUT:
+        sc = ShelfCache(db_path='dummy', shelf_t=mock_shelf)
+        sc.set_many({'a': 1, 'b': 2}, exp_seconds=10)
+
+        mock_shelf.assert_called_once_with('dummy', flag='c')
+        self.assertEqual(1, mock_dict.get('a').data)
+        self.assertEqual(2, mock_dict.get('b').data)
+        self.assertIsNotNone(mock_dict.get('b').expire_dt)
+
+    def test_delete_many(self):
+        wrapped_dict = {'a': Item(data='a'), 'b': Item(data='b')}
+        mock_shelf = make_mock_locked_shelf(wrapped_dict)
+
+        # DUT:
+        sc = ShelfCache(db_path='dummy', shelf_t=mock_shelf)
+        count = sc.delete_many(['a', 'c'])
+
+        self.assertEqual(1, count)
+        self.assertEqual(['b'], list(wrapped_dict))
+        mock_shelf.assert_called_once_with('dummy', flag='c')
+
+    def test_transaction(self):
+        """
+        All operations inside a transaction share one exclusive acquisition.
+        """
+        mock_shelf = make_mock_locked_shelf()
+
+        # DUT:
+        sc = ShelfCache(db_path='dummy', shelf_t=mock_shelf)
+        with sc.transaction():
+            sc['a'] = 1
+            sc['b'] = sc['a'].data + 1
+            sc.update_expires('a')
+            del sc['a']
+        self.assertEqual(2, sc['b'].data)
+        self.assertEqual(2, mock_shelf.call_count)
+
+    def test_update_expires_single_lock(self):
+        wrapped_dict = {'a': Item(data='a')}
+        mock_shelf = make_mock_locked_shelf(wrapped_dict)
+
+        # DUT:
+        sc = ShelfCache(db_path='dummy', shelf_t=mock_shelf)
+        sc.update_expires('a')
+        sc.replace_data('a', 'b')
+        self.assertEqual(2, mock_shelf.call_count)
+        self.assertEqual('b', wrapped_dict['a'].data)
+        self.assertIsNotNone(wrapped_dict['a'].expire_dt)
+
+    def test_transaction_memory(self):
+        """
+        Writes made in a transaction invalidate the memory tier.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sc = ShelfCache(db_path=os.path.join(tmpdir, 'cache.db'),
+                            memory_items=10)
+            sc.set_many([('a', 1), ('b', 2)])
+            self.assertEqual(2, len(sc.get_many(['a', 'b'])))
+            with sc.transaction():
+                sc['a'] = 3
+                self.assertEqual(3, sc['a'].data)
+            self.assertEqual(3, sc['a'].data)
+            self.assertEqual(2, sc['b'].data)
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'cache.db')
+        self.yesterday = datetime.utcnow() + timedelta(days=-1)
+        self.tomorrow = datetime.utcnow() + timedelta(days=1)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_prune_without_reading_items(self):
+        """
+        Pruning with the index does not read the cached items.
+        """
+        sc = ShelfCache(db_path=self.db, index=True)
+        sc.create_or_update('old', data='old', expire_dt=self.yesterday)
+        sc.create_or_update('new', data='new', expire_dt=self.tomorrow)
+        sc.create_or_update('never', data='never')
+
+        sc._load = MagicMock(side_effect=AssertionError)
+        self.assertEqual(1, sc.prune_expired())
+        del sc._load
+
+        self.assertIsNone(sc.get('old'))
+        self.assertEqual('new', sc.get('new').data)
+        self.assertEqual('never', sc.get('never').data)
+
+    def test_stats_and_expiring(self):
+        sc = ShelfCache(db_path=self.db, index=True)
+        sc.create_or_update('old', data='old', expire_dt=self.yesterday)
+        sc.create_or_update('new', data='new', expire_dt=self.tomorrow)
+        stats = sc.stats()
+        self.assertEqual(2, stats['items'])
+        self.assertEqual(1, stats['expired'])
+        self.assertGreater(stats['bytes'], 0)
+        self.assertEqual(['new'], sc.expiring(timedelta(days=2)))
+        self.assertEqual([], sc.expiring(timedelta(hours=1)))
+
+        # Same answers without the index:
+        plain = ShelfCache(db_path=self.db)
+        os.remove(self.db + '.idx')
+        self.assertEqual(stats, plain.stats())
+        self.assertEqual(['new'], plain.expiring(timedelta(days=2)))
+
+    def test_maintained_by_other_writers(self):
+        """
+        The index is built from an existing database, and kept up to date by
+        caches which did not ask for it.
+        """
+        plain = ShelfCache(db_path=self.db)
+        plain.create_or_update('old', data='old', expire_dt=self.yesterday)
+        sc = ShelfCache(db_path=self.db, index=True)
+        plain.create_or_update('old2', data='old', expire_dt=self.yesterday)
+        plain['new'] = 'new'
+        plain.delete('new')
+        self.assertEqual(2, sc.stats()['items'])
+        self.assertEqual(2, sc.prune_expired())
+        plain.clear()
+        self.assertEqual(0, sc.stats()['items'])
+
+
+class TestRecords(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'cache.db')
+        self.tomorrow = datetime.utcnow() + timedelta(days=1)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_clear(self):
+        sc = ShelfCache(db_path=self.db)
+        sc['a'] = 'a'
+        sc['b'] = 'b'
+        sc.clear()
+        self.assertIsNone(sc.get('a'))
+        self.assertEqual(0, sc.stats()['items'])
+
+    def test_probes_skip_payload(self):
+        """
+        meta(), ttl() and is_fresh() do not deserialize the cached data, and
+        neither does updating the expiry date.
+        """
+        sc = ShelfCache(db_path=self.db)
+        sc.create_or_update('key', data='val', expire_dt=self.tomorrow)
+        sc['never'] = 'never'
+        with unittest.mock.patch('pickle.loads',
+                                 side_effect=AssertionError):
+            self.assertEqual(self.tomorrow, sc.meta('key').expire_dt)
+            self.assertTrue(sc.is_fresh('key'))
+            self.assertGreater(sc.ttl('key'), timedelta(hours=23))
+            self.assertIsNone(sc.ttl('never'))
+            self.assertFalse(sc.is_fresh('missing'))
+            self.assertIsNone(sc.meta('missing'))
+            sc.update_expires('key')
+            self.assertFalse(sc.is_fresh('key'))
+            item = sc.get_item('key')
+        self.assertEqual('val', item.data)
+        with self.assertRaises(KeyError):
+            sc.ttl('missing')
+
+    def test_legacy_items(self):
+        """
+        Databases of pickled Items written by older versions are still read,
+        and pruned.
+        """
+        with shelve.open(self.db) as shelf:
+            shelf['old'] = Item('old', datetime.utcnow() + timedelta(days=-1))
+            shelf['new'] = Item('new', self.tomorrow)
+        sc = ShelfCache(db_path=self.db)
+        self.assertEqual('new', sc['new'].data)
+        self.assertEqual(self.tomorrow, sc.meta('new').expire_dt)
+        created = sc.meta('new').created_dt
+        sc['new'] = 'newer'
+        self.assertEqual(created, sc.meta('new').created_dt)
+        self.assertEqual(1, sc.prune_expired())
+        self.assertEqual(['new'], list(sc.get_many(['old', 'new'])))
+
+    def test_compression(self):
+        """
+        Large values are compressed, and compressed and uncompressed records
+        are read by any cache.
+        """
+        self.assertRaises(ValueError, ShelfCache, self.db, compression='zip')
+        big = 'data' * 1000
+        plain = ShelfCache(db_path=self.db)
+        sc = ShelfCache(db_path=self.db, compression='zlib',
+                        compress_threshold=100)
+        plain['plain'] = big
+        sc['big'] = big
+        sc['small'] = 'small'
+        with shelve.open(self.db) as shelf:
+            self.assertEqual(record.ZLIB,
+                             record.unpack_meta(shelf.dict[b'big'])[1])
+            self.assertEqual(record.PICKLE,
+                             record.unpack_meta(shelf.dict[b'small'])[1])
+        self.assertLess(sc.meta('big').size, sc.meta('plain').size / 10)
+        for cache in (plain, sc):
+            self.assertEqual(big, cache['big'].data)
+            self.assertEqual(big, cache['plain'].data)
+            self.assertEqual('small', cache['small'].data)
+        # Rewriting the metadata keeps the compressed payload
+        sc.update_expires('big', self.tomorrow)
+        plain.update_expires('big', self.tomorrow)
+        self.assertEqual(big, plain['big'].data)
+
+    def test_serializer(self):
+        """
+        Items are read with the serializer which wrote them.
+        """
+        sc = ShelfCache(db_path=self.db,
+                        serializer=Chain(Raw(), Json(), Pickle(2)))
+        sc['bytes'] = b'bytes'
+        sc['json'] = {'a': [1]}
+        sc['set'] = {1, 2}
+        with shelve.open(self.db) as shelf:
+            self.assertEqual([serializers.RAW, serializers.JSON,
+                              serializers.PICKLE],
+                             [record.unpack_meta(shelf.dict[key])[1]
+                              for key in (b'bytes', b'json', b'set')])
+        plain = ShelfCache(db_path=self.db)
+        self.assertEqual(b'bytes', plain['bytes'].data)
+        self.assertEqual({'a': [1]}, plain['json'].data)
+        self.assertEqual({1, 2}, plain['set'].data)
+
+    def test_get_bytes(self):
+        sc = ShelfCache(db_path=self.db, serializer=Raw())
+        sc['key'] = b'value'
+        view = sc.get_bytes('key')
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(b'value', view)
+        self.assertIsNone(sc.get_bytes('missing'))
+        self.assertRaises(TypeError, sc.__setitem__, 'str', 'value')
+        plain = ShelfCache(db_path=self.db)
+        plain['pickled'] = b'pickled'
+        plain['str'] = 'str'
+        self.assertEqual(b'pickled', plain.get_bytes('pickled'))
+        self.assertRaises(TypeError, plain.get_bytes, 'str')
+
+    def test_blobs(self):
+        """
+        Large values are stored once in the blob store, and collected when no
+        item refers to them.
+        """
+        big = b'x' * 10000
+        sc = ShelfCache(db_path=self.db, blob_threshold=1000)
+        sc.create_or_update('a', data={'body': big}, exp_seconds=-1)
+        sc.create_or_update('b', data=[big], expire_dt=self.tomorrow)
+        sc['small'] = b'small'
+        self.assertEqual(1, len(list(sc.blob_store.digests())))
+        self.assertLess(sc.stats()['bytes'], 1000)
+        self.assertEqual({'body': big}, sc['a'].data)
+        # Readable without a blob_threshold
+        self.assertEqual([big], ShelfCache(db_path=self.db)['b'].data)
+
+        sc.delete('a')
+        sc.prune_expired()
+        self.assertEqual(1, len(list(sc.blob_store.digests())))
+        sc.delete('b')
+        sc.prune_expired()
+        self.assertEqual(1, len(list(sc.blob_store.digests())))
+        self.assertEqual((1, 10000), sc.collect_blobs(grace=0))
+        self.assertEqual(b'small', sc['small'].data)
+
+        # Blobs which were just written survive a clear()
+        sc['c'] = big
+        sc.clear()
+        self.assertEqual(1, len(list(sc.blob_store.digests())))
+
+
+def _incr_many(db, n, shelf_t=RWShelf):
+    sc = ShelfCache(db_path=db, shelf_t=shelf_t)
+    for _ in range(n):
+        sc.incr('count')
+
+
+class TestAtomic(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'cache.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_update(self):
+        """
+        update() applies the function under one exclusive lock and keeps the
+        item's expiry datetime.
+        """
+        mock_shelf = make_mock_locked_shelf()
+        tomorrow = datetime.utcnow() + timedelta(days=1)
+
+        # DUT:
+        sc = ShelfCache(db_path='dummy', shelf_t=mock_shelf)
+        sc.create_or_update('key', data=[1], expire_dt=tomorrow)
+        mock_shelf.reset_mock()
+        self.assertEqual([1, 2], sc.update('key', lambda l: l + [2]))
+        mock_shelf.assert_called_once_with('dummy', flag='c')
+        self.assertEqual([1, 2], sc['key'].data)
+        self.assertEqual(tomorrow, sc.get_item('key').expire_dt)
+        self.assertEqual(['new'], sc.update('other', lambda l: l + ['new'],
+                                            default=[]))
+
+    def test_incr(self):
+        sc = ShelfCache(db_path=self.db)
+        self.assertEqual(1, sc.incr('count'))
+        self.assertEqual(11, sc.incr('count', 10))
+        self.assertEqual(5, sc.incr('other', initial=5, n=0))
+
+    def test_incr_processes(self):
+        """
+        Concurrent increments from several processes are never lost, with
+        any of the shelves supporting them.
+        """
+        for shelf_t in (RWShelf, SqliteShelf, LogShelf):
+            with self.subTest(shelf_t=shelf_t.__name__):
+                db = os.path.join(self.tmpdir.name, shelf_t.__name__)
+                procs = [multiprocessing.Process(target=_incr_many,
+                                                 args=(db, 20, shelf_t))
+                         for _ in range(4)]
+                for p in procs:
+                    p.start()
+                for p in procs:
+                    p.join()
+                sc = ShelfCache(db_path=db, shelf_t=shelf_t)
+                self.assertEqual(80, sc['count'].data)
+        close_connections()
+
+    def test_compare_and_set(self):
+        sc = ShelfCache(db_path=self.db)
+        self.assertTrue(sc.compare_and_set('key', 0, 'first'))
+        self.assertFalse(sc.compare_and_set('key', 0, 'again'))
+        version = sc.meta('key').version
+        self.assertEqual(1, version)
+        self.assertTrue(sc.compare_and_set('key', version, 'second'))
+        self.assertFalse(sc.compare_and_set('key', version, 'third'))
+        self.assertEqual('second', sc['key'].data)
+        sc.update_expires('key')
+        self.assertEqual(3, sc.meta('key').version)
+
+
+class TestEviction(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'cache.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, ShelfCache, db_path=self.db,
+                          max_items=1, policy='fifo')
+
+    def test_max_items_lru(self):
+        sc = ShelfCache(db_path=self.db, max_items=3)
+        self.assertTrue(os.path.exists(self.db + '.idx'))
+        for key in 'abc':
+            sc[key] = key
+        sc.get('a')
+        sc['d'] = 'd'
+        self.assertEqual(3, sc.stats()['items'])
+        self.assertIsNone(sc.get('b'))
+        for key in 'acd':
+            self.assertEqual(key, sc.get(key).data)
+
+    def test_max_items_lfu(self):
+        sc = ShelfCache(db_path=self.db, max_items=2, policy='lfu')
+        sc['a'] = 'a'
+        sc['b'] = 'b'
+        sc.get_many(['a', 'a', 'b'])
+        sc.get('b')
+        sc.get('a')
+        sc['c'] = 'c'
+        sc['d'] = 'd'
+        # 'c' was used less than 'a'
+        self.assertIsNone(sc.get('c'))
+        self.assertEqual('a', sc.get('a').data)
+        self.assertEqual(2, sc.stats()['items'])
+
+    def test_max_bytes_ttl(self):
+        now = datetime.utcnow()
+        sc = ShelfCache(db_path=self.db, max_bytes=1000, policy='ttl')
+        sc.create_or_update('soon', 'x' * 250, now + timedelta(hours=1))
+        sc.create_or_update('later', 'x' * 250, now + timedelta(days=1))
+        sc.create_or_update('never', 'x' * 250)
+        sc.create_or_update('new', 'x' * 250, now + timedelta(days=2))
+        self.assertIsNone(sc.get('soon'))
+        self.assertLessEqual(sc.stats()['bytes'], 1000)
+        self.assertEqual(3, sc.stats()['items'])
+
+    def test_memory_tier_hits(self):
+        """
+        Reads served from the memory tier count as uses, and evicted items
+        are dropped from the memory tier.
+        """
+        sc = ShelfCache(db_path=self.db, max_items=2, memory_items=10)
+        sc['a'] = 'a'
+        sc['b'] = 'b'
+        sc.get('a')
+        sc.get('a')  # from memory
+        self.assertEqual(1, len(sc._accessed))
+        sc['c'] = 'c'
+        self.assertEqual(0, len(sc._accessed))
+        self.assertIsNone(sc.get('b'))
+        self.assertEqual('a', sc.get('a').data)
+
+    def test_transaction(self):
+        sc = ShelfCache(db_path=self.db, max_items=2)
+        with sc.transaction():
+            for key in 'abcd':
+                sc[key] = key
+        self.assertEqual(2, sc.stats()['items'])
+        self.assertEqual('d', sc.get('d').data)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'cache.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_disabled(self):
+        sc = ShelfCache(db_path=self.db)
+        self.assertIsNone(sc.metrics)
+        sc['a'] = 'a'
+        self.assertEqual({'items', 'bytes', 'expired'}, set(sc.stats()))
+
+    def test_metrics(self):
+        sc = ShelfCache(db_path=self.db, metrics=True, max_items=2)
+        sc['a'] = 'a'
+        sc.create_or_update('b', 'b', expire_dt=datetime.utcnow())
+        sc.get('a')
+        sc.get('b')
+        sc.get_many(['a', 'c', 'd'])
+        sc['c'] = 'c'
+        stats = sc.stats()
+        self.assertEqual(2, stats['items'])
+        self.assertEqual((2, 1, 2, 1), (stats['hits'], stats['stale_hits'],
+                                        stats['misses'], stats['evictions']))
+        self.assertGreater(stats['bytes_read'], 0)
+        self.assertGreater(stats['bytes_written'], 0)
+        self.assertGreater(stats['latency']['lock_wait']['count'], 0)
+        self.assertEqual(3, stats['latency']['deserialize']['count'])
+
+    def test_shared(self):
+        metrics = CacheStats()
+        ShelfCache(db_path=self.db, metrics=metrics)['a'] = 'a'
+        ShelfCache(db_path=self.db, metrics=metrics).get('a')
+        self.assertEqual(1, metrics.snapshot()['hits'])
+
+    def test_lock_wait(self):
+        sc = ShelfCache(db_path=self.db, metrics=True)
+        sc['a'] = 'a'
+        locked = threading.Event()
+
+        def hold_lock():
+            with RWShelf(self.db, flag='c'):
+                locked.set()
+                time.sleep(0.3)
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        locked.wait()
+        sc.get('a')
+        holder.join()
+        lock_wait = sc.stats()['latency']['lock_wait']
+        self.assertGreaterEqual(lock_wait['max'], 0.2)
@@ -0,0 +1,111 @@
+from shelfcache.shelfcache import ShelfCache
+from shelfcache.sqlite_shelf import (SqliteShelf, SqliteGeneration,
+                                     close_connections)
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+import unittest
+import tempfile
+import threading
+import os
+
+
+class TestSqliteShelf(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'cache.sqlite')
+
+    def tearDown(self):
+        close_connections()
+        self.tmpdir.cleanup()
+
+    def test_shelf(self):
+        self.assertRaises(FileNotFoundError, SqliteShelf, self.db, flag='r')
+        with SqliteShelf(self.db, flag='c') as shelf:
+            shelf['key'] = [1, 2]
+            shelf['other'] = 'other'
+            del shelf['other']
+            self.assertRaises(KeyError, shelf.__delitem__, 'other')
+        with SqliteShelf(self.db, flag='r') as shelf:
+            self.assertEqual([1, 2], shelf['key'])
+            self.assertEqual(['key'], list(shelf.keys()))
+            self.assertNotIn('other', shelf)
+        with SqliteShelf(self.db, flag='n') as shelf:
+            self.assertEqual(0, len(shelf))
+
+    def test_reader_not_blocked(self):
+        """
+        A reader sees the last committed data while a writer holds the lock.
+        """
+        with SqliteShelf(self.db) as shelf:
+            shelf['key'] = 'old'
+        writing = threading.Event()
+        done = threading.Event()
+
+        def write():
+            with SqliteShelf(self.db) as shelf:
+                shelf['key'] = 'new'
+                writing.set()
+                done.wait(5)
+            close_connections()
+
+        t = threading.Thread(target=write)
+        t.start()
+        writing.wait(5)
+        with SqliteShelf(self.db, flag='r') as shelf:
+            self.assertEqual('old', shelf['key'])
+        done.set()
+        t.join()
+        with SqliteShelf(self.db, flag='r') as shelf:
+            self.assertEqual('new', shelf['key'])
+
+    def test_cache(self):
+        yesterday = datetime.utcnow() - timedelta(days=1)
+        sc = ShelfCache(db_path=self.db, shelf_t=SqliteShelf)
+        self.assertIsNone(sc.get('missing'))
+        sc.create_or_update('old', data='old', expire_dt=yesterday)
+        sc.create_or_update('new', data='new', exp_seconds=60)
+        sc['never'] = 'never'
+        self.assertTrue(sc.get('old').expired)
+        self.assertEqual('new', sc.get('new').data)
+        self.assertEqual(2, sc.meta('new').version + sc.meta('old').version)
+        self.assertEqual(3, sc.stats()['items'])
+
+        # Pruning is a range delete, which does not read the items
+        sc._load_meta = MagicMock(side_effect=AssertionError)
+        self.assertEqual(1, sc.prune_expired())
+        self.assertEqual([], list(sc.iter_prune()))
+        self.assertEqual(2, sc.prune_old(datetime.utcnow()))
+        del sc._load_meta
+        self.assertIsNone(sc.get('never'))
+
+    def test_memory_generation(self):
+        """
+        A reader which reads while a writer has bumped the generation but not
+        committed yet doesn't keep the old data in its memory tier.
+        """
+        writer = ShelfCache(db_path=self.db, shelf_t=SqliteShelf)
+        writer['key'] = 'old'
+        reader = ShelfCache(db_path=self.db, shelf_t=SqliteShelf,
+                            memory_items=10)
+        bumped = threading.Event()
+        release = threading.Event()
+        bump = SqliteGeneration.bump
+
+        def slow_bump(generation):
+            value = bump(generation)
+            bumped.set()
+            release.wait(5)
+            return value
+
+        def write():
+            writer['key'] = 'new'
+            close_connections()
+
+        with patch.object(SqliteGeneration, 'bump', slow_bump):
+            t = threading.Thread(target=write)
+            t.start()
+            bumped.wait(5)
+            self.assertEqual('old', reader.get('key').data)
+            release.set()
+            t.join()
+        self.assertEqual('new', reader.get('key').data)
@@ -0,0 +1,47 @@
+from shelfcache.stats import CacheStats, Histogram, COUNTERS
+import unittest
+
+
+class TestHistogram(unittest.TestCase):
+    def test_quantiles(self):
+        histogram = Histogram()
+        self.assertEqual(0, histogram.quantile(0.5))
+        for _ in range(98):
+            histogram.observe(0.002)
+        histogram.observe(0.5)
+        histogram.observe(1000)
+        snapshot = histogram.snapshot()
+        self.assertEqual(100, snapshot['count'])
+        self.assertEqual(1000, snapshot['max'])
+        self.assertAlmostEqual(0.002, snapshot['p50'], delta=0.002)
+        self.assertAlmostEqual(0.5, snapshot['p99'], delta=0.5)
+        self.assertEqual(1000, histogram.quantile(1))
+
+
+class TestCacheStats(unittest.TestCase):
+    def test_snapshot(self):
+        stats = CacheStats()
+        snapshot = stats.snapshot()
+        self.assertEqual(set(COUNTERS) | {'latency'}, set(snapshot))
+        stats.incr('hits')
+        stats.incr('bytes_read', 100)
+        with stats.timer('fetch'):
+            pass
+        snapshot = stats.snapshot()
+        self.assertEqual((1, 100), (snapshot['hits'],
+                                    snapshot['bytes_read']))
+        self.assertEqual(1, snapshot['latency']['fetch']['count'])
+        stats.reset()
+        self.assertEqual(0, stats.snapshot()['hits'])
+
+    def test_callbacks(self):
+        events = []
+        stats = CacheStats(lambda name, value: events.append((name, value)))
+        stats.add_callback(lambda name, value: 1 / 0)
+        with self.assertLogs('shelfcache.stats'):
+            stats.incr('misses', 2)
+        with stats.timed_open('lock_wait', lambda: open(__file__)) as f:
+            self.assertFalse(f.closed)
+        self.assertEqual(('misses', 2), events[0])
+        self.assertEqual('lock_wait', events[1][0])
+        self.assertTrue(f.closed)